@@ -0,0 +1,7 @@
+"""
+Benchmarks
+----------
+
+Measures the throughput of scanning, hashing, storing states and backing up
+synthetic repositories. Run with `python -m benchmarks --help`.
+"""
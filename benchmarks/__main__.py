@@ -0,0 +1,184 @@
+from argparse import ArgumentParser
+import json
+import logging
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+from benchmarks import trees
+from benchmarks.timing import Benchmark
+from benchmarks.local_s3 import LocalS3Client
+from pyups import backups
+from pyups.configuration import Configuration
+from pyups.state.model import (DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS, State,
+                               calculate_state)
+from pyups.state.repository import StateRepository
+from pyups.state.store import StateStore
+
+
+def run(repository_path: Path, bucket_path: Path, store_items: int,
+        hash_workers: int, upload_workers: int, hash_algorithm: str) -> dict:
+    """
+    Runs each of the benchmarks against a repository.
+
+    Returns
+    -------
+    The results of the benchmarks, by their name.
+    """
+    results = {}
+    states = StateRepository(root_path=repository_path)
+
+    with Benchmark(results, "content_paths") as benchmark:
+        for path in states.content_paths():
+            benchmark.add(items=1)
+
+    paths = [path for path in states.content_paths()]
+    with Benchmark(results, "calculate_state") as benchmark:
+        for path in paths:
+            benchmark.add(items=1,
+                          size=calculate_state(
+                              path, hash_algorithm=hash_algorithm).size)
+
+    store_path = bucket_path.parent.joinpath("store")
+    store = StateStore(store_path)
+    items = [(Path(f"directory{i % 100}/item{i}"),
+              State(size=i, content_hash=f"{i:064x}", mtime_ns=i, inode=i))
+             for i in range(store_items)]
+    with Benchmark(results, "state_store_write") as benchmark:
+        store.store_states(items)
+        benchmark.add(items=len(items))
+    with Benchmark(results, "state_store_read") as benchmark:
+        for (item, _) in items:
+            store.get_state(item)
+            benchmark.add(items=1)
+    with Benchmark(results, "state_store_list") as benchmark:
+        for item in store.stored_items():
+            benchmark.add(items=1)
+    store.close()
+
+    total_size = sum(path.stat().st_size for path in paths)
+    client = LocalS3Client(bucket="benchmark", directory=bucket_path)
+    configuration = Configuration(s3_bucket="benchmark",
+                                  hash_algorithm=hash_algorithm)
+    with Benchmark(results, "backup_initial") as benchmark:
+        __check_backed_up(
+            backups.backup(repository_path,
+                           configuration,
+                           hash_workers=hash_workers,
+                           upload_workers=upload_workers,
+                           client=client))
+        benchmark.add(items=len(paths), size=total_size)
+    with Benchmark(results, "backup_unchanged") as benchmark:
+        __check_backed_up(
+            backups.backup(repository_path,
+                           configuration,
+                           hash_workers=hash_workers,
+                           upload_workers=upload_workers,
+                           client=client))
+        benchmark.add(items=len(paths))
+
+    return results
+
+
+def __check_backed_up(failed: list) -> None:
+    # Items that could not be backed up take less time than the others, so
+    # the results would not be meaningful.
+    if failed:
+        raise RuntimeError(f"{len(failed)} items could not be backed up, "
+                           f"e.g. {failed[0]}")
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """
+    Prints how long each benchmark took, relative to a baseline.
+    """
+    for (name, result) in results.items():
+        if name in baseline:
+            ratio = result["seconds"] / max(baseline[name]["seconds"], 1e-9)
+            print(f"{name}: {result['seconds']:.3f}s "
+                  f"({ratio:.2f}x of {baseline[name]['seconds']:.3f}s)")
+        else:
+            print(f"{name}: {result['seconds']:.3f}s (no baseline)")
+
+
+def __commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+parser = ArgumentParser(
+    prog="benchmarks",
+    description="Measures the throughput of pyups on a synthetic repository.")
+parser.add_argument("--shape",
+                    choices=trees.SHAPES,
+                    default=trees.TINY_FILES,
+                    help="The shape of the synthetic repository.")
+parser.add_argument("--files",
+                    type=int,
+                    default=10000,
+                    help="The number of files in the repository.")
+parser.add_argument("--file-size",
+                    type=int,
+                    default=None,
+                    help="The size of each file in bytes.")
+parser.add_argument("--depth",
+                    type=int,
+                    default=8,
+                    help="How deeply the directories are nested.")
+parser.add_argument("--store-items",
+                    type=int,
+                    default=100000,
+                    help="The number of states to write to the state store.")
+parser.add_argument("--hash-workers", type=int, default=1)
+parser.add_argument("--upload-workers", type=int, default=8)
+parser.add_argument("--hash-algorithm",
+                    choices=HASH_ALGORITHMS,
+                    default=DEFAULT_HASH_ALGORITHM,
+                    help="The algorithm that file contents are hashed with.")
+parser.add_argument("--directory",
+                    help="Where to create the repository. Defaults to a "
+                    "temporary directory.")
+parser.add_argument("--output", help="Write the results to this JSON file.")
+parser.add_argument("--compare",
+                    help="Compare the results against a previous JSON file.")
+arguments = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING)
+with tempfile.TemporaryDirectory(dir=arguments.directory) as directory:
+    repository_path = Path(directory).joinpath("repository")
+    trees.create(repository_path,
+                 shape=arguments.shape,
+                 files=arguments.files,
+                 file_size=arguments.file_size,
+                 depth=arguments.depth)
+    results = run(repository_path,
+                  bucket_path=Path(directory).joinpath("bucket"),
+                  store_items=arguments.store_items,
+                  hash_workers=arguments.hash_workers,
+                  upload_workers=arguments.upload_workers,
+                  hash_algorithm=arguments.hash_algorithm)
+
+report = {
+    "commit": __commit(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "parameters": vars(arguments),
+    "results": results
+}
+
+if arguments.output:
+    with open(arguments.output, mode="w") as output:
+        json.dump(report, output, indent=1)
+else:
+    json.dump(report, sys.stdout, indent=1)
+    print()
+
+if arguments.compare:
+    with open(arguments.compare) as baseline:
+        compare(results, json.load(baseline)["results"])
@@ -0,0 +1,130 @@
+from pathlib import Path
+import shutil
+import uuid
+from botocore.exceptions import ClientError
+
+
+class LocalS3Client:
+    """
+    A stand-in for the S3 client from `boto3`, which stores the objects of a
+    single bucket as files in a local directory. Only the operations used when
+    backing up are provided.
+    """
+    __COPY_SIZE = 65536 * 8
+
+    def __init__(self, bucket: str, directory: Path):
+        self.__bucket = bucket
+        self.__directory = directory
+        # The parts of multipart uploads are kept next to the bucket until the
+        # uploads are completed.
+        self.__uploads = directory.with_name(directory.name + ".uploads")
+
+    def __path(self, bucket: str, key: str) -> Path:
+        assert bucket == self.__bucket
+        return self.__directory.joinpath(key)
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str) -> None:
+        with open(Filename, mode="rb") as source:
+            self.upload_fileobj(source, Bucket, Key)
+
+    def upload_fileobj(self,
+                       Fileobj,
+                       Bucket: str,
+                       Key: str,
+                       ExtraArgs: dict = None) -> None:
+        target = self.__path(Bucket, Key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with target.open(mode="wb") as output:
+            shutil.copyfileobj(Fileobj, output, LocalS3Client.__COPY_SIZE)
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        path = self.__path(Bucket, Key)
+        try:
+            source = path.open(mode="rb")
+        except FileNotFoundError:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}},
+                              "GetObject") from None
+        return {
+            "Body": source,
+            "ContentLength": path.stat().st_size,
+            "Metadata": {}
+        }
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        try:
+            size = self.__path(Bucket, Key).stat().st_size
+        except FileNotFoundError:
+            raise ClientError({"Error": {"Code": "404"}},
+                              "HeadObject") from None
+        return {"ContentLength": size, "Metadata": {}}
+
+    def copy(self,
+             CopySource: dict,
+             Bucket: str,
+             Key: str,
+             ExtraArgs: dict = None) -> None:
+        target = self.__path(Bucket, Key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(self.__path(CopySource["Bucket"], CopySource["Key"]),
+                        target)
+
+    def delete_object(self, Bucket: str, Key: str) -> None:
+        self.__path(Bucket, Key).unlink(missing_ok=True)
+
+    def delete_objects(self, Bucket: str, Delete: dict) -> dict:
+        for entry in Delete["Objects"]:
+            self.delete_object(Bucket, entry["Key"])
+        return {}
+
+    def create_multipart_upload(self, Bucket: str, Key: str) -> dict:
+        self.__path(Bucket, Key)
+        upload_id = uuid.uuid4().hex
+        self.__uploads.joinpath(upload_id).mkdir(parents=True)
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str,
+                    PartNumber: int, Body: bytes) -> dict:
+        self.__path(Bucket, Key)
+        self.__uploads.joinpath(UploadId, str(PartNumber)).write_bytes(Body)
+        return {"ETag": LocalS3Client.__etag(UploadId, PartNumber)}
+
+    def list_parts(self,
+                   Bucket: str,
+                   Key: str,
+                   UploadId: str,
+                   PartNumberMarker: int = 0) -> dict:
+        self.__path(Bucket, Key)
+        parts = sorted((int(part.name), part.stat().st_size)
+                       for part in self.__uploads.joinpath(UploadId).iterdir())
+        return {
+            "Parts": [{
+                "PartNumber": number,
+                "ETag": LocalS3Client.__etag(UploadId, number),
+                "Size": size
+            } for (number, size) in parts if number > PartNumberMarker],
+            "IsTruncated": False
+        }
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str,
+                                  MultipartUpload: dict) -> None:
+        target = self.__path(Bucket, Key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        parts = self.__uploads.joinpath(UploadId)
+        with target.open(mode="wb") as output:
+            for part in MultipartUpload["Parts"]:
+                assert part["ETag"] == LocalS3Client.__etag(
+                    UploadId, part["PartNumber"])
+                with parts.joinpath(str(part["PartNumber"])).open(
+                        mode="rb") as source:
+                    shutil.copyfileobj(source, output,
+                                       LocalS3Client.__COPY_SIZE)
+        shutil.rmtree(parts)
+
+    def abort_multipart_upload(self, Bucket: str, Key: str,
+                               UploadId: str) -> None:
+        self.__path(Bucket, Key)
+        shutil.rmtree(self.__uploads.joinpath(UploadId), ignore_errors=True)
+
+    @staticmethod
+    def __etag(upload_id: str, number: int) -> str:
+        return f"{upload_id}-{number}"
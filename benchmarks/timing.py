@@ -0,0 +1,38 @@
+import time
+
+
+class Benchmark:
+    """
+    Times a benchmark and counts the items and bytes that it processed. The
+    result is added to a dictionary of results when the benchmark finishes.
+
+    Example
+    -------
+    with Benchmark(results, "hashing") as benchmark:
+        for path in paths:
+            benchmark.add(items=1, size=hash_file(path))
+    """
+    def __init__(self, results: dict, name: str):
+        self.__results = results
+        self.__name = name
+        self.__items = 0
+        self.__size = 0
+        self.__start = None
+
+    def add(self, items: int = 0, size: int = 0) -> None:
+        self.__items += items
+        self.__size += size
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        seconds = time.perf_counter() - self.__start
+        self.__results[self.__name] = {
+            "seconds": seconds,
+            "items": self.__items,
+            "bytes": self.__size,
+            "items_per_second": self.__items / seconds if seconds else None,
+            "bytes_per_second": self.__size / seconds if seconds else None
+        }
@@ -0,0 +1,78 @@
+import os
+from pathlib import Path
+
+"""
+Many tiny files, spread over a few levels of directories.
+"""
+TINY_FILES = "tiny-files"
+"""
+A few huge files.
+"""
+HUGE_FILES = "huge-files"
+"""
+Files in deeply nested directories.
+"""
+DEEP_NESTING = "deep-nesting"
+SHAPES = [TINY_FILES, HUGE_FILES, DEEP_NESTING]
+
+DEFAULT_FILE_SIZES = {
+    TINY_FILES: 128,
+    HUGE_FILES: 256 * 1024 * 1024,
+    DEEP_NESTING: 4096
+}
+
+__FILES_PER_DIRECTORY = 100
+__WRITE_SIZE = 1024 * 1024
+
+
+def create(root: Path,
+           shape: str,
+           files: int,
+           file_size: int = None,
+           depth: int = 8) -> None:
+    """
+    Creates a synthetic repository to benchmark with.
+
+    Parameters
+    ----------
+    root
+        The directory to create the repository in.
+
+    shape
+        One of `SHAPES`, which determines how the files are laid out.
+
+    files
+        The number of files to create.
+
+    file_size
+        The size of each file in bytes. Each shape has its own default.
+
+    depth
+        For `DEEP_NESTING`, how deeply the directories are nested.
+    """
+    if file_size is None:
+        file_size = DEFAULT_FILE_SIZES[shape]
+
+    for index in range(files):
+        path = root.joinpath(__directory(shape, index, depth), f"file{index}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        __write(path, file_size)
+
+
+def __directory(shape: str, index: int, depth: int) -> Path:
+    if shape == HUGE_FILES:
+        return Path(".")
+    elif shape == DEEP_NESTING:
+        levels = [f"level{level}" for level in range(depth)]
+        return Path(*levels, f"branch{index % __FILES_PER_DIRECTORY}")
+    group = index // __FILES_PER_DIRECTORY
+    return Path(f"group{group // __FILES_PER_DIRECTORY}", f"directory{group}")
+
+
+def __write(path: Path, size: int) -> None:
+    with path.open(mode="wb") as output:
+        remaining = size
+        while remaining > 0:
+            length = min(remaining, __WRITE_SIZE)
+            output.write(os.urandom(length))
+            remaining -= length
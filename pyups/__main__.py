@@ -1,19 +1,104 @@
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
+import sys
 import pyups.backups as backups
+from pyups import commands, plan
 from pyups.configuration import get_configuration
+from pyups.stats import RunStats
 
 logging.config.fileConfig('logging.ini')
 
+__COMMANDS = {
+    "restore": commands.restore_command,
+    "verify": commands.verify_command,
+    "watch": commands.watch_command
+}
+
+if len(sys.argv) > 1 and sys.argv[1] in __COMMANDS:
+    sys.exit(__COMMANDS[sys.argv[1]](sys.argv[2:]))
+
 parser = ArgumentParser(
-    prog="pyups", description="Back up a directory into an Amazon S3 bucket")
+    prog="pyups",
+    description="Back up a directory into an Amazon S3 bucket. Run "
+    "`pyups restore --help` to restore a backup, `pyups verify --help` to "
+    "check one, or `pyups watch --help` to keep backing up a directory as it "
+    "changes, instead.")
 parser.add_argument("directory", help="The path of the directory to backup.")
+parser.add_argument(
+    "--paranoid",
+    action="store_true",
+    help="Hash the contents of every file, even if its metadata is unchanged.")
+parser.add_argument("--hash-workers",
+                    type=int,
+                    default=1,
+                    help="The number of threads used to hash file contents.")
+parser.add_argument("--upload-workers",
+                    type=int,
+                    default=8,
+                    help="The number of files to upload concurrently.")
+parser.add_argument(
+    "--plan",
+    metavar="PLAN_FILE",
+    help="Write the changes that would be backed up to this file as JSON, "
+    "without backing them up.")
+parser.add_argument(
+    "--apply-plan",
+    metavar="PLAN_FILE",
+    help="Back up the changes in a plan written by --plan, without scanning "
+    "the directory again.")
+parser.add_argument(
+    "--bandwidth",
+    type=float,
+    default=plan.DEFAULT_BANDWIDTH / (1024 * 1024),
+    help="The upload bandwidth in MiB/s, used to estimate transfer times in a "
+    "plan.")
+parser.add_argument(
+    "--stats-file",
+    metavar="STATS_FILE",
+    help="Write the time spent in each phase and the number of files and bytes "
+    "processed to this file as JSON.")
+parser.add_argument(
+    "--prometheus-file",
+    metavar="PROM_FILE",
+    help="Write the same statistics as --stats-file to this file in the "
+    "Prometheus text format, e.g. for the textfile collector of node_exporter."
+)
 arguments = parser.parse_args()
 
 path = Path(arguments.directory)
-if path.exists() and path.is_dir():
-    logging.info(f"Backing up directory {arguments.directory}")
-    backups.backup(path, get_configuration(path))
-else:
-    print(f'Could {path} either does not exist or is not a directory.')
+stats = RunStats()
+try:
+    if not (path.exists() and path.is_dir()):
+        print(f'Could {path} either does not exist or is not a directory.')
+    elif arguments.plan:
+        logging.info(f"Planning backup of directory {arguments.directory}")
+        states = backups.open_states(path,
+                                     get_configuration(path),
+                                     paranoid=arguments.paranoid,
+                                     hash_workers=arguments.hash_workers,
+                                     stats=stats)
+        try:
+            backup_plan = plan.create_plan(states)
+        finally:
+            states.close()
+        bandwidth = int(arguments.bandwidth * 1024 * 1024)
+        backup_plan.write(Path(arguments.plan), bandwidth=bandwidth)
+        print(plan.format_summary(backup_plan.summary(bandwidth=bandwidth)))
+    else:
+        logging.info(f"Backing up directory {arguments.directory}")
+        backups.backup(path,
+                       get_configuration(path),
+                       paranoid=arguments.paranoid,
+                       hash_workers=arguments.hash_workers,
+                       upload_workers=arguments.upload_workers,
+                       plan_file=(Path(arguments.apply_plan)
+                                  if arguments.apply_plan else None),
+                       stats=stats)
+finally:
+    # The statistics are also written if the run fails, with whatever was
+    # recorded until then.
+    if arguments.stats_file:
+        stats.write_json(Path(arguments.stats_file))
+    if arguments.prometheus_file:
+        stats.write_prometheus(Path(arguments.prometheus_file))
@@ -1,104 +1,1087 @@
 import boto3
+from contextlib import contextmanager
+import io
+import json
 import logging
+import os
+from botocore.config import Config
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from pyups import encryption
-from pyups.configuration import Configuration
-from pyups.state.repository import StateRepository
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+from pyups import (chunking, compression, deletion, encryption, manifest,
+                   plan)
+from pyups.configuration import (Configuration, DATA_PATH,
+                                 LAYOUT_CONTENT_ADDRESSED)
+from pyups.journal import Journal
+from pyups.state import model
+from pyups.state.model import State
+from pyups.state.repository import Change, MOVED, StateRepository
+from pyups.stats import RunStats
 from botocore.exceptions import ClientError
+
 """
-When files from the repository are deleted, their backup copies in the S3
-bucket are also deleted. S3 allows each delete request to contain multiple
-items to delete. This value is the maximum number of items that each delete
-request should contain.
+Files at least this large, whose content is uploaded as it is (i.e. without
+compression or encryption), are uploaded in parts that are recorded in the
+journal. If the backup is interrupted, the next one only uploads the parts that
+are missing.
 """
-__DELETE_GROUP_SIZE = 500
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+MAXIMUM_PARTS = 10000
 
+"""
+The name of the file, in the data directory, that marks the manifest in the
+bucket as out of date because it could not be updated. The next backup then
+writes a new base for it.
+"""
+MANIFEST_STALE_NAME = "manifest.stale"
 
-def backup(repository_path: Path, configuration: Configuration) -> None:
+"""
+The name of the file, in the data directory, that lists the items whose changes
+were backed up without the manifest being updated with them (see `backup`).
+They are added to the manifest by its next update.
+"""
+MANIFEST_PENDING_NAME = "manifest.pending"
+
+
+class TornReadError(Exception):
+    """
+    Raised when a file changed while it was being uploaded, so that the object
+    may hold a mix of its old and new content. The change is not committed, so
+    the file is uploaded again by the next backup.
+    """
+
+
+class ManifestError(Exception):
+    """
+    Raised by `backup` when the changes were backed up, but the manifest could
+    not be updated with them. The manifest is written again, in full, by the
+    next backup.
+    """
+
+
+def open_states(repository_path: Path,
+                configuration: Configuration,
+                paranoid: bool = False,
+                hash_workers: int = 1,
+                stats: RunStats = None) -> StateRepository:
+    """
+    Opens the states of a repository, to look for the changes that a backup
+    with the given configuration backs up. Plans are created from the states
+    opened in the same way (see `pyups.plan`), so that they find the same
+    changes as the backup.
+
+    Parameters
+    ----------
+    paranoid, hash_workers, stats
+        As for `backup`.
+    """
+    return StateRepository(root_path=repository_path,
+                           paranoid=paranoid,
+                           hash_workers=hash_workers,
+                           stats=stats,
+                           hash_algorithm=configuration.hash_algorithm,
+                           ignore_patterns=configuration.ignore_patterns,
+                           excluded_items=configuration.excluded_items,
+                           skip_unchanged_directories=(
+                               configuration.skip_unchanged_directories))
+
+
+def backup(repository_path: Path,
+           configuration: Configuration,
+           paranoid: bool = False,
+           hash_workers: int = 1,
+           upload_workers: int = 8,
+           client=None,
+           plan_file: Path = None,
+           stats: RunStats = None,
+           paths: Iterable[Path] = None,
+           defer_manifest: bool = False) -> List[Path]:
     """
     Parameters
     ----------
     path
-        The file system path to the directory that will be backed up. This path 
+        The file system path to the directory that will be backed up. This path
         is expected to be an existing directory.
 
     configuration
         This provides a representation of the configuration for the backup (e.g.
         which Amazon S3 Bucket to upload backups to).
+
+    paranoid
+        If `True`, the contents of every file is hashed to look for changes,
+        even if the file's metadata indicates that it has not changed.
+
+    hash_workers
+        The number of threads used to hash the contents of files.
+
+    upload_workers
+        The number of files that are uploaded concurrently.
+
+    client
+        The S3 client to back up with. If not given, a client is created with a
+        connection pool large enough for all of the `upload_workers`.
+
+    plan_file
+        If given, the changes in this plan (see `pyups.plan`) are backed up,
+        instead of scanning the repository for changes.
+
+    stats
+        If given, the time spent in each phase of the backup and the number of
+        files and bytes processed are recorded in it.
+
+    paths
+        If given, only these paths (relative to `path`) are looked at for
+        changes, e.g. because they are known to have changed (see
+        `StateRepository.changes`).
+
+    defer_manifest
+        If `True`, the manifest is not updated with the changes. They are
+        recorded as pending instead, and added to the manifest by the next
+        backup that updates it or by `update_manifest`, e.g. so that frequent
+        small backups do not each write a segment of the manifest.
+
+    If an earlier backup was interrupted, the changes that it did not finish
+    are backed up first from its journal (see `pyups.journal`), before the
+    repository is scanned for other changes.
+
+    Returns
+    -------
+    The items whose changes could not be backed up. They are found again by
+    the next backup that looks at them.
+
+    Raises
+    ------
+    ManifestError
+        If the manifest could not be updated. The changes that were backed up
+        are committed nonetheless.
     """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(configuration.s3_bucket)
-    states = StateRepository(root_path=repository_path)
-
-    if configuration.encryption_password:
-        file_provider = lambda file: encryption.encrypted_file(
-            source=file, password=configuration.encryption_password)
-    else:
-        file_provider = lambda file: (file, lambda: None)
-
-    any_changes = False
-    to_delete = []
-    for c in states.changes():
-        any_changes = True
-        if (c.item_path.exists()):
-            if (not c.previous_state
-                ) or c.previous_state.hash != c.new_state.hash:
-                logging.info(f'Uploading item {c.item.as_posix()}.')
-                (to_upload, cleanup) = file_provider(c.item_path)
-                try:
-                    bucket.upload_file(to_upload.as_posix(),
-                                       f"content/{c.item.as_posix()}")
-                finally:
-                    cleanup()
+    if client is None:
+        client = boto3.client(
+            's3', config=Config(max_pool_connections=upload_workers))
+    states = open_states(repository_path,
+                         configuration,
+                         paranoid=paranoid,
+                         hash_workers=hash_workers,
+                         stats=stats)
+
+    journal = Journal(repository_path.joinpath(DATA_PATH))
+
+    try:
+        resumed = []
+        if journal.resuming:
+            resumed = journal.pending_changes(states)
+        if plan_file is not None:
+            changes = plan.read_plan(plan_file, states).changes
+        else:
+            changes = states.changes(defer_hash=__deferrable(configuration),
+                                     paths=paths)
+        return _BackupRun(repository_path=repository_path,
+                          configuration=configuration,
+                          client=client,
+                          states=states,
+                          journal=journal,
+                          upload_workers=upload_workers,
+                          defer_manifest=defer_manifest).run(changes, resumed)
+    finally:
+        journal.close()
+        states.close()
+
+
+def update_manifest(repository_path: Path,
+                    configuration: Configuration,
+                    client=None,
+                    stats: RunStats = None) -> None:
+    """
+    Updates the manifest with the changes of the backups that deferred it (see
+    `backup`), without backing anything up.
+
+    Raises
+    ------
+    ManifestError
+        If the manifest could not be updated.
+    """
+    if client is None:
+        client = boto3.client('s3')
+    states = open_states(repository_path, configuration, stats=stats)
+    try:
+        _BackupRun(repository_path=repository_path,
+                   configuration=configuration,
+                   client=client,
+                   states=states,
+                   journal=None,
+                   upload_workers=1).update_manifest()
+    finally:
+        states.close()
+
+
+def __deferrable(configuration: Configuration):
+    """
+    Returns
+    -------
+    Whether a file whose content changed can be hashed while it is uploaded,
+    given the result of `stat`-ing it (see `StateRepository.changes`), or `None`
+    if no file can. The content-addressed layout needs the hash for the key of
+    the object before the upload, and chunked files are hashed by chunk. Large
+    files are only hashed while they are uploaded if they are encrypted, since
+    otherwise they are uploaded in parts that can be resumed by their hash.
+    """
+    if configuration.layout == LAYOUT_CONTENT_ADDRESSED:
+        return None
+    threshold = configuration.chunk_threshold
+    encrypted = bool(configuration.encryption_password)
+    return lambda stats: (not chunking.splits(stats.st_size, threshold) and
+                          (encrypted or stats.st_size < MULTIPART_THRESHOLD))
+
+
+class _BackupRun:
+    """
+    Backs up the changes that are found in a repository during a single run of
+    `backup`.
+    """
+    def __init__(self,
+                 repository_path: Path,
+                 configuration: Configuration,
+                 client,
+                 states: StateRepository,
+                 journal: Journal,
+                 upload_workers: int,
+                 defer_manifest: bool = False):
+        self.__repository_path = repository_path
+        self.__configuration = configuration
+        self.__client = client
+        self.__bucket = configuration.s3_bucket
+        self.__states = states
+        self.__journal = journal
+        self.__upload_workers = upload_workers
+        self.__defer_manifest = defer_manifest
+        self.__stats = states.stats
+        self.__content_addressed = (
+            configuration.layout == LAYOUT_CONTENT_ADDRESSED)
+
+        # Uploads that have not completed yet, with the key of the object
+        # being uploaded and the changes that are waiting for it.
+        self.__uploads = {}
+        # The uploads in `__uploads`, by the key of the object being uploaded.
+        self.__uploading = {}
+        self.__failures = []
+        # Deleted items whose objects could not be deleted.
+        self.__failed_deletes = []
+        # Hashes of chunks that may no longer be referenced by any item.
+        self.__released_chunks = set()
+        # Previous hashes of items whose content changed, or is now stored
+        # under the hash of another algorithm.
+        self.__replaced = set()
+        # The entries of the manifest that were changed by this run.
+        self.__manifest_entries = []
+        # Why the manifest could not be updated, if it could not.
+        self.__manifest_error = None
+
+    def run(self,
+            changes: Iterable[Change],
+            resumed: Iterable[Change] = ()) -> List[Path]:
+        """
+        Backs up changes in the repository.
+
+        Parameters
+        ----------
+        changes
+            The changes to back up.
+
+        resumed
+            Changes left over by an interrupted backup. These are backed up
+            first, and committed before `changes` is iterated, so that they
+            are not found again.
+
+        Returns
+        -------
+        The items whose changes could not be backed up. The item that a change
+        was moved from is included as well.
+
+        Raises
+        ------
+        ManifestError
+            If the manifest could not be updated.
+        """
+        # The client retries failed requests itself, so the retries can only
+        # be counted through its events. The fake clients used in tests do
+        # not have any.
+        events = getattr(getattr(self.__client, "meta", None), "events", None)
+        if events is not None:
+            events.register("after-call.s3", self.__count_retries)
+        try:
+            with self.__stats.phase("total"):
+                self.__run(changes, resumed)
+        finally:
+            if events is not None:
+                events.unregister("after-call.s3", self.__count_retries)
+        failed = [c for (c, _) in self.__failures] + self.__failed_deletes
+        failed_items = [c.item for c in failed] + [
+            c.moved_from for c in failed if c.moved_from is not None
+        ]
+        # Their directories are listed again by the next backup, even if they
+        # have not changed, so that the items are found again.
+        for item in failed_items:
+            self.__states.forget_directory(item.parent)
+        self.__check_manifest()
+        return failed_items
+
+    def update_manifest(self) -> None:
+        """
+        Updates the manifest with the changes of the runs that deferred it.
+
+        Raises
+        ------
+        ManifestError
+            If the manifest could not be updated.
+        """
+        with self.__stats.phase("manifest"):
+            self.__update_manifest([])
+        self.__check_manifest()
+
+    def __check_manifest(self) -> None:
+        if self.__manifest_error is not None:
+            raise ManifestError(
+                f"Could not update the manifest: {self.__manifest_error}"
+            ) from self.__manifest_error
+
+    def __run(self, changes: Iterable[Change],
+              resumed: Iterable[Change]) -> None:
+        any_changes = False
+        to_delete = []
+        with ThreadPoolExecutor(
+                max_workers=self.__upload_workers) as executor:
+            for c in self.__resumed_first(resumed, changes):
+                any_changes = True
+                if c.kind == MOVED:
+                    self.__submit_move(executor, c)
+                elif c.new_state is not None and c.item_path.exists():
+                    if c.content_changed:
+                        self.__submit_upload(executor, c)
+                    elif self.__key(c.item, c.previous_state) != self.__key(
+                            c.item, c.new_state):
+                        self.__submit_rehash(executor, c)
+                    elif (c.previous_state.hash_algorithm !=
+                          c.new_state.hash_algorithm):
+                        # Only the manifest needs the new hash.
+                        self.__stats.count("uploads_skipped")
+                        self.__commit(c)
+                    else:
+                        logging.info(
+                            f'Content of item {c.item.as_posix()} has not changed, skipping upload.'
+                        )
+                        self.__stats.count("uploads_skipped")
+                        c.commit()
+                else:
+                    if c.new_state == None and c.previous_state != None:
+                        logging.info(
+                            f'Item {c.item.as_posix()} is no longer in filesystem. It will be deleted.'
+                        )
+                        self.__release_chunks(c.item)
+                        to_delete.append(c)
+
+            while self.__uploads:
+                self.__complete_uploads()
+
+        with self.__stats.phase("delete"):
+            if self.__content_addressed:
+                self.__delete_unreferenced(to_delete)
+                self.__delete_replaced_objects()
             else:
-                logging.info(
-                    f'Content of item {c.item.as_posix()} has not changed, skipping upload.'
+                to_delete = self.__delete_items(to_delete)
+            self.__delete_released_chunks()
+        with self.__stats.phase("manifest"):
+            self.__update_manifest(to_delete)
+        # The committed changes must be written before the journal, which
+        # would otherwise be needed to resume them, is removed.
+        self.__states.state_store.flush()
+        self.__journal.finish(abort=self.__abort_upload)
+
+        logging.info(
+            f'Skipped hashing {self.__states.skipped} items with unchanged metadata.'
+        )
+
+        if self.__failures:
+            print(f"{len(self.__failures)} item(s) could not be uploaded:")
+            for (c, error) in self.__failures:
+                print(f"  {c.item.as_posix()}: {error}")
+
+        if any_changes == False:
+            if self.__has_content():
+                print("No changes was detected.")
+            else:
+                print(
+                    f"Directory '{self.__repository_path}' contains no files to back up."
                 )
-            c.commit()
+
+    def __resumed_first(self, resumed: Iterable[Change],
+                        changes: Iterable[Change]) -> Iterator[Change]:
+        yield from resumed
+        while self.__uploads:
+            self.__complete_uploads()
+        yield from changes
+
+    def __key(self, item: Path, state: State) -> str:
+        """
+        Returns
+        -------
+        The key of the object that stores the content of an item in the bucket.
+        """
+        if self.__content_addressed:
+            return f"objects/{state.content_hash}"
+        return f"content/{item.as_posix()}"
+
+    def __submit_upload(self, executor: ThreadPoolExecutor,
+                        change: Change) -> None:
+        """
+        Starts uploading the content of a changed item, unless the object it
+        would be uploaded to is already stored or being uploaded. At most two
+        uploads per worker are queued, so the scan does not get too far ahead
+        of the uploads.
+        """
+        key = self.__key(change.item, change.new_state)
+        if key in self.__uploading:
+            logging.info(
+                f'Content of item {change.item.as_posix()} is already being uploaded.'
+            )
+            self.__stats.count("uploads_skipped")
+            self.__uploads[self.__uploading[key]][1].append(change)
+        elif self.__content_addressed and self.__states.state_store.has_object(
+                key):
+            logging.info(
+                f'Content of item {change.item.as_posix()} is already stored, skipping upload.'
+            )
+            self.__stats.count("uploads_skipped")
+            store = self.__states.state_store
+            duplicate = store.find_item(change.new_state.content_hash)
+            self.__commit(
+                change,
+                store.get_chunks(duplicate) if duplicate is not None else [])
+        else:
+            logging.info(f'Uploading item {change.item.as_posix()}.')
+            self.__journal.record_change(change)
+            self.__track(
+                executor.submit(self.__upload, change.item_path, key,
+                                change.new_state), key, change)
+
+    def __submit_move(self, executor: ThreadPoolExecutor,
+                      change: Change) -> None:
+        """
+        Moves the stored content of an item that was moved (or renamed) with a
+        copy in the bucket, so the content does not have to be uploaded again.
+        With the content-addressed layout, the object is shared by both paths
+        so only the state needs to be committed.
+        """
+        source = self.__key(change.moved_from, change.previous_state)
+        key = self.__key(change.item, change.new_state)
+        if source == key:
+            logging.info(
+                f'Item {change.moved_from.as_posix()} was moved to {change.item.as_posix()}.'
+            )
+            self.__commit(change)
+        else:
+            logging.info(
+                f'Moving item {change.moved_from.as_posix()} to {change.item.as_posix()}.'
+            )
+            self.__journal.record_change(change)
+            self.__track(executor.submit(self.__move, source, key), key,
+                         change)
+
+    def __submit_rehash(self, executor: ThreadPoolExecutor,
+                        change: Change) -> None:
+        """
+        Copies the stored content of an item whose content did not change, but
+        was hashed with another algorithm, to the key of its new hash. This
+        only happens with the content-addressed layout. The object under the
+        previous hash is deleted once no item refers to it any more.
+        """
+        source = self.__key(change.item, change.previous_state)
+        key = self.__key(change.item, change.new_state)
+        if key in self.__uploading:
+            self.__uploads[self.__uploading[key]][1].append(change)
+        elif self.__states.state_store.has_object(key):
+            self.__commit(change)
+        else:
+            logging.info(
+                f'Copying content of item {change.item.as_posix()} to its new hash.'
+            )
+            self.__journal.record_change(change)
+            self.__track(
+                executor.submit(self.__move, source, key, remove_source=False),
+                key, change)
+
+    def __track(self, future: Future, key: str, change: Change) -> None:
+        """
+        Keeps track of an upload (or copy) of an object for a change, so that
+        the change can be committed once the upload succeeds.
+        """
+        self.__uploads[future] = (key, [change])
+        self.__uploading[key] = future
+        if len(self.__uploads) >= self.__upload_workers * 2:
+            self.__complete_uploads()
+
+    def __complete_uploads(self) -> None:
+        """
+        Waits for at least one upload to complete and commits the changes whose
+        uploads succeeded. The ones that failed are added to `__failures`,
+        together with their error.
+        """
+        (done, _) = wait(self.__uploads, return_when=FIRST_COMPLETED)
+        for future in done:
+            (key, changes) = self.__uploads.pop(future)
+            del self.__uploading[key]
+            error = future.exception()
+            if error is None:
+                result = future.result()
+                for c in changes:
+                    if result is None:
+                        self.__commit(c)
+                        continue
+                    (state, chunk_list) = result
+                    if c.new_state.content_hash is None:
+                        c = c.with_new_state(state)
+                    self.__commit(c, chunk_list)
+            else:
+                for c in changes:
+                    logging.error(
+                        f'Could not upload {c.item.as_posix()}: {error}')
+                    self.__failures.append((c, error))
+                    self.__stats.count("uploads_failed")
+
+    def __commit(self, change: Change, chunk_list: list = None) -> None:
+        """
+        Commits a change whose content is stored in the bucket, together with
+        the chunks that its content was split into.
+
+        Parameters
+        ----------
+        chunk_list
+            The hash and size of each chunk of the item's new content, or
+            `None` if its content was not split into chunks. This is ignored
+            for moved items, which keep the chunks of the item they were moved
+            from.
+        """
+        store = self.__states.state_store
+        if change.moved_from is not None:
+            store.store_chunks(change.item, store.get_chunks(change.moved_from))
+            self.__manifest_entries.append((change.moved_from, None, None))
+        elif change.content_changed:
+            self.__release_chunks(change.item)
+            store.store_chunks(change.item, chunk_list or [])
+            if self.__content_addressed and change.previous_state is not None:
+                self.__replaced.add(change.previous_state.content_hash)
+        elif self.__content_addressed:
+            # The content was only hashed with another algorithm, so it keeps
+            # its chunks.
+            self.__replaced.add(change.previous_state.content_hash)
+        change.commit()
+        self.__manifest_entries.append(
+            (change.item, change.new_state,
+             self.__key(change.item, change.new_state)))
+
+    def __release_chunks(self, item: Path) -> None:
+        self.__released_chunks.update(
+            chunk_hash
+            for (chunk_hash, _) in self.__states.state_store.get_chunks(item))
+
+    @contextmanager
+    def __stored_content(self,
+                         source: BinaryIO,
+                         codec: str = None) -> Iterator[BinaryIO]:
+        """
+        Provides the content that will be stored in the bucket for the content
+        of `source` (e.g. the encrypted content). If a `codec` is given, the
+        content is compressed before it is encrypted.
+        """
+        if codec is not None:
+            with compression.compressed_stream(
+                    source=source,
+                    codec=codec,
+                    level=self.__configuration.compression_level
+            ) as compressed:
+                with self.__stored_content(compressed) as content:
+                    yield content
+        elif self.__configuration.encryption_password:
+            with encryption.encrypted_stream(
+                    source=source,
+                    password=self.__configuration.encryption_password
+            ) as encrypted:
+                yield encrypted
         else:
-            if c.new_state == None and c.previous_state != None:
+            yield source
+
+    def __upload(self, path: Path, key: str,
+                 state: State) -> Tuple[State, list]:
+        """
+        Uploads the content of a file, whose state is `state`, to an object.
+        If the state has no hash yet (see `StateRepository.changes`), the
+        content is hashed as it is uploaded, so that the file is only read
+        once.
+
+        Returns
+        -------
+        The state of the file, with the hash of its content. Also, if the file
+        was split into chunks, the hash and size of each of them. Otherwise,
+        `None`.
+
+        Raises
+        ------
+        TornReadError
+            If the file changed since its state was found, or while it was
+            being uploaded.
+        """
+        self.__stats.count("files_uploaded")
+        threshold = self.__configuration.chunk_threshold
+        with path.open(mode="rb") as source:
+            before = os.fstat(source.fileno())
+            size = before.st_size
+            self.__stats.count("bytes_uploaded", size)
+            chunk_list = None
+            if (chunking.splits(size, threshold)
+                    and state.content_hash is not None):
+                chunk_list = self.__upload_chunks(source, path, key)
+            else:
+                sample = source.read(compression.SAMPLE_SIZE)
+                source.seek(0)
+                codec = self.__codec(path, sample)
+                if state.content_hash is None:
+                    state = self.__put_hashed(source, key, state, codec)
+                # Encrypted content is different every time it is produced,
+                # and the parts of compressed content cannot be found without
+                # compressing everything before them. Such content is
+                # therefore always uploaded from the start.
+                elif (size >= MULTIPART_THRESHOLD and codec is None
+                      and not self.__configuration.encryption_password):
+                    self.__put_parts(source, key, state.content_hash, size)
+                else:
+                    self.__put(source, key, codec=codec)
+        self.__check_unchanged(path, state, before)
+        return (state, chunk_list)
+
+    def __put_hashed(self, source: BinaryIO, key: str, state: State,
+                     codec: str) -> State:
+        """
+        Uploads content to an object, while hashing it with the algorithm of
+        `state`.
+
+        Returns
+        -------
+        The state, with the hash of the content.
+        """
+        hashing = _HashingReader(source, model.hasher(state.hash_algorithm))
+        self.__put(hashing, key, codec=codec)
+        self.__stats.count("files_hashed")
+        self.__stats.count("bytes_hashed", hashing.size)
+        return State(size=state.size,
+                     content_hash=hashing.hexdigest(),
+                     mtime_ns=state.mtime_ns,
+                     inode=state.inode,
+                     device=state.device,
+                     hash_algorithm=state.hash_algorithm)
+
+    def __check_unchanged(self, path: Path, state: State,
+                          before: os.stat_result) -> None:
+        """
+        Checks that a file that was uploaded still has the metadata it had when
+        it was opened (`before`), and that it had the metadata of its `state`
+        then. Otherwise, what was uploaded may be a mix of old and new content,
+        or may not be the content that was hashed.
+        """
+        try:
+            after = os.stat(path)
+        except FileNotFoundError:
+            after = None
+        metadata = (before.st_size, before.st_mtime_ns, before.st_ino)
+        if (after is None
+                or metadata != (after.st_size, after.st_mtime_ns,
+                                after.st_ino) or before.st_size != state.size
+                or state.mtime_ns not in (None, before.st_mtime_ns)
+                or state.inode not in (None, before.st_ino)):
+            self.__stats.count("uploads_torn")
+            raise TornReadError(
+                f"{path} changed while it was being backed up")
+
+    def __upload_chunks(self, source: BinaryIO, path: Path, key: str) -> list:
+        """
+        Splits the content of a file into chunks and uploads the chunks that are
+        not already stored in the bucket under `chunks/`. The object for the
+        file itself only contains the recipe for putting the chunks back
+        together.
+        """
+        store = self.__states.state_store
+        chunk_list = []
+        size = 0
+        for chunk in chunking.chunks(source, self.__configuration.chunk_size):
+            chunk_hash = chunking.chunk_hash(chunk)
+            chunk_key = f"chunks/{chunk_hash}"
+            if not store.has_object(chunk_key):
+                self.__put(io.BytesIO(chunk),
+                           chunk_key,
+                           codec=self.__codec(
+                               path, chunk[:compression.SAMPLE_SIZE]))
+                self.__stats.count("chunks_uploaded")
+            else:
+                self.__stats.count("chunks_deduplicated")
+            chunk_list.append((chunk_hash, len(chunk)))
+            size += len(chunk)
+
+        logging.debug(f'Split {path} into {len(chunk_list)} chunks.')
+        recipe = json.dumps(chunking.recipe(size, chunk_list))
+        self.__put(io.BytesIO(bytes(recipe, "utf-8")),
+                   key,
+                   metadata={chunking.FORMAT_METADATA: chunking.RECIPE_FORMAT})
+        return chunk_list
+
+    def __codec(self, path: Path, sample: bytes) -> str:
+        """
+        Returns
+        -------
+        The codec to compress the content of a file with, or `None` if it
+        should not be compressed.
+        """
+        codec = self.__configuration.compression_codec
+        if codec is not None and compression.should_compress(
+                path, sample, codec, self.__configuration.compression_level):
+            return codec
+        return None
+
+    def __put(self,
+              source: BinaryIO,
+              key: str,
+              metadata: dict = None,
+              codec: str = None) -> None:
+        """
+        Uploads content to an object. If a `codec` is given, the content is
+        compressed and the codec is recorded in the object's metadata. The
+        content is compressed and encrypted while it is uploaded, so that time
+        is part of the upload's time. Once uploaded, the object is recorded in
+        the store with its size in the bucket.
+        """
+        metadata = dict(metadata or {})
+        if codec is not None:
+            metadata[compression.CODEC_METADATA] = codec
+        extra_args = {'Metadata': metadata} if metadata else None
+        with self.__stats.phase("upload", histogram="upload_seconds"):
+            with self.__stored_content(source, codec) as content:
+                counting = _CountingReader(content)
+                self.__client.upload_fileobj(Fileobj=counting,
+                                             Bucket=self.__bucket,
+                                             Key=key,
+                                             ExtraArgs=extra_args)
+        self.__states.state_store.store_object(key, counting.size)
+
+    def __put_parts(self, source: BinaryIO, key: str, content_hash: str,
+                    size: int) -> None:
+        """
+        Uploads content to an object with a multipart upload, which is recorded
+        in the journal. If the journal has an open upload of the same content
+        to the object, the parts that were already uploaded are skipped.
+        """
+        part_size = max(PART_SIZE, -(-size // MAXIMUM_PARTS))
+        part_count = max(1, -(-size // part_size))
+        parts = {}
+        upload = self.__journal.open_upload(key, content_hash)
+        if upload is not None and upload["part_size"] == part_size:
+            upload_id = upload["upload_id"]
+            try:
+                parts = self.__uploaded_parts(key, upload_id, part_size, size)
                 logging.info(
-                    f'Item {c.item.as_posix()} is no longer in filesystem. It will be deleted.'
+                    f'Resuming upload of {key} with {len(parts)} of {part_count} parts.'
                 )
-                to_delete.append(c)
-
-    delete_groups = [
-        to_delete[i:min(i + __DELETE_GROUP_SIZE, len(to_delete))]
-        for i in range(0, len(to_delete), __DELETE_GROUP_SIZE)
-    ]
-
-    for sublist in delete_groups:
-        keys = [{'Key': f"content/{c.item.as_posix()}"} for c in sublist]
-        response = bucket.delete_objects(Delete={
-            'Objects': keys,
-            'Quiet': True
-        })
-
-        failed = []
-        if 'Errors' in response:
-            # List of objects or items that failed to be deleted. Documentation says
-            # the list should contain only the things that encountered an error while
-            # deleting.
-            failed = [o['Key'] for o in response['Errors']]
+            except ClientError as error:
+                logging.info(f'Could not resume upload of {key}: {error}')
+                upload = None
+        else:
+            upload = None
+
+        if upload is None:
+            upload_id = self.__client.create_multipart_upload(
+                Bucket=self.__bucket, Key=key)['UploadId']
+            self.__journal.record_upload(key, content_hash, upload_id,
+                                         part_size)
+
+        with self.__stats.phase("upload", histogram="upload_seconds"):
+            for number in range(1, part_count + 1):
+                if number in parts:
+                    self.__stats.count("parts_resumed")
+                    continue
+                source.seek((number - 1) * part_size)
+                response = self.__client.upload_part(Bucket=self.__bucket,
+                                                     Key=key,
+                                                     UploadId=upload_id,
+                                                     PartNumber=number,
+                                                     Body=source.read(part_size))
+                parts[number] = response['ETag']
+
+            self.__client.complete_multipart_upload(
+                Bucket=self.__bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={
+                    'Parts': [{
+                        'ETag': parts[number],
+                        'PartNumber': number
+                    } for number in sorted(parts)]
+                })
+        self.__journal.record_completed(key)
+        self.__states.state_store.store_object(key, size)
+
+    def __uploaded_parts(self, key: str, upload_id: str, part_size: int,
+                         size: int) -> dict:
+        """
+        Lists the parts of a multipart upload that were uploaded completely.
+
+        Returns
+        -------
+        The ETag of each part, by its number.
+        """
+        parts = {}
+        marker = 0
+        while True:
+            response = self.__client.list_parts(Bucket=self.__bucket,
+                                                Key=key,
+                                                UploadId=upload_id,
+                                                PartNumberMarker=marker)
+            for part in response.get('Parts', []):
+                number = part['PartNumber']
+                expected = min(part_size, size - (number - 1) * part_size)
+                if part['Size'] == expected:
+                    parts[number] = part['ETag']
+            if not response.get('IsTruncated'):
+                return parts
+            marker = response['NextPartNumberMarker']
+
+    def __abort_upload(self, key: str, upload_id: str) -> None:
+        logging.info(f'Aborting upload of {key} left by an earlier backup.')
+        self.__client.abort_multipart_upload(Bucket=self.__bucket,
+                                             Key=key,
+                                             UploadId=upload_id)
+
+    def __move(self, source: str, key: str, remove_source: bool = True) -> None:
+        """
+        Copies an object within the bucket and, unless `remove_source` is
+        `False`, deletes the original.
+        """
+        # The managed copy uses multipart copies for objects too large for a
+        # single CopyObject request, which do not carry over the metadata of
+        # the source (e.g. its codec), so it is copied explicitly.
+        copy_source = {'Bucket': self.__bucket, 'Key': source}
+        store = self.__states.state_store
+        with self.__stats.phase("move", histogram="move_seconds"):
+            head = self.__client.head_object(Bucket=self.__bucket, Key=source)
+            self.__client.copy(CopySource=copy_source,
+                               Bucket=self.__bucket,
+                               Key=key,
+                               ExtraArgs={
+                                   'Metadata': head['Metadata'],
+                                   'MetadataDirective': 'REPLACE'
+                               })
+            if remove_source:
+                self.__client.delete_object(Bucket=self.__bucket, Key=source)
+        store.store_object(key, store.object_size(source))
+        if remove_source:
+            store.remove_objects([source])
+        self.__stats.count("objects_moved")
 
+    def __delete_items(self, to_delete: list) -> list:
+        """
+        Deletes the objects of deleted items, and removes the items whose
+        objects were deleted from the store. Items whose objects could not be
+        deleted are left in the store, so that they are deleted again by the
+        next backup.
+
+        Returns
+        -------
+        The changes of the items that were deleted.
+        """
+        changes = {self.__key(c.item, c.previous_state): c for c in to_delete}
+        failed = self.__delete_objects(list(changes))
+        deleted = [c for (key, c) in changes.items() if key not in failed]
+        for c in deleted:
+            c.commit()
+        self.__failed_deletes = [
+            c for (key, c) in changes.items() if key in failed
+        ]
+        return deleted
+
+    def __delete_unreferenced(self, to_delete: list) -> None:
+        """
+        Removes deleted items from the store, then deletes the objects that are
+        no longer referenced by any item that is still stored.
+        """
         for c in to_delete:
-            if any(m for m in failed if m == c.item.as_posix()):
-                # This means we could not delete the item.
-                logging.warn(f'Could not delete {c.item.as_posix()}')
-            else:
-                c.commit()
+            c.commit()
+
+        store = self.__states.state_store
+        self.__delete_objects(
+            sorted({
+                self.__key(c.item, c.previous_state)
+                for c in to_delete
+                if not store.is_referenced(c.previous_state.content_hash)
+            }))
+
+    def __delete_replaced_objects(self) -> None:
+        """
+        Deletes the objects stored under hashes that no stored item has any
+        more, because their content changed or is now stored under a hash of
+        another algorithm. The object of a chunked item is its recipe, so this
+        deletes the recipes of its previous content as well.
+        """
+        store = self.__states.state_store
+        self.__delete_objects(
+            sorted(f"objects/{content_hash}"
+                   for content_hash in self.__replaced
+                   if not store.is_referenced(content_hash)))
+        self.__replaced.clear()
+
+    def __delete_released_chunks(self) -> None:
+        """
+        Deletes the chunks that are no longer referenced by any stored item.
+        """
+        store = self.__states.state_store
+        self.__delete_objects(
+            sorted(f"chunks/{chunk_hash}"
+                   for chunk_hash in self.__released_chunks
+                   if not store.is_chunk_referenced(chunk_hash)))
+        self.__released_chunks.clear()
 
-    if any_changes == False:
-        if __has_content(states):
-            print("No changes was detected.")
+    def __delete_objects(self, keys: list) -> set:
+        """
+        Deletes objects that are no longer needed from the bucket (see
+        `pyups.deletion`) and removes them from the index of stored objects.
+
+        Returns
+        -------
+        The keys of the objects that could not be deleted.
+        """
+        failed = deletion.delete_objects(self.__client,
+                                         self.__bucket,
+                                         keys,
+                                         workers=self.__upload_workers,
+                                         stats=self.__stats)
+        self.__states.state_store.remove_objects(
+            [key for key in keys if key not in failed])
+        return set(failed)
+
+    def __update_manifest(self, to_delete: list) -> None:
+        """
+        Adds the items that were backed up or deleted by this run, and the
+        pending items of earlier runs that deferred it, to the manifest in the
+        bucket (see `pyups.manifest`). If the manifest cannot be updated, it is
+        marked as out of date so that the next backup writes all of it again.
+        If this run defers the manifest, its items are only recorded as
+        pending.
+        """
+        store = self.__states.state_store
+        self.__manifest_entries.extend((c.item, None, None) for c in to_delete
+                                       if store.get_state(c.item) is None)
+        data_path = self.__repository_path.joinpath(DATA_PATH)
+        pending_file = data_path.joinpath(MANIFEST_PENDING_NAME)
+        if self.__defer_manifest:
+            if self.__manifest_entries:
+                data_path.mkdir(parents=True, exist_ok=True)
+                with pending_file.open(mode="a", encoding="utf-8") as pending:
+                    pending.writelines(
+                        json.dumps(item.as_posix()) + "\n"
+                        for (item, _, _) in self.__manifest_entries)
+            return
+
+        stale_marker = data_path.joinpath(MANIFEST_STALE_NAME)
+        pending = self.__pending_entries(pending_file)
+        remote = manifest.RemoteManifest(
+            client=self.__client,
+            bucket=self.__bucket,
+            encryption_password=self.__configuration.encryption_password)
+        try:
+            remote.update(changed=(pending or []) + self.__manifest_entries,
+                          all_entries=((item, state, self.__key(item, state))
+                                       for (item,
+                                            state) in store.stored_states()),
+                          rebase=stale_marker.exists() or pending is None)
+        except Exception as error:
+            logging.error(f'Could not update the manifest: {error}')
+            self.__stats.count("manifest_failures")
+            self.__manifest_error = error
+            stale_marker.parent.mkdir(parents=True, exist_ok=True)
+            stale_marker.touch()
         else:
-            print(
-                f"Directory '{repository_path}' contains no files to back up.")
+            if stale_marker.exists():
+                stale_marker.unlink()
+            if pending_file.exists():
+                pending_file.unlink()
 
+    def __pending_entries(self, pending_file: Path) -> list:
+        """
+        Returns
+        -------
+        The entries of the manifest for the items that are pending (see
+        `MANIFEST_PENDING_NAME`), with their current states. `None` is returned
+        if the file cannot be read (e.g. because a backup was interrupted while
+        writing it), in which case all of the manifest must be written again.
+        """
+        try:
+            with pending_file.open(encoding="utf-8") as pending:
+                items = dict.fromkeys(
+                    Path(json.loads(line)) for line in pending)
+        except FileNotFoundError:
+            return []
+        except ValueError as error:
+            logging.warning(f'Could not read {pending_file}: {error}')
+            return None
+        store = self.__states.state_store
+        entries = []
+        for item in items:
+            state = store.get_state(item)
+            entries.append((item, state, None if state is None else
+                            self.__key(item, state)))
+        return entries
 
-def __has_content(states: StateRepository) -> bool:
-    try:
-        next(states.content_paths())
-        return True
-    except StopIteration:
-        return False
+    def __count_retries(self, parsed: dict = None, **kwargs) -> None:
+        """
+        Counts the requests that botocore had to retry. It is called after each
+        call made by the client.
+        """
+        retries = (parsed or {}).get('ResponseMetadata',
+                                     {}).get('RetryAttempts', 0)
+        if retries:
+            self.__stats.count("retries", retries)
+
+    def __has_content(self) -> bool:
+        try:
+            next(self.__states.content_paths())
+            return True
+        except StopIteration:
+            return False
+
+
+class _CountingReader:
+    """
+    Reads from a stream, counting the number of bytes that were read.
+    """
+    def __init__(self, source: BinaryIO):
+        self.__source = source
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        content = self.__source.read(size)
+        self.size += len(content)
+        return content
+
+
+class _HashingReader:
+    """
+    Reads from a stream, hashing the content that was read.
+    """
+    def __init__(self, source: BinaryIO, calculator):
+        self.__source = source
+        self.__calculator = calculator
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        content = self.__source.read(size)
+        self.__calculator.update(content)
+        self.size += len(content)
+        return content
+
+    def hexdigest(self) -> str:
+        return self.__calculator.hexdigest()
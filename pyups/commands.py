@@ -0,0 +1,149 @@
+"""
+The subcommands of `pyups`, other than backing up a directory (which is what
+`pyups DIRECTORY` does). Each is run as `pyups COMMAND ...`.
+"""
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+from typing import List
+from pyups import restore, verify, watch
+from pyups.configuration import get_configuration, read_configuration
+
+
+def restore_command(argv: List[str]) -> int:
+    """
+    Restores a backup into a directory.
+
+    Returns
+    -------
+    The exit status: 0 if every item was restored, 1 otherwise.
+    """
+    parser = ArgumentParser(
+        prog="pyups restore",
+        description="Restore a backup from an Amazon S3 bucket")
+    parser.add_argument(
+        "directory",
+        help="The directory to restore into. Its .pyups/config is used, "
+        "unless --config is given.")
+    parser.add_argument(
+        "--config",
+        metavar="CONFIG_FILE",
+        help="The configuration file of the backup to restore, e.g. a copy of "
+        "the .pyups/config of the directory that was backed up.")
+    parser.add_argument(
+        "--include",
+        metavar="PATTERN",
+        action="append",
+        default=[],
+        help="Only restore the items under this directory, or that match this "
+        "glob. May be given several times.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=16,
+                        help="The number of items to download concurrently.")
+    arguments = parser.parse_args(argv)
+
+    destination = Path(arguments.directory)
+    if arguments.config:
+        configuration = read_configuration(Path(arguments.config))
+    else:
+        configuration = get_configuration(destination)
+
+    logging.info(f"Restoring into directory {destination}")
+    failures = restore.restore(destination,
+                               configuration,
+                               patterns=arguments.include,
+                               workers=arguments.workers)
+    if failures:
+        print(f"{len(failures)} item(s) could not be restored:")
+        for (item, error) in failures:
+            print(f"  {item.as_posix()}: {error}")
+        return 1
+    return 0
+
+
+def verify_command(argv: List[str]) -> int:
+    """
+    Verifies that the backup of a directory is complete.
+
+    Returns
+    -------
+    The exit status: 0 if every object that is needed is in the bucket as
+    expected, 1 otherwise.
+    """
+    parser = ArgumentParser(
+        prog="pyups verify",
+        description="Check that the objects backed up from a directory are in "
+        "its Amazon S3 bucket, without downloading them")
+    parser.add_argument("directory",
+                        help="The directory whose backup is verified.")
+    parser.add_argument(
+        "--sample",
+        type=int,
+        default=0,
+        metavar="COUNT",
+        help="Also check part of the content of this many objects, picked at "
+        "random.")
+    arguments = parser.parse_args(argv)
+
+    path = Path(arguments.directory)
+    logging.info(f"Verifying backup of directory {path}")
+    report = verify.verify(path, get_configuration(path), sample=arguments.sample)
+    print(verify.format_report(report))
+    return 0 if report.ok else 1
+
+
+def watch_command(argv: List[str]) -> int:
+    """
+    Backs up a directory, and then keeps backing up the paths in it that
+    change, until interrupted.
+
+    Returns
+    -------
+    The exit status, which is 0 once interrupted.
+    """
+    parser = ArgumentParser(
+        prog="pyups watch",
+        description="Back up a directory into an Amazon S3 bucket, and keep "
+        "backing up its files as they change")
+    parser.add_argument("directory", help="The path of the directory to watch.")
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=watch.DEBOUNCE_DELAY,
+        metavar="SECONDS",
+        help="Back up changed files once nothing has changed for this long.")
+    parser.add_argument(
+        "--polling",
+        action="store_true",
+        help="Look for changes by walking the directory periodically, instead "
+        "of with inotify.")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=watch.POLL_INTERVAL,
+        metavar="SECONDS",
+        help="How often to walk the directory, if inotify is not used.")
+    parser.add_argument("--hash-workers",
+                        type=int,
+                        default=1,
+                        help="The number of threads used to hash file contents.")
+    parser.add_argument("--upload-workers",
+                        type=int,
+                        default=8,
+                        help="The number of files to upload concurrently.")
+    arguments = parser.parse_args(argv)
+
+    path = Path(arguments.directory)
+    logging.info(f"Watching directory {path}")
+    try:
+        watch.watch(path,
+                    get_configuration(path),
+                    debounce=arguments.debounce,
+                    poll_interval=arguments.poll_interval,
+                    polling=arguments.polling,
+                    hash_workers=arguments.hash_workers,
+                    upload_workers=arguments.upload_workers)
+    except KeyboardInterrupt:
+        logging.info(f"Stopped watching directory {path}")
+    return 0
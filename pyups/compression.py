@@ -0,0 +1,227 @@
+"""
+Compresses content before it is encrypted and uploaded. The codec used for an
+object is recorded in its metadata, so that it can be decompressed again.
+
+Content is compressed with `gzip` from the standard library or, if the
+`zstandard` package is installed, with `zstd`.
+"""
+from contextlib import contextmanager
+import io
+import logging
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+CODECS = [GZIP, ZSTD]
+
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+
+"""
+The bytes that content compressed with each codec starts with.
+"""
+MAGIC_NUMBERS = {GZIP: b"\x1f\x8b", ZSTD: b"\x28\xb5\x2f\xfd"}
+
+"""
+The name of the metadata that records the codec an object was compressed with.
+"""
+CODEC_METADATA = "pyups-codec"
+
+"""
+Files with these extensions are already compressed, so compressing them again
+would only waste time.
+"""
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".aac", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz",
+    ".heic", ".jar", ".jpeg", ".jpg", ".lz4", ".lzma", ".m4a", ".mkv", ".mov",
+    ".mp3", ".mp4", ".odt", ".ogg", ".png", ".pptx", ".rar", ".tgz", ".webm",
+    ".webp", ".xlsx", ".xz", ".zip", ".zst"
+}
+
+"""
+The amount of content that is compressed to estimate how well the rest of the
+content would compress.
+"""
+SAMPLE_SIZE = 64 * 1024
+
+"""
+Content is only compressed if the sample compresses to at most this fraction
+of its original size.
+"""
+MAXIMUM_RATIO = 0.9
+
+"""
+Content smaller than this is not worth compressing.
+"""
+MINIMUM_SIZE = 512
+
+BUFFER_SIZE = 65536 * 8
+
+
+def check_codec(codec: str) -> None:
+    """
+    Checks that content can be compressed with a codec.
+
+    Raises
+    ------
+    ValueError
+        If the codec is unknown or the package that it needs is not installed.
+    """
+    if codec not in CODECS:
+        raise ValueError(
+            f"Unknown compression codec '{codec}'. Expected one of: "
+            f"{', '.join(CODECS)}")
+    if codec == ZSTD and zstandard is None:
+        raise ValueError(
+            "The zstandard package must be installed to use zstd compression")
+
+
+def should_compress(path: Path, sample: bytes, codec: str,
+                    level: int) -> bool:
+    """
+    Decides whether content is worth compressing, based on the file's
+    extension and on how well a sample of the content compresses.
+
+    Parameters
+    ----------
+    path
+        The path of the file that the content is from.
+
+    sample
+        The first `SAMPLE_SIZE` bytes of the content (or all of the content,
+        if it is smaller).
+
+    codec
+        The codec that the content would be compressed with.
+
+    level
+        The compression level that the content would be compressed with.
+    """
+    if path.suffix.lower() in COMPRESSED_EXTENSIONS:
+        logging.debug(f"{path} is already compressed.")
+        return False
+    if len(sample) < MINIMUM_SIZE:
+        return False
+
+    compressed = __compressor(codec, level)
+    size = len(compressed.compress(sample)) + len(compressed.flush())
+    return size <= len(sample) * MAXIMUM_RATIO
+
+
+@contextmanager
+def compressed_stream(source: BinaryIO, codec: str,
+                      level: int) -> Iterator[BinaryIO]:
+    """
+    Provides the compressed content of a stream as another stream. The content
+    is compressed as it is read.
+
+    Parameters
+    ----------
+    source
+        The stream to compress. It is read from its current position.
+
+    codec
+        The codec to compress the content with.
+
+    level
+        The compression level.
+
+    Yields
+    ------
+    A readable stream of the compressed content. Reads return the requested
+    number of bytes, unless the end of the compressed content has been reached.
+    """
+    compressor = __compressor(codec, level)
+    yield io.BufferedReader(_TransformingReader(source, compressor.compress,
+                                                compressor.flush),
+                            buffer_size=BUFFER_SIZE)
+
+
+@contextmanager
+def decompressed_stream(source: BinaryIO, codec: str) -> Iterator[BinaryIO]:
+    """
+    Provides the decompressed content of a stream that was compressed by
+    `compressed_stream`.
+
+    Parameters
+    ----------
+    source
+        The stream of compressed content.
+
+    codec
+        The codec that the content was compressed with.
+
+    Yields
+    ------
+    A readable stream of the original content.
+    """
+    check_codec(codec)
+    if codec == ZSTD:
+        with zstandard.ZstdDecompressor().stream_reader(source) as content:
+            yield io.BufferedReader(content, buffer_size=BUFFER_SIZE)
+    else:
+        decompressor = zlib.decompressobj(wbits=31)
+        yield io.BufferedReader(_TransformingReader(source,
+                                                    decompressor.decompress,
+                                                    decompressor.flush),
+                                buffer_size=BUFFER_SIZE)
+
+
+def decompressor(codec: str):
+    """
+    Returns
+    -------
+    An object that decompresses content that was compressed with a codec, a
+    piece at a time. Its `decompress` method is given each piece of the
+    compressed content and returns the decompressed content that is available
+    so far.
+    """
+    check_codec(codec)
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(wbits=31)
+
+
+def __compressor(codec: str, level: int):
+    check_codec(codec)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    # Using 31 for the window bits produces content in the gzip format.
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+class _TransformingReader(io.RawIOBase):
+    """
+    Reads the content of a stream after it has been passed through a
+    compression (or decompression) object.
+    """
+    def __init__(self, source: BinaryIO, transform: Callable[[bytes], bytes],
+                 flush: Callable[[], bytes]):
+        self.__source = source
+        self.__transform = transform
+        self.__flush = flush
+        self.__pending = memoryview(b"")
+        self.__finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.__pending and not self.__finished:
+            content = self.__source.read(BUFFER_SIZE)
+            if content:
+                self.__pending = memoryview(self.__transform(content))
+            else:
+                self.__pending = memoryview(self.__flush())
+                self.__finished = True
+
+        count = min(len(buffer), len(self.__pending))
+        buffer[:count] = self.__pending[:count]
+        self.__pending = self.__pending[count:]
+        return count
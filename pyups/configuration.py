@@ -2,10 +2,37 @@ from configparser import ConfigParser
 import getpass
 from passlib.context import CryptContext
 import logging
+from pyups import chunking, compression
+from pyups.state import model
 import secrets
 from pathlib import Path
+from typing import Iterable, List
 
 DATA_PATH = ".pyups"
+"""
+Backed up files are stored under `content/`, using their path in the
+repository as the key.
+"""
+LAYOUT_PATH = "path"
+"""
+Backed up files are stored under `objects/`, using the hash of their content as
+the key. Files with identical content are only stored once. A manifest maps the
+path of each file to the hash of its content.
+"""
+LAYOUT_CONTENT_ADDRESSED = "content-addressed"
+LAYOUTS = [LAYOUT_PATH, LAYOUT_CONTENT_ADDRESSED]
+"""
+Items that are stored, but have become excluded by the ignore rules (see
+`pyups.state.ignore`), are kept in the bucket as they were last backed up. They
+are only deleted once they are deleted from the repository.
+"""
+EXCLUDED_KEEP = "keep"
+"""
+Items that are stored, but have become excluded by the ignore rules, are
+deleted from the bucket as if they had been deleted from the repository.
+"""
+EXCLUDED_DELETE = "delete"
+EXCLUDED_POLICIES = [EXCLUDED_KEEP, EXCLUDED_DELETE]
 
 __CRYPT_CONTEXT = CryptContext(
     schemes=["bcrypt", "pbkdf2_sha256", "sha512_crypt"])
@@ -16,9 +43,52 @@ class Configuration:
     Provides a representation for the configuration of a directory that may be
     backed up.
     """
-    def __init__(self, s3_bucket: str, encryption_password: str = None):
+    def __init__(self,
+                 s3_bucket: str,
+                 encryption_password: str = None,
+                 layout: str = LAYOUT_PATH,
+                 chunk_threshold: int = None,
+                 chunk_size: int = chunking.DEFAULT_AVERAGE_SIZE,
+                 compression_codec: str = None,
+                 compression_level: int = None,
+                 hash_algorithm: str = model.DEFAULT_HASH_ALGORITHM,
+                 ignore_patterns: Iterable[str] = (),
+                 excluded_items: str = EXCLUDED_KEEP,
+                 skip_unchanged_directories: bool = False):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout '{layout}'. Expected one of: "
+                             f"{', '.join(LAYOUTS)}")
+        if excluded_items not in EXCLUDED_POLICIES:
+            raise ValueError(
+                f"Unknown policy for excluded items '{excluded_items}'. "
+                f"Expected one of: {', '.join(EXCLUDED_POLICIES)}")
+        model.check_hash_algorithm(hash_algorithm)
+        if (layout == LAYOUT_CONTENT_ADDRESSED
+                and hash_algorithm not in model.CRYPTOGRAPHIC_HASH_ALGORITHMS):
+            raise ValueError(
+                f"Hash algorithm '{hash_algorithm}' cannot be used with the "
+                f"{LAYOUT_CONTENT_ADDRESSED} layout. Expected one of: "
+                f"{', '.join(model.CRYPTOGRAPHIC_HASH_ALGORITHMS)}")
+        if chunk_size & (chunk_size - 1) or chunk_size < 256:
+            raise ValueError(
+                f"Chunk size must be a power of two of at least 256, not {chunk_size}"
+            )
+        if compression_codec is not None:
+            compression.check_codec(compression_codec)
+            if compression_level is None:
+                compression_level = compression.DEFAULT_LEVELS[
+                    compression_codec]
         self.__s3_bucket = s3_bucket
         self.__encryption_password = encryption_password
+        self.__layout = layout
+        self.__chunk_threshold = chunk_threshold
+        self.__chunk_size = chunk_size
+        self.__compression_codec = compression_codec
+        self.__compression_level = compression_level
+        self.__hash_algorithm = hash_algorithm
+        self.__ignore_patterns = tuple(ignore_patterns)
+        self.__excluded_items = excluded_items
+        self.__skip_unchanged_directories = skip_unchanged_directories
 
     @property
     def s3_bucket(self):
@@ -36,17 +106,112 @@ class Configuration:
         """
         return self.__encryption_password
 
+    @property
+    def layout(self):
+        """
+        How the backed up files are laid out in the bucket. This is either
+        `LAYOUT_PATH` (the default) or `LAYOUT_CONTENT_ADDRESSED`.
+        """
+        return self.__layout
+
+    @property
+    def chunk_threshold(self):
+        """
+        If configured, files of at least this size (in bytes) are split into
+        chunks, so that only the chunks that changed need to be uploaded. This
+        is `None` if files are not split into chunks.
+        """
+        return self.__chunk_threshold
+
+    @property
+    def chunk_size(self):
+        """
+        The average size (in bytes) of the chunks that files are split into.
+        """
+        return self.__chunk_size
+
+    @property
+    def compression_codec(self):
+        """
+        If configured, this is the codec that content is compressed with before
+        it is encrypted and uploaded (see `pyups.compression.CODECS`). This is
+        `None` if content is not compressed.
+        """
+        return self.__compression_codec
+
+    @property
+    def compression_level(self):
+        """
+        The level of compression, if content is compressed. Otherwise, `None`.
+        """
+        return self.__compression_level
+
+    @property
+    def hash_algorithm(self):
+        """
+        The algorithm that the content of files is hashed with to detect
+        changes (see `pyups.state.model.HASH_ALGORITHMS`). With the
+        content-addressed layout, the hash is also the key of the content, so
+        the algorithm must be a cryptographic one.
+        """
+        return self.__hash_algorithm
+
+    @property
+    def ignore_patterns(self):
+        """
+        Patterns of items to exclude from the backup (see
+        `pyups.state.ignore`), in addition to the ones in the repository's
+        `.pyupsignore` file.
+        """
+        return self.__ignore_patterns
+
+    @property
+    def excluded_items(self):
+        """
+        What happens to stored items that have become excluded by the ignore
+        rules. This is either `EXCLUDED_KEEP` (the default) or
+        `EXCLUDED_DELETE`.
+        """
+        return self.__excluded_items
+
+    @property
+    def skip_unchanged_directories(self):
+        """
+        Whether directories whose modification time has not changed since they
+        were last listed are not listed again (see
+        `pyups.state.repository.StateRepository`). Their files are taken from
+        the store instead, and are still checked, so that files modified in
+        place (which does not change their directory's modification time) are
+        found. This makes scanning a large repository with few changes faster.
+        It is off by default.
+        """
+        return self.__skip_unchanged_directories
+
     def __eq__(self, other) -> bool:
         if isinstance(other, self.__class__):
             return (self.s3_bucket == other.s3_bucket
-                    and self.encryption_password == other.encryption_password)
+                    and self.encryption_password == other.encryption_password
+                    and self.layout == other.layout
+                    and self.chunk_threshold == other.chunk_threshold
+                    and self.chunk_size == other.chunk_size
+                    and self.compression_codec == other.compression_codec
+                    and self.compression_level == other.compression_level
+                    and self.hash_algorithm == other.hash_algorithm
+                    and self.ignore_patterns == other.ignore_patterns
+                    and self.excluded_items == other.excluded_items
+                    and self.skip_unchanged_directories ==
+                    other.skip_unchanged_directories)
         return NotImplemented
 
     def __hash__(self) -> int:
-        return hash((self.s3_bucket, self.encryption_password))
+        return hash((self.s3_bucket, self.encryption_password, self.layout,
+                     self.chunk_threshold, self.chunk_size,
+                     self.compression_codec, self.compression_level,
+                     self.hash_algorithm, self.ignore_patterns,
+                     self.excluded_items, self.skip_unchanged_directories))
 
     def __repr__(self) -> str:
-        return f"Configuration(s3_bucket={self.s3_bucket})"
+        return f"Configuration(s3_bucket={self.s3_bucket}, layout={self.layout})"
 
 
 def get_configuration(repository_path: Path) -> Configuration:
@@ -80,6 +245,20 @@ def get_configuration(repository_path: Path) -> Configuration:
     return configuration
 
 
+def read_configuration(config_file: Path) -> Configuration:
+    """
+    Reads a configuration file, e.g. the configuration of a repository that is
+    being restored on another host.
+
+    Parameters
+    ----------
+    config_file
+        The path to the configuration file, as written for a repository in
+        `.pyups/config`.
+    """
+    return __read_configuration(config_file)
+
+
 def __read_configuration(config_file: Path) -> Configuration:
     # Configuration for the repository being backed up
     config_parser = ConfigParser()
@@ -88,7 +267,51 @@ def __read_configuration(config_file: Path) -> Configuration:
 
     return Configuration(s3_bucket=config_parser.get(section="s3",
                                                      option="bucket"),
-                         encryption_password=encryption_password)
+                         encryption_password=encryption_password,
+                         layout=config_parser.get(section="s3",
+                                                  option="layout",
+                                                  fallback=LAYOUT_PATH),
+                         chunk_threshold=config_parser.getint(
+                             section="chunking",
+                             option="threshold",
+                             fallback=None),
+                         chunk_size=config_parser.getint(
+                             section="chunking",
+                             option="size",
+                             fallback=chunking.DEFAULT_AVERAGE_SIZE),
+                         compression_codec=config_parser.get(
+                             section="compression",
+                             option="codec",
+                             fallback=None),
+                         compression_level=config_parser.getint(
+                             section="compression",
+                             option="level",
+                             fallback=None),
+                         hash_algorithm=__read_hash_algorithm(config_parser),
+                         ignore_patterns=__read_ignore_patterns(config_parser),
+                         excluded_items=__read_excluded_items(config_parser),
+                         skip_unchanged_directories=config_parser.getboolean(
+                             section="scanning",
+                             option="skip_unchanged_directories",
+                             fallback=False))
+
+
+def __read_hash_algorithm(config: ConfigParser) -> str:
+    return config.get(section="hashing",
+                      option="algorithm",
+                      fallback=model.DEFAULT_HASH_ALGORITHM)
+
+
+def __read_ignore_patterns(config: ConfigParser) -> List[str]:
+    # One pattern on each line of the (multi-line) value.
+    patterns = config.get(section="ignore", option="patterns", fallback="")
+    return [line.strip() for line in patterns.splitlines() if line.strip()]
+
+
+def __read_excluded_items(config: ConfigParser) -> str:
+    return config.get(section="ignore",
+                      option="excluded_items",
+                      fallback=EXCLUDED_KEEP)
 
 
 def __read_encryption(config: ConfigParser):
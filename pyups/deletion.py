@@ -0,0 +1,134 @@
+"""
+Deletes objects from the bucket in batches. S3 deletes up to 1000 objects with
+each `delete_objects` request, and reports the keys that it could not delete
+with an error code for each. The batches are sent concurrently, and the keys
+that failed with an error that may go away (e.g. because the bucket is being
+throttled) are sent again in later batches, after a backoff.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import time
+from typing import Dict, Iterable, List
+from pyups.stats import RunStats
+
+"""
+The most keys that are sent with a single delete request.
+"""
+BATCH_SIZE = 500
+
+"""
+The number of times that a key is sent, before it is given up on.
+"""
+MAXIMUM_ATTEMPTS = 5
+
+"""
+The time (in seconds) waited before sending a key again for the first time. The
+time is doubled for each attempt after that, with some jitter.
+"""
+RETRY_DELAY = 0.2
+
+"""
+The error codes of keys that may be deleted if they are sent again. Keys that
+failed with any other code (e.g. `AccessDenied`) are not sent again.
+"""
+RETRYABLE_ERRORS = {
+    "SlowDown", "InternalError", "ServiceUnavailable", "RequestTimeout",
+    "OperationAborted"
+}
+
+
+def delete_objects(client,
+                   bucket: str,
+                   keys: Iterable[str],
+                   workers: int = 8,
+                   stats: RunStats = None) -> Dict[str, str]:
+    """
+    Deletes objects from a bucket.
+
+    Parameters
+    ----------
+    client
+        The S3 client to delete the objects with.
+
+    bucket
+        The name of the bucket.
+
+    keys
+        The keys of the objects to delete.
+
+    workers
+        The number of delete requests that are sent concurrently.
+
+    stats
+        If given, the number of objects deleted (and not deleted) and the
+        number of keys sent again are counted in it.
+
+    Returns
+    -------
+    The error code of each key whose object could not be deleted. The objects
+    of all of the other keys were deleted.
+    """
+    stats = stats if stats is not None else RunStats()
+    pending = list(dict.fromkeys(keys))
+    failures = {}
+    attempt = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        while pending:
+            if attempt > 0:
+                stats.count("delete_retries", len(pending))
+                time.sleep(RETRY_DELAY * 2**(attempt - 1) *
+                           random.uniform(0.5, 1.0))
+            batches = [
+                pending[i:i + BATCH_SIZE]
+                for i in range(0, len(pending), BATCH_SIZE)
+            ]
+            attempt += 1
+            pending = []
+            for errors in executor.map(
+                    lambda batch: __delete_batch(client, bucket, batch, stats),
+                    batches):
+                for (key, code) in errors.items():
+                    if code in RETRYABLE_ERRORS and attempt < MAXIMUM_ATTEMPTS:
+                        pending.append(key)
+                    else:
+                        failures[key] = code
+
+    for (key, code) in failures.items():
+        logging.warning(f"Could not delete object {key} ({code})")
+    stats.count("deletes_failed", len(failures))
+    return failures
+
+
+def __delete_batch(client, bucket: str, batch: List[str],
+                   stats: RunStats) -> Dict[str, str]:
+    """
+    Sends a single delete request.
+
+    Returns
+    -------
+    The error code of each key that was not deleted. If the request itself
+    failed, every key of the batch is returned with the `InternalError` code,
+    so that they are sent again.
+    """
+    start = time.perf_counter()
+    try:
+        response = client.delete_objects(Bucket=bucket,
+                                         Delete={
+                                             'Objects': [{
+                                                 'Key': key
+                                             } for key in batch],
+                                             'Quiet': True
+                                         })
+    except Exception as error:
+        logging.warning(f"Delete request of {len(batch)} objects failed: "
+                        f"{error}")
+        return {key: "InternalError" for key in batch}
+    finally:
+        stats.observe("delete_seconds", time.perf_counter() - start)
+    errors = {
+        error['Key']: error.get('Code', "InternalError")
+        for error in response.get('Errors', [])
+    }
+    stats.count("objects_deleted", len(batch) - len(errors))
+    return errors
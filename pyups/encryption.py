@@ -1,16 +1,25 @@
+from contextlib import contextmanager
+import io
 from pathlib import Path
 import os
 import pyAesCrypt
 import tempfile
-from typing import Callable
+import threading
+from typing import BinaryIO, Callable, Iterator
 
 BUFFER_SIZE = 65536 * 8
 
+"""
+The bytes that content encrypted by `pyAesCrypt` starts with.
+"""
+HEADER = b"AES"
+
 
 def encrypted_file(source: Path, password: str) -> (Path, Callable[[], None]):
     """
     Encrypts a file to a temporary file. The temporary file is also removed by
-    the provided clean up function.
+    the provided clean up function. Use `encrypted_stream` to encrypt content
+    without having to write it to the file system.
 
     Parameters
     ----------
@@ -34,3 +43,102 @@ def encrypted_file(source: Path, password: str) -> (Path, Callable[[], None]):
 
     encrypted_path = Path(encrypted_file)
     return (encrypted_path, encrypted_path.unlink)
+
+
+@contextmanager
+def encrypted_stream(source: BinaryIO, password: str) -> Iterator[BinaryIO]:
+    """
+    Provides the encrypted content of a stream as another stream, without
+    writing the encrypted content to the file system. The content is encrypted
+    by a separate thread as it is being read.
+
+    The stream that is provided is not seekable. Reads return the requested
+    number of bytes, unless the end of the encrypted content has been reached.
+    If the content could not be encrypted, reading the stream raises the error
+    instead of reaching the end of the stream.
+
+    Parameters
+    ----------
+    source
+        The stream to encrypt. It is read from its current position.
+
+    password
+        The password that the content will be encrypted with. It will need to be
+        provided for the content to be decrypted again.
+
+    Yields
+    ------
+    A readable stream of the encrypted content.
+    """
+    encrypting = _EncryptingReader(source=source, password=password)
+    try:
+        yield io.BufferedReader(encrypting, buffer_size=BUFFER_SIZE)
+    finally:
+        encrypting.close()
+
+
+def decrypt_stream(source: BinaryIO, target: BinaryIO, password: str,
+                   size: int) -> None:
+    """
+    Decrypts content that was encrypted by `encrypted_stream` (or
+    `encrypted_file`) as it is read, writing the decrypted content to
+    `target`. Neither stream needs to be seekable.
+
+    Parameters
+    ----------
+    source
+        The stream of encrypted content.
+
+    target
+        Where the decrypted content is written to.
+
+    password
+        The password that the content was encrypted with.
+
+    size
+        The size of the encrypted content, in bytes.
+    """
+    pyAesCrypt.decryptStream(source, target, password, BUFFER_SIZE, size)
+
+
+class _EncryptingReader(io.RawIOBase):
+    """
+    Reads the content of a stream as it is encrypted by `pyAesCrypt`. The
+    encryption thread writes into a pipe, which is read by this reader.
+    """
+    def __init__(self, source: BinaryIO, password: str):
+        (read_fd, write_fd) = os.pipe()
+        self.__pipe = os.fdopen(read_fd, "rb", buffering=0)
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__encrypt,
+                                         args=(source, password, write_fd),
+                                         daemon=True)
+        self.__thread.start()
+
+    def __encrypt(self, source: BinaryIO, password: str, write_fd: int):
+        try:
+            with os.fdopen(write_fd, "wb") as output:
+                pyAesCrypt.encryptStream(source, output, password,
+                                         BUFFER_SIZE)
+        except BrokenPipeError:
+            # The reader was closed before all of the content was read.
+            pass
+        except Exception as error:
+            self.__error = error
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = self.__pipe.readinto(buffer)
+        if not count:
+            self.__thread.join()
+            if self.__error is not None:
+                raise IOError("Could not encrypt content") from self.__error
+        return count
+
+    def close(self) -> None:
+        if not self.closed:
+            self.__pipe.close()
+            self.__thread.join()
+        super().close()
@@ -0,0 +1,226 @@
+"""
+A journal of the progress of a backup, kept in the repository's data directory.
+If a backup is interrupted, the next one resumes from the journal: the changes
+that were found but not backed up yet are checked against their metadata
+instead of being hashed again, and multipart uploads that were left open are
+continued instead of being started over.
+
+The journal is a file with one JSON object per line, so that entries can be
+appended as the backup progresses. It is removed once a backup completes.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import Callable, Iterator
+from pyups import plan
+from pyups.state.repository import Change, DELETED, StateRepository
+
+JOURNAL_NAME = "journal.jsonl"
+JOURNAL_VERSION = 1
+
+
+class Journal:
+    """
+    Records the changes that a backup is working on and the multipart uploads
+    that it has open. It may be updated from several threads.
+    """
+    def __init__(self, data_path: Path):
+        """
+        Parameters
+        ----------
+        data_path
+            The repository's data directory, where the journal is kept. The
+            entries of a journal that was left there by an earlier backup are
+            read.
+        """
+        self.__data_path = data_path
+        self.__path = data_path.joinpath(JOURNAL_NAME)
+        self.__lock = threading.Lock()
+        self.__file = None
+        # The changes recorded by earlier backups, by their item.
+        self.__changes = {}
+        # The multipart uploads that have not been completed, by their key.
+        self.__uploads = {}
+        # The keys of the uploads that were started or continued by this backup.
+        self.__used = set()
+        # Uploads that were replaced by another upload to the same key.
+        self.__replaced = []
+        self.__load()
+
+    @property
+    def resuming(self) -> bool:
+        """
+        Returns
+        -------
+        `True` if an earlier backup left changes in the journal.
+        """
+        return bool(self.__changes)
+
+    def pending_changes(self, states: StateRepository) -> Iterator[Change]:
+        """
+        Provides the changes that an earlier backup found, but did not finish
+        backing up. Changes that no longer describe the repository are left
+        out (see `pyups.plan.current_changes`), as are deletions, which are
+        found again cheaply.
+        """
+        entries = [
+            entry for entry in self.__changes.values()
+            if entry["kind"] != DELETED
+        ]
+        logging.info(
+            f"Resuming an interrupted backup with {len(entries)} change(s).")
+        yield from plan.current_changes(entries, states)
+
+    def record_change(self, change: Change) -> None:
+        """
+        Records a change that the backup is about to back up.
+        """
+        self.__append({"change": plan.change_to_dict(change)})
+
+    def open_upload(self, key: str, content_hash: str) -> dict:
+        """
+        Finds a multipart upload of content to an object, which was left open.
+
+        Returns
+        -------
+        The `upload_id` and `part_size` of the upload, or `None` if there is no
+        open upload of the content to the object.
+        """
+        with self.__lock:
+            upload = self.__uploads.get(key)
+            if upload is None or upload["hash"] != content_hash:
+                return None
+            self.__used.add(key)
+            return dict(upload)
+
+    def record_upload(self, key: str, content_hash: str, upload_id: str,
+                      part_size: int) -> None:
+        """
+        Records a multipart upload that was started, so that it can be
+        continued if the backup is interrupted.
+        """
+        upload = {
+            "key": key,
+            "hash": content_hash,
+            "upload_id": upload_id,
+            "part_size": part_size
+        }
+        with self.__lock:
+            previous = self.__uploads.get(key)
+            if previous is not None and previous["upload_id"] != upload_id:
+                self.__replaced.append(previous)
+            self.__uploads[key] = upload
+            self.__used.add(key)
+        self.__append({"upload": upload})
+
+    def record_completed(self, key: str) -> None:
+        """
+        Records that the multipart upload to an object was completed.
+        """
+        with self.__lock:
+            self.__uploads.pop(key, None)
+        self.__append({"completed": key})
+
+    def finish(self, abort: Callable[[str, str], None]) -> None:
+        """
+        Removes the journal once a backup has finished. Multipart uploads that
+        this backup started or continued, but could not complete, are kept in
+        the journal so that the next backup can continue them. Uploads that
+        were left open by an earlier backup, but were not continued by this
+        one, are aborted.
+
+        Parameters
+        ----------
+        abort
+            Aborts a multipart upload, given its key and upload ID.
+        """
+        with self.__lock:
+            self.close()
+            stale = self.__replaced + [
+                upload for (key, upload) in self.__uploads.items()
+                if key not in self.__used
+            ]
+            for upload in stale:
+                try:
+                    abort(upload["key"], upload["upload_id"])
+                except Exception as error:
+                    logging.warning(
+                        f"Could not abort the upload to {upload['key']}: {error}"
+                    )
+
+            remaining = [
+                upload for (key, upload) in self.__uploads.items()
+                if key in self.__used
+            ]
+            if remaining:
+                temporary = self.__path.with_name(f".{JOURNAL_NAME}.tmp")
+                entries = [Journal.__header()]
+                entries += [{"upload": upload} for upload in remaining]
+                with temporary.open(mode="w") as file:
+                    for entry in entries:
+                        file.write(json.dumps(entry) + "\n")
+                os.replace(temporary, self.__path)
+            elif self.__path.exists():
+                self.__path.unlink()
+
+            self.__changes = {}
+            self.__uploads = {upload["key"]: upload for upload in remaining}
+            self.__used = set()
+            self.__replaced = []
+
+    def close(self) -> None:
+        """
+        Closes the journal, leaving its entries for the next backup.
+        """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __load(self) -> None:
+        try:
+            with self.__path.open(mode="r") as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return
+
+        if not lines or Journal.__parse(lines[0]) != Journal.__header():
+            logging.warning(f"Ignoring unsupported journal {self.__path}.")
+            self.__path.unlink()
+            return
+
+        for line in lines[1:]:
+            entry = Journal.__parse(line)
+            if entry is None:
+                # The last line may have been cut short by the interruption.
+                logging.debug(f"Ignoring incomplete journal entry: {line}")
+            elif "change" in entry:
+                self.__changes[entry["change"]["item"]] = entry["change"]
+            elif "upload" in entry:
+                self.__uploads[entry["upload"]["key"]] = entry["upload"]
+            elif "completed" in entry:
+                self.__uploads.pop(entry["completed"], None)
+
+    def __append(self, entry: dict) -> None:
+        with self.__lock:
+            if self.__file is None:
+                self.__data_path.mkdir(parents=True, exist_ok=True)
+                self.__file = self.__path.open(mode="a")
+                if self.__file.tell() == 0:
+                    self.__file.write(json.dumps(Journal.__header()) + "\n")
+            self.__file.write(json.dumps(entry) + "\n")
+            # The entry only has to survive the process being interrupted, so
+            # it is flushed to the operating system without an fsync.
+            self.__file.flush()
+
+    @staticmethod
+    def __parse(line: str) -> dict:
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            return None
+
+    @staticmethod
+    def __header() -> dict:
+        return {"version": JOURNAL_VERSION}
@@ -0,0 +1,374 @@
+"""
+The manifest lists the items that are backed up in the bucket, with the size
+and hash of their content and the key of the object that stores it. Tools that
+work on the bucket (e.g. restoring or verifying a backup, or recovering the
+local state) can read it instead of listing every object in the bucket.
+
+The manifest is kept as segments under `manifest/`: a base segment that lists
+every item and delta segments that list the items changed (or deleted) by each
+backup after it. An index object lists the segments in order. Once there are
+too many deltas, they are compacted into a new base.
+"""
+from contextlib import closing, contextmanager
+import gzip
+import io
+import json
+import logging
+from pathlib import Path
+import secrets
+import shutil
+import time
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, Tuple
+from botocore.exceptions import ClientError
+from pyups import compression, encryption
+from pyups.state.model import DEFAULT_HASH_ALGORITHM, State
+
+"""
+The key of the index, which lists the segments of the manifest.
+"""
+INDEX_KEY = "manifest/index.json"
+INDEX_VERSION = 1
+
+"""
+The key of the manifest written by earlier versions, which listed every item of
+the content-addressed layout in a single object.
+"""
+LEGACY_MANIFEST_KEY = "manifest.json.gz"
+
+"""
+Once the manifest has this many delta segments, or the deltas list more entries
+than the base, they are compacted into a new base.
+"""
+MAXIMUM_DELTAS = 16
+
+"""
+An entry of the manifest: an item, its state and the key of the object that
+stores its content. The state and key of a deleted item are `None`.
+"""
+Entry = Tuple[Path, State, str]
+
+
+@contextmanager
+def manifest_stream(entries: Iterable[Entry]) -> Iterator[BinaryIO]:
+    """
+    Provides a segment of the manifest as a stream. The segment is a gzip
+    compressed file with one JSON object per line, which describes the path,
+    size, content hash (and its algorithm) and key of an item, or marks the
+    item as deleted. The entries are compressed as the stream is read, so the
+    segment is not written anywhere first.
+
+    Parameters
+    ----------
+    entries
+        The entries that will be listed in the segment.
+
+    Yields
+    ------
+    A readable stream of the segment's content.
+    """
+    def lines() -> Iterator[bytes]:
+        for (item, state, key) in entries:
+            if state is None:
+                entry = {"path": item.as_posix(), "deleted": True}
+            else:
+                entry = {
+                    "path": item.as_posix(),
+                    "size": state.size,
+                    "hash": state.content_hash,
+                    "algorithm": state.hash_algorithm,
+                    "key": key
+                }
+            yield bytes(json.dumps(entry) + "\n", "utf-8")
+
+    with compression.compressed_stream(
+            source=_LinesReader(lines()),
+            codec=compression.GZIP,
+            level=compression.DEFAULT_LEVELS[compression.GZIP]) as content:
+        yield content
+
+
+def read_entry(line: bytes) -> Entry:
+    """
+    Reads an entry from a line of a segment of the manifest, which was written
+    by `manifest_stream`.
+    """
+    entry = json.loads(line)
+    if entry.get("deleted"):
+        return (Path(entry["path"]), None, None)
+    return (Path(entry["path"]),
+            State(size=entry["size"],
+                  content_hash=entry["hash"],
+                  hash_algorithm=entry.get("algorithm",
+                                           DEFAULT_HASH_ALGORITHM)),
+            entry.get("key"))
+
+
+def read_manifest(source: BinaryIO) -> Iterator[Entry]:
+    """
+    Reads the entries of a segment of the manifest, which was written by
+    `manifest_stream`.
+
+    Parameters
+    ----------
+    source
+        A stream of the segment's content.
+
+    Yields
+    ------
+    The entries listed in the segment.
+    """
+    with gzip.GzipFile(fileobj=source, mode="rb") as content:
+        for line in content:
+            yield read_entry(line)
+
+
+class RemoteManifest:
+    """
+    The manifest of the items backed up in a bucket.
+    """
+    def __init__(self, client, bucket: str, encryption_password: str = None):
+        """
+        Parameters
+        ----------
+        client
+            The S3 client to access the bucket with.
+
+        bucket
+            The name of the bucket.
+
+        encryption_password
+            If given, the segments are encrypted with this password.
+        """
+        self.__client = client
+        self.__bucket = bucket
+        self.__password = encryption_password
+
+    def read_index(self) -> dict:
+        """
+        Returns
+        -------
+        The index of the manifest, or `None` if there is no manifest in the
+        bucket yet.
+        """
+        try:
+            response = self.__client.get_object(Bucket=self.__bucket,
+                                                Key=INDEX_KEY)
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") in ("404",
+                                                               "NoSuchKey"):
+                return None
+            raise
+        with closing(response["Body"]) as content:
+            index = json.load(content)
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(
+                f"Unsupported manifest version: {index.get('version')}")
+        return index
+
+    def update(self,
+               changed: Iterable[Entry],
+               all_entries: Iterable[Entry],
+               rebase: bool = False) -> None:
+        """
+        Adds the entries changed by a backup to the manifest, as a delta
+        segment. A new base is written instead if there is no manifest yet,
+        if there are too many deltas, or if `rebase` is `True`.
+
+        Parameters
+        ----------
+        changed
+            The entries that were changed by the backup.
+
+        all_entries
+            Every item that is backed up. This is only iterated if a new base
+            is written.
+
+        rebase
+            If `True`, a new base is written even if a delta would do, e.g.
+            because an earlier update failed.
+        """
+        index = self.read_index()
+        changed = list(changed)
+        if not (rebase or RemoteManifest.__needs_base(index, len(changed))):
+            if not changed:
+                return
+            index["deltas"].append(self.__write_segment("delta", changed))
+            self.__write_index(index)
+            return
+
+        replaced = [] if index is None else [index["base"]] + index["deltas"]
+        self.__write_index({
+            "version": INDEX_VERSION,
+            "base": self.__write_segment("base", all_entries),
+            "deltas": []
+        })
+        self.__delete([segment["key"] for segment in replaced] +
+                      [LEGACY_MANIFEST_KEY])
+
+    def read(self) -> Dict[Path, Tuple[State, str]]:
+        """
+        Reads the manifest, applying the deltas to the base in order.
+
+        Returns
+        -------
+        The state of each backed up item and the key of the object that stores
+        its content, by the item. The result is empty if there is no manifest.
+        """
+        index = self.read_index()
+        if index is None:
+            return {}
+
+        items = {}
+
+        def apply(entry: Entry) -> None:
+            (item, state, key) = entry
+            if state is None:
+                items.pop(item, None)
+            else:
+                items[item] = (state, key)
+
+        for segment in [index["base"]] + index["deltas"]:
+            self.__read_segment(segment["key"],
+                                segment.get("encrypted", False), apply)
+        return items
+
+    @staticmethod
+    def __needs_base(index: dict, changed: int) -> bool:
+        if index is None:
+            return True
+        delta_entries = sum(segment["entries"] for segment in index["deltas"])
+        return (len(index["deltas"]) >= MAXIMUM_DELTAS
+                or delta_entries + changed > max(index["base"]["entries"], 1))
+
+    def __write_segment(self, kind: str, entries: Iterable[Entry]) -> dict:
+        """
+        Uploads a segment of the manifest.
+
+        Returns
+        -------
+        The description of the segment for the index.
+        """
+        count = 0
+
+        def counting(entries: Iterable[Entry]) -> Iterator[Entry]:
+            nonlocal count
+            for entry in entries:
+                count += 1
+                yield entry
+
+        key = f"manifest/{kind}-{time.time_ns()}-{secrets.token_hex(4)}.json.gz"
+        with manifest_stream(counting(entries)) as source:
+            if self.__password:
+                with encryption.encrypted_stream(source,
+                                                 self.__password) as content:
+                    self.__upload(content, key)
+            else:
+                self.__upload(source, key)
+        logging.info(f"Wrote manifest segment {key}.")
+        return {
+            "key": key,
+            "entries": count,
+            "encrypted": bool(self.__password)
+        }
+
+    def __write_index(self, index: dict) -> None:
+        self.__upload(io.BytesIO(bytes(json.dumps(index, indent=1), "utf-8")),
+                      INDEX_KEY)
+
+    def __upload(self, content: BinaryIO, key: str) -> None:
+        self.__client.upload_fileobj(Fileobj=content,
+                                     Bucket=self.__bucket,
+                                     Key=key)
+
+    def __read_segment(self, key: str, encrypted: bool,
+                       consumer: Callable[[Entry], None]) -> None:
+        """
+        Reads the entries of a segment of the manifest, passing each of them
+        to `consumer`. The segment is decrypted and decompressed as it is
+        downloaded.
+        """
+        if encrypted and not self.__password:
+            raise ValueError(
+                f"Manifest segment {key} is encrypted, but no password was given"
+            )
+        target = _SegmentWriter(consumer)
+        response = self.__client.get_object(Bucket=self.__bucket, Key=key)
+        with closing(response["Body"]) as body:
+            if encrypted:
+                encryption.decrypt_stream(body, target, self.__password,
+                                          response["ContentLength"])
+            else:
+                shutil.copyfileobj(body, target, encryption.BUFFER_SIZE)
+        target.finish()
+
+    def __delete(self, keys: list) -> None:
+        response = self.__client.delete_objects(
+            Bucket=self.__bucket,
+            Delete={
+                'Objects': [{
+                    'Key': key
+                } for key in keys],
+                'Quiet': True
+            })
+        for error in response.get('Errors', []):
+            logging.warning(
+                f"Could not delete old manifest segment {error['Key']}")
+
+
+class _LinesReader(io.RawIOBase):
+    """
+    Reads the lines provided by an iterator as a stream, taking them from the
+    iterator as they are needed.
+    """
+    def __init__(self, lines: Iterator[bytes]):
+        self.__lines = lines
+        self.__pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self.__pending:
+            parts = []
+            size = 0
+            for line in self.__lines:
+                parts.append(line)
+                size += len(line)
+                if size >= len(buffer):
+                    break
+            self.__pending = memoryview(b"".join(parts))
+
+        count = min(len(buffer), len(self.__pending))
+        buffer[:count] = self.__pending[:count]
+        self.__pending = self.__pending[count:]
+        return count
+
+
+class _SegmentWriter:
+    """
+    Reads the entries of a segment of the manifest as its content is written
+    to it, decompressing the content and passing each entry to a consumer.
+    """
+    def __init__(self, consumer: Callable[[Entry], None]):
+        self.__consumer = consumer
+        self.__decompressor = compression.decompressor(compression.GZIP)
+        # The start of a line whose end has not been written yet.
+        self.__partial = b""
+
+    def write(self, content: bytes) -> int:
+        self.__read_lines(self.__decompressor.decompress(content))
+        return len(content)
+
+    def finish(self) -> None:
+        """
+        Reads the rest of the segment, once all of it has been written.
+        """
+        self.__read_lines(self.__decompressor.flush())
+        if not self.__decompressor.eof or self.__partial:
+            raise ValueError("The manifest segment is incomplete")
+
+    def __read_lines(self, content: bytes) -> None:
+        lines = (self.__partial + content).split(b"\n")
+        self.__partial = lines.pop()
+        for line in lines:
+            self.__consumer(read_entry(line))
@@ -0,0 +1,288 @@
+"""
+Plans for backups. A plan lists the changes that a backup would make, with
+totals of the number of items and bytes for each kind of change, without
+touching the bucket. A plan that was written to a file can be applied later,
+without having to scan the repository again.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Iterable, Iterator
+from pyups.state.model import State, calculate_state
+from pyups.state.repository import (Change, DELETED, MODIFIED, MOVED, NEW,
+                                    StateRepository)
+
+PLAN_VERSION = 1
+
+"""
+The default bandwidth (in bytes per second) used to estimate how long the
+transfer of a plan's changes will take.
+"""
+DEFAULT_BANDWIDTH = 10 * 1024 * 1024
+
+
+class Plan:
+    """
+    The changes that a backup would make to the bucket.
+    """
+    def __init__(self, root_path: Path, changes: Iterable[Change]):
+        self.__root_path = root_path
+        self.__changes = list(changes)
+
+    @property
+    def root_path(self) -> Path:
+        """
+        Returns
+        -------
+        The path to the repository that the plan is for.
+        """
+        return self.__root_path
+
+    @property
+    def changes(self) -> list:
+        """
+        Returns
+        -------
+        The `Change`s in the plan, in the order that they were found.
+        """
+        return self.__changes
+
+    @property
+    def upload_size(self) -> int:
+        """
+        Returns
+        -------
+        The number of bytes of content that will be uploaded. Moved items are
+        copied within the bucket, so they are not included.
+        """
+        return sum(c.new_state.size for c in self.__changes
+                   if Plan.__needs_upload(c))
+
+    def summary(self, bandwidth: int = DEFAULT_BANDWIDTH) -> dict:
+        """
+        Totals the number of items and bytes for each kind of change.
+
+        Parameters
+        ----------
+        bandwidth
+            The bandwidth, in bytes per second, used to estimate how long the
+            uploads will take.
+
+        Returns
+        -------
+        A dictionary with the `items` and `bytes` for each kind of change, the
+        total `upload_bytes` and the `estimated_seconds` for the upload.
+        """
+        totals = {
+            kind: {
+                "items": 0,
+                "bytes": 0
+            }
+            for kind in [NEW, MODIFIED, DELETED, MOVED]
+        }
+        for c in self.__changes:
+            state = c.previous_state if c.kind == DELETED else c.new_state
+            totals[c.kind]["items"] += 1
+            totals[c.kind]["bytes"] += state.size
+
+        upload_size = self.upload_size
+        totals["upload_bytes"] = upload_size
+        totals["estimated_seconds"] = round(upload_size / bandwidth, 1)
+        return totals
+
+    def write(self, plan_file: Path, bandwidth: int = DEFAULT_BANDWIDTH):
+        """
+        Writes the plan to a file as JSON, so that it can be read back with
+        `read_plan`.
+        """
+        content = {
+            "version": PLAN_VERSION,
+            "root": self.__root_path.as_posix(),
+            "summary": self.summary(bandwidth),
+            "changes": [change_to_dict(c) for c in self.__changes]
+        }
+        with plan_file.open(mode="w") as file:
+            json.dump(content, file, indent=1)
+
+    @staticmethod
+    def __needs_upload(change: Change) -> bool:
+        if change.kind == NEW:
+            return True
+        return change.kind == MODIFIED and change.content_changed
+
+
+def format_summary(summary: dict) -> str:
+    """
+    Formats the summary of a plan (see `Plan.summary`) for printing.
+    """
+    lines = [
+        f"{kind.capitalize()}: {summary[kind]['items']} item(s), {summary[kind]['bytes']} bytes"
+        for kind in [NEW, MODIFIED, DELETED, MOVED]
+    ]
+    lines.append(f"To upload: {summary['upload_bytes']} bytes, "
+                 f"about {summary['estimated_seconds']} seconds")
+    return "\n".join(lines)
+
+
+def create_plan(states: StateRepository) -> Plan:
+    """
+    Creates a plan of the changes in a repository.
+    """
+    return Plan(root_path=states.root_path, changes=states.changes())
+
+
+def read_plan(plan_file: Path, states: StateRepository) -> Plan:
+    """
+    Reads a plan that was written by `Plan.write`. Changes whose items have
+    changed again since the plan was made are left out, since the plan no
+    longer describes them correctly. They will be found by the next backup.
+
+    Parameters
+    ----------
+    plan_file
+        The file that the plan was written to.
+
+    states
+        The repository that the plan is for.
+
+    Raises
+    ------
+    ValueError
+        If the plan was made for a different repository or by an incompatible
+        version.
+    """
+    with plan_file.open(mode="r") as file:
+        content = json.load(file)
+
+    if content.get("version") != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version: {content.get('version')}")
+    if Path(content["root"]).resolve() != states.root_path.resolve():
+        raise ValueError(
+            f"Plan {plan_file} is for {content['root']}, not {states.root_path}"
+        )
+
+    return Plan(root_path=states.root_path,
+                changes=current_changes(content["changes"], states))
+
+
+def current_changes(entries: Iterable[dict],
+                    states: StateRepository) -> Iterator[Change]:
+    """
+    Converts changes written by `change_to_dict` back into `Change`s, leaving
+    out the ones that no longer describe the repository. Changes that have
+    already been committed are left out as well.
+
+    Parameters
+    ----------
+    entries
+        The changes, as written by `change_to_dict`.
+
+    states
+        The repository that the changes are for.
+    """
+    store = states.state_store
+    for entry in entries:
+        change = change_from_dict(entry, states)
+        stored_item = change.moved_from or change.item
+        if __is_committed(change, store):
+            logging.debug(
+                f"{change.item.as_posix()} was already backed up, skipping it."
+            )
+        elif store.get_state(stored_item) != change.previous_state:
+            logging.warning(
+                f"State of {stored_item.as_posix()} changed since the plan was made, skipping it."
+            )
+        elif change.new_state is not None and not __still_current(change):
+            logging.warning(
+                f"{change.item.as_posix()} changed since the plan was made, skipping it."
+            )
+        elif (change.new_state is None and change.item_path.exists()
+              and not states.deletes_excluded(change.item)):
+            logging.warning(
+                f"{change.item.as_posix()} was restored since the plan was made, skipping it."
+            )
+        else:
+            yield change
+
+
+def __is_committed(change: Change, store) -> bool:
+    if change.kind == DELETED:
+        return store.get_state(change.item) is None
+    # States are compared without their metadata, so it is compared as well.
+    return (state_to_dict(store.get_state(change.item)) == state_to_dict(
+        change.new_state) and (change.moved_from is None
+                 or store.get_state(change.moved_from) is None))
+
+
+def __still_current(change: Change) -> bool:
+    """
+    Determines whether the item of a change still has the new state recorded in
+    the plan.
+    """
+    try:
+        stats = change.item_path.stat()
+    except FileNotFoundError:
+        return False
+    if change.new_state.matches_metadata(stats):
+        return True
+    # The metadata was not recorded (or has changed), so compare the content.
+    current = calculate_state(change.item_path, stats,
+                              change.new_state.hash_algorithm)
+    return not change.new_state.has_changed(current)
+
+
+def change_to_dict(change: Change) -> dict:
+    """
+    Converts a `Change` into a dictionary that can be written as JSON. It can
+    be converted back with `change_from_dict`.
+    """
+    return {
+        "kind": change.kind,
+        "item": change.item.as_posix(),
+        "moved_from": (change.moved_from.as_posix()
+                       if change.moved_from is not None else None),
+        "previous_state": state_to_dict(change.previous_state),
+        "new_state": state_to_dict(change.new_state),
+        "content_changed": change.content_changed
+    }
+
+
+def change_from_dict(entry: dict, states: StateRepository) -> Change:
+    """
+    Converts a dictionary written by `change_to_dict` back into a `Change` in
+    a repository.
+    """
+    return Change(repository_root=states.root_path,
+                  item=Path(entry["item"]),
+                  previous_state=state_from_dict(entry["previous_state"]),
+                  new_state=state_from_dict(entry["new_state"]),
+                  state_store=states.state_store,
+                  moved_from=(Path(entry["moved_from"])
+                              if entry["moved_from"] is not None else None),
+                  content_changed=entry.get("content_changed"))
+
+
+def state_to_dict(state: State) -> dict:
+    """
+    Converts a `State` into a dictionary that can be written as JSON. It can be
+    converted back with `state_from_dict`.
+    """
+    if state is None:
+        return None
+    return {
+        "size": state.size,
+        "content_hash": state.content_hash,
+        "mtime_ns": state.mtime_ns,
+        "inode": state.inode,
+        "device": state.device,
+        "hash_algorithm": state.hash_algorithm
+    }
+
+
+def state_from_dict(entry: dict) -> State:
+    """
+    Converts a dictionary written by `state_to_dict` back into a `State`.
+    """
+    if entry is None:
+        return None
+    return State(**entry)
@@ -0,0 +1,252 @@
+"""
+Restores the items of a backup from the bucket. The items to restore, and the
+objects that store their content, are read from the manifest (see
+`pyups.manifest`), so the bucket does not have to be listed.
+
+The content of each object is streamed from the bucket through decryption and
+decompression straight into the restored file, which is written next to its
+final location with a `.partial` suffix. Once the file has been written and its
+size and hash match the ones in the manifest, it is renamed into place.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import fnmatch
+import json
+import logging
+import os
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Tuple
+import boto3
+from botocore.config import Config
+from pyups import chunking, compression, encryption
+from pyups.configuration import Configuration
+from pyups.manifest import RemoteManifest
+from pyups.state import model
+from pyups.state.model import State
+
+BUFFER_SIZE = 65536 * 16
+
+"""
+The suffix of files that are still being restored.
+"""
+PARTIAL_SUFFIX = ".partial"
+
+
+class RestoreError(Exception):
+    """
+    Raised when the content of an item could not be restored correctly.
+    """
+
+
+def restore(destination: Path,
+            configuration: Configuration,
+            patterns: Iterable[str] = (),
+            workers: int = 16,
+            client=None) -> List[Tuple[Path, Exception]]:
+    """
+    Restores backed up items into a directory.
+
+    Parameters
+    ----------
+    destination
+        The directory that the items are restored into. It is created if it
+        does not exist.
+
+    configuration
+        The configuration of the backup, which determines the bucket and the
+        password that the content was encrypted with.
+
+    patterns
+        If given, only the items that match one of these are restored. A
+        pattern matches the items under a directory with that path, or the
+        items whose path matches it as a glob (e.g. `reports/*.csv`).
+
+    workers
+        The number of items that are downloaded concurrently.
+
+    client
+        The S3 client to restore with. If not given, a client is created with a
+        connection pool large enough for all of the `workers`.
+
+    Returns
+    -------
+    The items that could not be restored, together with the error for each.
+    """
+    if client is None:
+        client = boto3.client('s3',
+                              config=Config(max_pool_connections=workers))
+
+    items = RemoteManifest(
+        client=client,
+        bucket=configuration.s3_bucket,
+        encryption_password=configuration.encryption_password).read()
+    selected = select_items(items, patterns)
+    logging.info(f"Restoring {len(selected)} of {len(items)} items.")
+
+    restorer = _Restorer(client, configuration)
+    failures = []
+    for item in list(selected):
+        if item.is_absolute() or ".." in item.parts:
+            failures.append(
+                (item, RestoreError(f"{item} is outside of the destination")))
+            del selected[item]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(restorer.restore_item, destination.joinpath(item),
+                            state, key): item
+            for (item, (state, key)) in selected.items()
+        }
+        for future in as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                logging.error(f"Could not restore {futures[future]}: {error}")
+                failures.append((futures[future], error))
+    return failures
+
+
+def select_items(items: Dict[Path, Tuple[State, str]],
+                 patterns: Iterable[str]) -> Dict[Path, Tuple[State, str]]:
+    """
+    Selects the items that match any of the patterns (see `restore`). All of
+    the items are selected if there are no patterns.
+    """
+    patterns = [pattern.rstrip("/") for pattern in patterns]
+    if not patterns:
+        return dict(items)
+
+    def matches(item: Path) -> bool:
+        name = item.as_posix()
+        return any(
+            name == pattern or name.startswith(pattern + "/")
+            or fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    return {
+        item: entry
+        for (item, entry) in items.items() if matches(item)
+    }
+
+
+class _Restorer:
+    """
+    Restores the content of items from their objects in the bucket. It may be
+    used from several threads at once.
+    """
+    def __init__(self, client, configuration: Configuration):
+        self.__client = client
+        self.__bucket = configuration.s3_bucket
+        self.__password = configuration.encryption_password
+
+    def restore_item(self, path: Path, state: State, key: str) -> None:
+        """
+        Restores the content of an item to a file.
+
+        Raises
+        ------
+        RestoreError
+            If the restored content does not have the size and hash recorded
+            for the item. The file is then left as it was.
+        """
+        partial = path.with_name(path.name + PARTIAL_SUFFIX)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with partial.open(mode="wb") as output:
+                target = _HashingWriter(output, state.hash_algorithm)
+                self.__download(key, target)
+            if (target.size, target.hexdigest()) != (state.size,
+                                                     state.content_hash):
+                raise RestoreError(
+                    f"Restored content of {path} does not match its backup "
+                    f"(size {target.size}, hash {target.hexdigest()})")
+            os.replace(partial, path)
+        except BaseException:
+            if partial.exists():
+                partial.unlink()
+            raise
+        logging.info(f"Restored {path}.")
+
+    def __download(self, key: str, target: "_HashingWriter") -> None:
+        """
+        Writes the original content stored in an object to `target`. If the
+        object is a recipe, the content of each of its chunks is written in
+        turn.
+        """
+        response = self.__client.get_object(Bucket=self.__bucket, Key=key)
+        metadata = response.get('Metadata', {})
+        if metadata.get(chunking.FORMAT_METADATA) == chunking.RECIPE_FORMAT:
+            recipe = _BufferWriter()
+            self.__write_content(response, recipe)
+            for (chunk_hash, _) in json.loads(recipe.content)["chunks"]:
+                self.__download(f"chunks/{chunk_hash}", target)
+        else:
+            self.__write_content(response, target)
+
+    def __write_content(self, response: dict, target) -> None:
+        codec = response.get('Metadata', {}).get(compression.CODEC_METADATA)
+        if codec is not None:
+            target = _DecompressingWriter(target, codec)
+
+        body = response['Body']
+        if self.__password:
+            encryption.decrypt_stream(body, target, self.__password,
+                                      response['ContentLength'])
+        else:
+            content = body.read(BUFFER_SIZE)
+            while content:
+                target.write(content)
+                content = body.read(BUFFER_SIZE)
+
+        if codec is not None:
+            target.finish()
+
+
+class _HashingWriter:
+    """
+    Writes content to a file, while hashing it with an algorithm (see
+    `pyups.state.model.HASH_ALGORITHMS`) and counting its size.
+    """
+    def __init__(self, output: BinaryIO, hash_algorithm: str):
+        self.__output = output
+        self.__hash = model.hasher(hash_algorithm)
+        self.size = 0
+
+    def write(self, content: bytes) -> int:
+        self.__hash.update(content)
+        self.size += len(content)
+        return self.__output.write(content)
+
+    def hexdigest(self) -> str:
+        return self.__hash.hexdigest()
+
+
+class _DecompressingWriter:
+    """
+    Decompresses content as it is written, writing the decompressed content to
+    another writer.
+    """
+    def __init__(self, target, codec: str):
+        self.__target = target
+        self.__decompressor = compression.decompressor(codec)
+
+    def write(self, content: bytes) -> int:
+        self.__target.write(self.__decompressor.decompress(content))
+        return len(content)
+
+    def finish(self) -> None:
+        self.__target.write(self.__decompressor.flush())
+
+
+class _BufferWriter:
+    """
+    Collects content that is written to it in memory. Used for recipes, which
+    are small.
+    """
+    def __init__(self):
+        self.__parts = []
+
+    def write(self, content: bytes) -> int:
+        self.__parts.append(bytes(content))
+        return len(content)
+
+    @property
+    def content(self) -> bytes:
+        return b"".join(self.__parts)
@@ -0,0 +1,199 @@
+"""
+Rules that exclude items from the repository, written like the patterns of a
+`.gitignore` file:
+
+- Blank lines, and lines starting with `#`, are ignored.
+- `*` matches anything except `/`, `?` matches a single character except `/`
+  and `[...]` matches one of a range of characters.
+- A leading `**/` matches in any directory, a trailing `/**` matches everything
+  inside a directory and `/**/` matches zero or more directories.
+- A pattern with a `/` at its start or in its middle is relative to the root of
+  the repository. Otherwise, it matches a name at any depth.
+- A pattern ending with `/` only matches directories.
+- A pattern starting with `!` includes what an earlier pattern excluded. As with
+  git, an item cannot be included again if a directory above it is excluded,
+  because excluded directories are not walked at all.
+
+The last pattern that matches an item decides whether it is excluded.
+"""
+import hashlib
+from pathlib import Path
+import re
+from typing import Iterable, List, Tuple
+
+"""
+The name of the file, in the root of the repository, that lists patterns of
+items to exclude.
+"""
+IGNORE_FILE_NAME = ".pyupsignore"
+
+
+def read_ignore_file(repository_path: Path) -> List[str]:
+    """
+    Returns
+    -------
+    The lines of the repository's ignore file, or an empty list if it does not
+    have one.
+    """
+    try:
+        return repository_path.joinpath(IGNORE_FILE_NAME).read_text(
+            encoding="utf-8").splitlines()
+    except FileNotFoundError:
+        return []
+
+
+class IgnoreRules:
+    """
+    Decides which items are excluded by a list of patterns. The patterns are
+    compiled once: consecutive patterns of the same kind are combined into a
+    single regular expression, so that an item is matched against a few
+    expressions rather than against every pattern.
+    """
+    def __init__(self, patterns: Iterable[str] = ()):
+        patterns = list(patterns)
+        self.__fingerprint = hashlib.sha256(
+            bytes("\n".join(patterns), "utf-8")).hexdigest()
+        groups = []
+        for rule in (IgnoreRules.__parse(p) for p in patterns):
+            if rule is None:
+                continue
+            (negated, directory_only, expression) = rule
+            if groups and groups[-1][:2] == (negated, directory_only):
+                groups[-1][2].append(expression)
+            else:
+                groups.append((negated, directory_only, [expression]))
+        # The groups are tried from the last to the first, as the last match
+        # decides.
+        self.__groups = [(negated, directory_only,
+                          re.compile("|".join(f"(?:{e})"
+                                              for e in expressions)))
+                         for (negated, directory_only,
+                              expressions) in reversed(groups)]
+        # Whether each directory, or a directory above it, is excluded.
+        self.__excluded_directories = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.__groups)
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Returns
+        -------
+        A hash of the patterns, which changes if the patterns change.
+        """
+        return self.__fingerprint
+
+    def ignores(self, item: str, directory: bool = False) -> bool:
+        """
+        Determines whether an item is excluded by its own path, without taking
+        the directories above it into account (they are expected to have been
+        checked already, e.g. while walking the repository).
+
+        Parameters
+        ----------
+        item
+            The path of the item relative to the repository's root, with `/`
+            separating its parts.
+
+        directory
+            `True` if the item is a directory.
+        """
+        for (negated, directory_only, expression) in self.__groups:
+            if (directory or not directory_only) and expression.match(item):
+                return not negated
+        return False
+
+    def excludes(self, item: Path, directory: bool = False) -> bool:
+        """
+        Determines whether an item is excluded, either by its own path or
+        because a directory above it is excluded.
+
+        Parameters
+        ----------
+        item
+            The path of the item relative to the repository's root.
+
+        directory
+            `True` if the item is a directory.
+        """
+        if not self.__groups:
+            return False
+        parent = item.parent.as_posix()
+        return ((parent != "." and self.__excludes_directory(parent))
+                or self.ignores(item.as_posix(), directory))
+
+    def __excludes_directory(self, directory: str) -> bool:
+        excluded = self.__excluded_directories.get(directory)
+        if excluded is None:
+            (parent, _, _) = directory.rpartition("/")
+            excluded = ((parent != "" and self.__excludes_directory(parent))
+                        or self.ignores(directory, directory=True))
+            self.__excluded_directories[directory] = excluded
+        return excluded
+
+    @staticmethod
+    def __parse(pattern: str) -> Tuple[bool, bool, str]:
+        """
+        Translates a pattern into a regular expression.
+
+        Returns
+        -------
+        Whether the pattern includes (rather than excludes) what it matches,
+        whether it only matches directories, and the regular expression. If the
+        line has no pattern, `None` is returned instead.
+        """
+        if pattern.endswith("\\ "):
+            pattern = pattern[:-2].rstrip() + "\\ "
+        else:
+            pattern = pattern.rstrip()
+        if not pattern or pattern.startswith("#"):
+            return None
+
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        if not pattern:
+            return None
+
+        expression = "" if anchored else "(?:.*/)?"
+        i = 0
+        while i < len(pattern):
+            character = pattern[i]
+            if pattern.startswith("**", i) and (i == 0
+                                                or pattern[i - 1] == "/"):
+                if pattern.startswith("**/", i):
+                    # Zero or more directories.
+                    expression += "(?:.*/)?"
+                    i += 3
+                    continue
+                if i + 2 == len(pattern):
+                    # Everything inside a directory, or everything.
+                    expression += ".*"
+                    i += 2
+                    continue
+            if character == "*":
+                expression += "[^/]*"
+            elif character == "?":
+                expression += "[^/]"
+            elif character == "[":
+                end = pattern.find("]", i + 2)
+                if end < 0:
+                    expression += re.escape(character)
+                else:
+                    characters = pattern[i + 1:end]
+                    if characters.startswith("!"):
+                        characters = "^" + characters[1:]
+                    expression += "[" + characters.replace("\\", "\\\\") + "]"
+                    i = end
+            elif character == "\\" and i + 1 < len(pattern):
+                i += 1
+                expression += re.escape(pattern[i])
+            else:
+                expression += re.escape(character)
+            i += 1
+        return (negated, directory_only, expression + "$")
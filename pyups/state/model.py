@@ -1,16 +1,114 @@
 import hashlib
 import logging
+import os
+import threading
+import time
 from pathlib import Path
 from os import stat_result
+from typing import Iterable, List
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+"""
+The algorithms that the content of files may be hashed with. `BLAKE3` needs the
+`blake3` package and `XXH3` needs the `xxhash` package.
+"""
+SHA3_256 = "sha3_256"
+BLAKE2B = "blake2b"
+BLAKE3 = "blake3"
+XXH3 = "xxh3"
+HASH_ALGORITHMS = [SHA3_256, BLAKE2B, BLAKE3, XXH3]
+
+"""
+The algorithm that content is hashed with, unless another is configured. States
+that were stored before the algorithm was recorded were hashed with it.
+"""
+DEFAULT_HASH_ALGORITHM = SHA3_256
+
+"""
+The algorithms whose hashes can be relied on to identify content, e.g. as the
+keys of the content-addressed layout. `XXH3` is only fit for detecting changes,
+as content with the same hash can easily be made.
+"""
+CRYPTOGRAPHIC_HASH_ALGORITHMS = [SHA3_256, BLAKE2B, BLAKE3]
+
+
+def check_hash_algorithm(algorithm: str) -> None:
+    """
+    Checks that content can be hashed with an algorithm.
+
+    Raises
+    ------
+    ValueError
+        If the algorithm is unknown or the package that it needs is not
+        installed.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(
+            f"Unknown hash algorithm '{algorithm}'. Expected one of: "
+            f"{', '.join(HASH_ALGORITHMS)}")
+    if algorithm == BLAKE3 and blake3 is None:
+        raise ValueError(
+            "Hash algorithm 'blake3' needs the blake3 package to be installed")
+    if algorithm == XXH3 and xxhash is None:
+        raise ValueError(
+            "Hash algorithm 'xxh3' needs the xxhash package to be installed")
+
+
+def hasher(algorithm: str):
+    """
+    Returns
+    -------
+    A new hash object for an algorithm, with the `update` and `hexdigest`
+    methods of the ones in `hashlib`.
+    """
+    check_hash_algorithm(algorithm)
+    if algorithm == BLAKE2B:
+        # A 256 bit digest, so that hashes are as long as those of SHA3-256.
+        return hashlib.blake2b(digest_size=32)
+    if algorithm == BLAKE3:
+        return blake3.blake3()
+    if algorithm == XXH3:
+        return xxhash.xxh3_128()
+    return hashlib.sha3_256()
 
 
 class State:
     """
     Represents the state of an item or file at a point in time. 
+
+    The hash of the content is recorded together with the algorithm that
+    calculated it (see `HASH_ALGORITHMS`). Hashes calculated with different
+    algorithms cannot be compared, so states with different algorithms are
+    never equal.
+
+    Besides the size and hash of the content, the state may also record the
+    file's modification time, inode and device. These are optional and are only
+    used to determine whether the content may be assumed to be unchanged
+    without having to calculate its hash again (see `matches_metadata`). They
+    do not take part in comparisons between states.
     """
-    def __init__(self, size: int, content_hash: str):
+    def __init__(self,
+                 size: int,
+                 content_hash: str,
+                 mtime_ns: int = None,
+                 inode: int = None,
+                 device: int = None,
+                 hash_algorithm: str = DEFAULT_HASH_ALGORITHM):
         self.__size = size
         self.__content_hash = content_hash
+        self.__mtime_ns = mtime_ns
+        self.__inode = inode
+        self.__device = device
+        self.__hash_algorithm = hash_algorithm
 
     @property
     def size(self) -> int:
@@ -30,6 +128,68 @@ class State:
         """
         return self.__content_hash
 
+    @property
+    def hash_algorithm(self) -> str:
+        """
+        Returns
+        -------
+        The algorithm that `content_hash` was calculated with.
+        """
+        return self.__hash_algorithm
+
+    @property
+    def mtime_ns(self) -> int:
+        """
+        Returns
+        -------
+        The modification time of the file, in nanoseconds, or `None` if it was
+        not recorded.
+        """
+        return self.__mtime_ns
+
+    @property
+    def inode(self) -> int:
+        """
+        Returns
+        -------
+        The inode number of the file, or `None` if it was not recorded.
+        """
+        return self.__inode
+
+    @property
+    def device(self) -> int:
+        """
+        Returns
+        -------
+        The identifier of the device that the file resides on, or `None` if it
+        was not recorded.
+        """
+        return self.__device
+
+    def matches_metadata(self, stats: stat_result) -> bool:
+        """
+        Determines whether the file's metadata still matches what was recorded
+        in this state. If it does, the file's content is assumed to be
+        unchanged and does not need to be hashed again.
+
+        Parameters
+        ----------
+        stats
+            The result of calling `stat` on the file.
+
+        Returns
+        -------
+        `True` if the size, modification time and inode of the file are the
+        same as the ones recorded in this state. `False` if any of them differ
+        or if this state does not have the metadata recorded.
+        """
+        if self.__mtime_ns is None or self.__inode is None:
+            return False
+
+        return (self.__size == stats.st_size
+                and self.__mtime_ns == stats.st_mtime_ns
+                and self.__inode == stats.st_ino)
+
     def has_changed(self, other) -> bool:
         """
         Compares this `State` against another an instance to determine whether
@@ -50,16 +210,18 @@ class State:
             return True
 
         return (self.__size != other.size
-                or self.__content_hash != other.content_hash)
+                or self.__content_hash != other.content_hash
+                or self.__hash_algorithm != other.hash_algorithm)
 
     def __eq__(self, other) -> bool:
         if isinstance(other, self.__class__):
             return (self.size == other.size
-                    and self.content_hash == other.content_hash)
+                    and self.content_hash == other.content_hash
+                    and self.hash_algorithm == other.hash_algorithm)
         return NotImplemented
 
     def __hash__(self) -> int:
-        return hash((self.size, self.content_hash))
+        return hash((self.size, self.content_hash, self.hash_algorithm))
 
     def __str__(self) -> str:
         return f"State(size={self.size}, content_hash='{self.content_hash}')"
@@ -72,6 +234,10 @@ class Builder:
     def __init__(self):
         self.size = None
         self.content_hash = None
+        self.mtime_ns = None
+        self.inode = None
+        self.device = None
+        self.hash_algorithm = DEFAULT_HASH_ALGORITHM
 
     """
     Builds an instance of the `State` object based on the values currently 
@@ -87,24 +253,100 @@ class Builder:
         assert self.size is not None and type(self.size) is int
         assert self.content_hash is not None and type(self.content_hash) is str
 
-        return State(size=self.size, content_hash=self.content_hash)
+        return State(size=self.size,
+                     content_hash=self.content_hash,
+                     mtime_ns=self.mtime_ns,
+                     inode=self.inode,
+                     device=self.device,
+                     hash_algorithm=self.hash_algorithm)
 
 
 READ_SIZE = 65536 * 8
 
+"""
+While a file is hashed, the pages of the file that were hashed are released from
+the operating system's page cache every time this many bytes have been hashed
+(where `posix_fadvise` is available). Hashing every file of a large repository
+would otherwise evict the working sets of other applications from the cache.
+"""
+RELEASE_INTERVAL = 8 * 1024 * 1024
+
+"""
+Files modified within this many nanoseconds of their state being calculated
+do not have their modification time recorded. Some file systems only record
+modification times with a coarse granularity, so a file could be modified again
+without its modification time changing. Leaving out the modification time
+ensures that the content of such a file is hashed again the next time.
+"""
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+# The buffer that files are read into, one for each thread that hashes files.
+__buffers = threading.local()
 
-def __calculate_hash(path: Path) -> str:
-    calculator = hashlib.sha3_256()
-    with path.open('rb') as content:
-        chunk = content.read(READ_SIZE)
-        while chunk:
-            calculator.update(chunk)
-            chunk = content.read(READ_SIZE)
 
-    return calculator.hexdigest()
+def calculate_hashes(path: Path, algorithms: Iterable[str]) -> dict:
+    """
+    Hashes the content of a file with several algorithms, reading it once.
+
+    Files are read into a buffer that is reused for every file hashed by the
+    same thread, so no memory is allocated for their content. Files are not
+    memory mapped, since the process would be killed by `SIGBUS` if a mapped
+    file were truncated while it is hashed (e.g. when a log is rotated). The
+    file's pages are released from the page cache once they have been hashed.
+
+    Returns
+    -------
+    The hash of the content, by the algorithm.
+    """
+    calculators = [hasher(algorithm) for algorithm in algorithms]
+    with path.open('rb', buffering=0) as content:
+        descriptor = content.fileno()
+        __advise(descriptor, 0, 0, "POSIX_FADV_SEQUENTIAL")
+        __hash_read(content, calculators)
+        __advise(descriptor, 0, 0, "POSIX_FADV_DONTNEED")
 
+    return {
+        algorithm: calculator.hexdigest()
+        for (algorithm, calculator) in zip(algorithms, calculators)
+    }
 
-def calculate_state(path: Path) -> State:
+
+def __hash_read(content, calculators: list) -> None:
+    buffer = getattr(__buffers, "buffer", None)
+    if buffer is None:
+        buffer = bytearray(READ_SIZE)
+        __buffers.buffer = buffer
+
+    with memoryview(buffer) as view:
+        hashed = 0
+        released = 0
+        length = content.readinto(buffer)
+        while length:
+            for calculator in calculators:
+                calculator.update(view[:length])
+            hashed += length
+            if hashed - released >= RELEASE_INTERVAL:
+                __advise(content.fileno(), released, hashed - released,
+                         "POSIX_FADV_DONTNEED")
+                released = hashed
+            length = content.readinto(buffer)
+
+
+def __advise(descriptor: int, offset: int, length: int, advice: str) -> None:
+    """
+    Gives the operating system advice about how a file is accessed, if it
+    supports `posix_fadvise`. A `length` of 0 applies to the rest of the file.
+    """
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(descriptor, offset, length, getattr(os, advice))
+        except OSError as error:
+            logging.debug(f"Could not advise {advice}: {error}")
+
+
+def calculate_state(path: Path,
+                    stats: stat_result = None,
+                    hash_algorithm: str = DEFAULT_HASH_ALGORITHM) -> State:
     """
     Calculates the current state of the file at a given path.
 
@@ -113,11 +355,67 @@ def calculate_state(path: Path) -> State:
     path
         The state will be calculated for this file.
 
+    stats
+        The result of calling `stat` on the file, if it is already known. The
+        file is only `stat`-ed again if this is not given.
+
+    hash_algorithm
+        The algorithm to hash the file's content with.
+
     Returns
     -------
     The `State` information for the `path`.
     """
-    stats = path.stat()
-    file_hash = __calculate_hash(path)
-    logging.info(f"{path}, Size={stats.st_size}, Hash={file_hash}")
-    return State(stats.st_size, file_hash)
+    return calculate_states(path, [hash_algorithm], stats)[0]
+
+
+def calculate_states(path: Path,
+                     hash_algorithms: List[str],
+                     stats: stat_result = None) -> List[State]:
+    """
+    Calculates the current state of a file with each of several hash
+    algorithms, reading its content only once. This allows content to be
+    compared with a state that was hashed with another algorithm, while its
+    state with the new algorithm is calculated.
+
+    Returns
+    -------
+    The `State` of the file for each of the `hash_algorithms`, in the same
+    order.
+    """
+    if stats is None:
+        stats = path.stat()
+    hashes = calculate_hashes(path, hash_algorithms)
+    logging.info(f"{path}, Size={stats.st_size}, Hash={hashes[hash_algorithms[0]]}")
+
+    return [
+        state_from_stats(stats, hashes[algorithm], algorithm)
+        for algorithm in hash_algorithms
+    ]
+
+
+def state_from_stats(stats: stat_result,
+                     content_hash: str,
+                     hash_algorithm: str = DEFAULT_HASH_ALGORITHM) -> State:
+    """
+    Creates the state of a file from the result of `stat`-ing it and the hash
+    of its content. The modification time is left out if the file was modified
+    too recently to be trusted (see `RACY_WINDOW_NS`).
+
+    Parameters
+    ----------
+    content_hash
+        The hash of the file's content, or `None` if it has not been calculated
+        yet (see `StateRepository.changes`).
+    """
+    mtime_ns = stats.st_mtime_ns
+    if time.time_ns() - mtime_ns < RACY_WINDOW_NS:
+        logging.debug("File was modified too recently to trust its mtime")
+        mtime_ns = None
+
+    return State(size=stats.st_size,
+                 content_hash=content_hash,
+                 mtime_ns=mtime_ns,
+                 inode=stats.st_ino,
+                 device=stats.st_dev,
+                 hash_algorithm=hash_algorithm)
@@ -1,17 +1,33 @@
 from pathlib import Path
 import logging
+import os
+from os import stat_result
+from stat import S_ISDIR, S_ISREG
+from typing import Callable, Iterable, Iterator, List, Tuple
 from logging.config import fileConfig
 import sys
 import io
-import hashlib
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import pyups.configuration as configuration
-from pyups.state.model import State, calculate_state
+from pyups.state.ignore import IgnoreRules, read_ignore_file
+from pyups.state.model import (DEFAULT_HASH_ALGORITHM, RACY_WINDOW_NS, State,
+                               calculate_hashes, calculate_states,
+                               check_hash_algorithm, state_from_stats)
 from pyups.state.store import StateStore
+from pyups.stats import RunStats
 
-READ_SIZE = 65536 * 8
+"""
+By default, committed changes are written to the state store in groups of this
+many items, or at least this often (in seconds). See `StateStore`.
+"""
+COMMIT_BATCH_SIZE = 1000
+COMMIT_INTERVAL = 5.0
 
 
-def calculate_hash(path: Path) -> str:
+def calculate_hash(path: Path,
+                   hash_algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
     """
     Calculates a hash of the contents of the file, which may be used to detect
     when the contents of the file has changed.
@@ -20,35 +36,46 @@ def calculate_hash(path: Path) -> str:
     ----------
     path
         The path to the file. The hash will be calcualted for this file.
+
+    hash_algorithm
+        The algorithm to hash the contents with.
     
     Returns
     -------
     The calculated hash of the file's contents.
     """
+    return calculate_hashes(path, [hash_algorithm])[hash_algorithm]
 
-    calculator = hashlib.sha1()
-    with path.open('rb') as content:
-        chunk = content.read(READ_SIZE)
-        while chunk:
-            calculator.update(chunk)
-            chunk = content.read(READ_SIZE)
 
-    return calculator.hexdigest()
+"""
+The kinds of `Change`. See `Change.kind`.
+"""
+NEW = "new"
+MODIFIED = "modified"
+DELETED = "deleted"
+MOVED = "moved"
 
 
 class Change:
     """
     Describes the difference in the `State` of an item in the `Repository`.
     """
-    def __init__(self, repository_root: Path, item: Path,
-                 previous_state: State, new_state: State,
-                 state_store: StateStore):
+    def __init__(self,
+                 repository_root: Path,
+                 item: Path,
+                 previous_state: State,
+                 new_state: State,
+                 state_store: StateStore,
+                 moved_from: Path = None,
+                 content_changed: bool = None):
 
         self.__repository_root = repository_root
         self.__item = item
         self.__previous_state = previous_state
         self.__new_state = new_state
         self.__state_store = state_store
+        self.__moved_from = moved_from
+        self.__content_changed = content_changed
 
     @property
     def item(self):
@@ -88,27 +115,161 @@ class Change:
         """
         return self.__new_state
 
+    @property
+    def moved_from(self):
+        """
+        Returns
+        -------
+        If the item was moved (or renamed), this is the item that it was moved
+        from. The `previous_state` is then the state of that item. Otherwise,
+        this is `None`.
+        """
+        return self.__moved_from
+
+    def with_new_state(self, new_state: State) -> "Change":
+        """
+        Returns
+        -------
+        A copy of the change with another new state, e.g. with the hash of
+        content that was hashed after the change was found (see
+        `StateRepository.changes`).
+        """
+        return Change(repository_root=self.__repository_root,
+                      item=self.__item,
+                      previous_state=self.__previous_state,
+                      new_state=new_state,
+                      state_store=self.__state_store,
+                      moved_from=self.__moved_from,
+                      content_changed=self.__content_changed)
+
+    @property
+    def content_changed(self) -> bool:
+        """
+        Returns
+        -------
+        `True` if the content of the item is different from the content it had
+        in its `previous_state` (or if it had no previous state). The states
+        cannot tell if their hashes were calculated with different algorithms,
+        so the repository then records whether the content changed when it
+        finds the change.
+        """
+        if self.__content_changed is not None:
+            return self.__content_changed
+        if self.__previous_state is None or self.__new_state is None:
+            return True
+        return self.__previous_state.has_changed(self.__new_state)
+
+    @property
+    def kind(self) -> str:
+        """
+        Returns
+        -------
+        The kind of change: `NEW`, `MODIFIED`, `DELETED` or `MOVED`.
+        """
+        if self.__moved_from is not None:
+            return MOVED
+        elif self.__new_state is None:
+            return DELETED
+        elif self.__previous_state is None:
+            return NEW
+        return MODIFIED
+
     def commit(self) -> None:
         """
         Commits the change represented in this `Change` to the repository. Once
         committed, the `Repository.changes()` will no longer provide the item
-        as a `Change` unless another change is made to the item.
+        as a `Change` unless another change is made to the item. Committing a
+        move also removes the item that it was moved from.
         """
-        self.__state_store.store_state(item=self.__item,
-                                       state=self.__new_state)
+        states = [(self.__item, self.__new_state)]
+        if self.__moved_from is not None:
+            states.insert(0, (self.__moved_from, None))
+        self.__state_store.store_states(states)
 
 
 class StateRepository:
     """
     Representation of the state of files in a directory. Provides facilities to
     look for files that have changed since their state was last stored.
+
+    The contents of files are hashed by a pool of `hash_workers` threads. The
+    changes are still provided in the order that the files are found.
+
+    Contents are hashed with `hash_algorithm`. When a file whose stored state
+    was hashed with another algorithm is hashed again, it is hashed with both in
+    the same pass, so that the new state can be stored without the content
+    being considered changed. Files are therefore moved to a new algorithm as
+    they are hashed, rather than all at once.
+
+    By default, a file whose size, modification time and inode still match the
+    ones in its stored state is assumed to be unchanged and its contents are not
+    hashed again. In *paranoid* mode, the contents of every file is hashed
+    regardless.
+
+    Items that match the repository's ignore rules (`ignore_patterns`, followed
+    by the lines of its `.pyupsignore` file, see `pyups.state.ignore`) are not
+    looked at. Excluded directories are not walked at all. Stored items that
+    have become excluded are kept, or reported as deleted, depending on the
+    `excluded_items` policy (see `pyups.configuration.EXCLUDED_POLICIES`).
+
+    If `skip_unchanged_directories` is `True`, the modification time of each
+    directory that is listed is recorded in the store. A directory whose
+    modification time has not changed since is not listed again: its files are
+    taken from the store instead, and each of them is still checked as above.
+    Its subdirectories are still checked in turn. A directory's modification
+    time only changes when entries are added to it, removed from it or renamed
+    in it, so this only saves listing it, not looking at its files.
+
+    The time spent walking the repository and hashing files, as well as the
+    number of files and bytes hashed, are recorded in `stats`.
+
+    Committed changes are written to the state store in groups of
+    `commit_batch_size` items, or every `commit_interval` seconds, rather than
+    one at a time. The pending group is written when `close` is called, so the
+    repository should always be closed once it is no longer used.
     """
     def __init__(self,
                  root_path: Path,
-                 data_directory_name: str = configuration.DATA_PATH):
+                 data_directory_name: str = configuration.DATA_PATH,
+                 paranoid: bool = False,
+                 hash_workers: int = 1,
+                 stats: RunStats = None,
+                 commit_batch_size: int = COMMIT_BATCH_SIZE,
+                 commit_interval: float = COMMIT_INTERVAL,
+                 hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+                 ignore_patterns: Iterable[str] = (),
+                 excluded_items: str = configuration.EXCLUDED_KEEP,
+                 skip_unchanged_directories: bool = False):
+        check_hash_algorithm(hash_algorithm)
+        if excluded_items not in configuration.EXCLUDED_POLICIES:
+            raise ValueError(
+                f"Unknown policy for excluded items '{excluded_items}'")
         self.__root_path = root_path
         self.__data_path = root_path.joinpath(data_directory_name)
-        self.__state_store = StateStore(self.__data_path)
+        self.__data_item = Path(data_directory_name).as_posix()
+        self.__state_store = StateStore(self.__data_path,
+                                        batch_size=commit_batch_size,
+                                        batch_interval=commit_interval)
+        self.__paranoid = paranoid
+        self.__skipped = 0
+        self.__hash_workers = hash_workers
+        self.__pending_limit = hash_workers * 4
+        self.__stats = stats if stats is not None else RunStats()
+        self.__hash_algorithm = hash_algorithm
+        self.__ignore_rules = IgnoreRules(
+            list(ignore_patterns) + read_ignore_file(root_path))
+        self.__delete_excluded = (
+            excluded_items == configuration.EXCLUDED_DELETE)
+        self.__skip_directories = skip_unchanged_directories
+        # The result of `stat` on each directory checked by the current call
+        # of `changes`, and what was recorded about it in the store.
+        self.__directories = {}
+        # Whether the entries of each directory checked by the current call of
+        # `changes` can be taken from the store.
+        self.__reusable = {}
+        # The directories listed by the current call of `changes`, with their
+        # modification times, numbers of entries and subdirectories.
+        self.__listed_directories = {}
 
     @property
     def root_path(self) -> Path:
@@ -121,6 +282,97 @@ class StateRepository:
         """
         return self.__root_path
 
+    @property
+    def state_store(self) -> StateStore:
+        """
+        Returns
+        -------
+        The store where the states of the items in the repository are kept.
+        """
+        return self.__state_store
+
+    @property
+    def paranoid(self) -> bool:
+        """
+        Returns
+        -------
+        `True` if the contents of every file is hashed when looking for
+        changes, even if its metadata indicates that it has not changed.
+        """
+        return self.__paranoid
+
+    @property
+    def hash_workers(self) -> int:
+        """
+        Returns
+        -------
+        The number of threads that hash the contents of files while looking for
+        changes.
+        """
+        return self.__hash_workers
+
+    @property
+    def hash_algorithm(self) -> str:
+        """
+        Returns
+        -------
+        The algorithm that the contents of files are hashed with.
+        """
+        return self.__hash_algorithm
+
+    @property
+    def ignore_rules(self) -> IgnoreRules:
+        """
+        Returns
+        -------
+        The rules that exclude items from the repository.
+        """
+        return self.__ignore_rules
+
+    def deletes_excluded(self, item: Path) -> bool:
+        """
+        Determines whether a stored item is reported as deleted because the
+        ignore rules exclude it, even if its file still exists.
+        """
+        return self.__delete_excluded and self.__ignore_rules.excludes(item)
+
+    def forget_directory(self, directory: Path) -> None:
+        """
+        Forgets that a directory was listed, so that it is listed again (and
+        its files checked) by the next call of `changes`. This should be done
+        when a change to one of its files could not be committed, as the
+        change would otherwise not be found again while the directory is
+        unchanged.
+        """
+        self.__listed_directories.pop(directory, None)
+        self.__state_store.remove_directories([directory])
+
+    @property
+    def skipped(self) -> int:
+        """
+        Returns
+        -------
+        The number of files that were not hashed by `changes()`, because their
+        metadata matched their stored state.
+        """
+        return self.__skipped
+
+    @property
+    def stats(self) -> RunStats:
+        """
+        Returns
+        -------
+        The statistics that the repository records its work in.
+        """
+        return self.__stats
+
+    def close(self) -> None:
+        """
+        Writes the changes that are still pending and releases the resources
+        held by the repository's state store.
+        """
+        self.__state_store.close()
+
     def content_paths(self) -> Path:
         """
         Locates items in the repository. It searches for items in the 
@@ -131,66 +383,490 @@ class StateRepository:
         ------
         A *full filesystem* path to an item in the repository.
         """
-        for path in self.__content_paths(path=self.__root_path):
+        for (path, _, _) in self.__content_entries():
             yield path
 
-    def __content_paths(self, path: Path) -> Path:
-        if path:
-            for entry in path.iterdir():
-                if entry.is_dir() and not self.__is_data_path(test_path=entry):
-                    for subentry in self.__content_paths(path=entry):
-                        yield subentry
+    def __content_entries(
+            self,
+            paths: List[Path] = None
+    ) -> Iterator[Tuple[Path, Path, stat_result]]:
+        """
+        Walks the repository with `os.scandir`, so that the type of each entry
+        is known without having to `stat` it separately. The data directory is
+        identified by its name in the root directory, as well as by its device
+        and inode in case it is also reachable through another path.
+
+        Parameters
+        ----------
+        paths
+            If given, only these paths (relative to the repository's root) are
+            walked instead of the whole repository. See `changes`.
+
+        Yields
+        ------
+        For each item, its *full filesystem* path, its path relative to the
+        repository's root and the result of `stat` on it.
+        """
+        try:
+            data_stats = os.stat(self.__data_path)
+            data_directory = (data_stats.st_dev, data_stats.st_ino)
+        except FileNotFoundError:
+            data_directory = None
+
+        if paths is None:
+            yield from self.__scan(directory=os.fspath(self.__root_path),
+                                   relative="",
+                                   data_directory=data_directory)
+            return
+
+        for item in paths:
+            path = self.__root_path.joinpath(item)
+            name = item.as_posix()
+            if name == self.__data_item or name.startswith(self.__data_item +
+                                                           "/"):
+                continue
+            try:
+                stats = os.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if S_ISDIR(stats.st_mode):
+                if ((stats.st_dev, stats.st_ino) != data_directory
+                        and not self.__ignore_rules.excludes(item,
+                                                             directory=True)):
+                    yield from self.__scan(directory=os.fspath(path),
+                                           relative=name + "/",
+                                           data_directory=data_directory)
+            elif S_ISREG(stats.st_mode):
+                if not self.__ignore_rules.excludes(item):
+                    yield (path, item, stats)
+
+    def __scan(
+            self, directory: str, relative: str,
+            data_directory: tuple) -> Iterator[Tuple[Path, Path, stat_result]]:
+        """
+        Walks a directory. If directories are skipped while unchanged (see
+        `StateRepository`), the files of an unchanged directory are taken from
+        the store instead of listing it.
+        """
+        listed = None
+        if self.__skip_directories:
+            listed = Path(relative) if relative else Path(".")
+            if self.__directory_state(listed) is None:
+                return
+            reused = self.__reused_entries(listed)
+            if reused is not None:
+                yield from self.__reuse(reused, data_directory)
+                return
+
+        rules = self.__ignore_rules
+        entry_count = 0
+        subdirectories = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                item = relative + entry.name
+                if entry.is_dir():
+                    if self.__is_data_path(entry, item, data_directory):
+                        continue
+                    if rules and rules.ignores(item, directory=True):
+                        logging.debug(f"Skipping excluded directory {item}")
+                        self.__stats.count("directories_excluded")
+                        continue
+                    entry_count += 1
+                    subdirectories.add(Path(item))
+                    yield from self.__scan(directory=entry.path,
+                                           relative=item + "/",
+                                           data_directory=data_directory)
                 elif entry.is_file():
-                    yield entry
+                    if rules and rules.ignores(item):
+                        self.__stats.count("files_excluded")
+                        continue
+                    entry_count += 1
+                    yield (Path(entry.path), Path(item), entry.stat())
+
+        if listed is not None:
+            (stats, _, checked_ns) = self.__directory_state(listed)
+            mtime_ns = stats.st_mtime_ns
+            if checked_ns - mtime_ns < RACY_WINDOW_NS:
+                # Entries may have been added without changing it.
+                mtime_ns = None
+            self.__listed_directories[listed] = (mtime_ns, entry_count,
+                                                 subdirectories)
+
+    def __directory_state(self, directory: Path) -> Tuple[stat_result, tuple]:
+        """
+        Returns
+        -------
+        The result of `stat` on a directory, taken the first time that it is
+        checked by the current call of `changes` (i.e. before it is listed),
+        what was recorded about it in the store and the time it was checked.
+        `None` is returned if it is not a directory.
+        """
+        if directory not in self.__directories:
+            checked_ns = time.time_ns()
+            try:
+                stats = os.stat(self.__root_path.joinpath(directory))
+            except (FileNotFoundError, NotADirectoryError):
+                stats = None
+            self.__directories[directory] = None
+            if stats is not None and S_ISDIR(stats.st_mode):
+                self.__directories[directory] = (
+                    stats, self.__state_store.get_directory(directory),
+                    checked_ns)
+        return self.__directories[directory]
+
+    def __is_reusable(self, directory: Path) -> bool:
+        """
+        Determines whether the entries of a directory can be taken from the
+        store: it must have the same modification time, and be listed with the
+        same ignore rules, as when it was last listed, and the store must have
+        all of its entries (which it does not e.g. if a new file in it could
+        not be backed up).
+        """
+        if directory not in self.__reusable:
+            self.__reusable[directory] = self.__entries(directory) is not None
+        return self.__reusable[directory]
+
+    def __reused_entries(self, directory: Path) -> tuple:
+        """
+        Returns
+        -------
+        The files in a directory whose entries can be taken from the store
+        (see `__is_reusable`), with their stored states, and its
+        subdirectories. `None` is returned if it must be listed instead.
+        """
+        if self.__reusable.get(directory) is False:
+            return None
+        entries = self.__entries(directory)
+        self.__reusable[directory] = entries is not None
+        return entries
+
+    def __entries(self, directory: Path) -> tuple:
+        """
+        Returns
+        -------
+        The entries of a directory from the store (see `__reused_entries`), or
+        `None` if they cannot be taken from it.
+        """
+        state = self.__directory_state(directory)
+        if state is None or state[1] is None:
+            return None
+        (stats, (mtime_ns, entry_count, ignore_rules), _) = state
+        if (mtime_ns != stats.st_mtime_ns
+                or ignore_rules != self.__ignore_rules.fingerprint):
+            return None
+        files = self.__state_store.child_states(directory)
+        subdirectories = self.__state_store.child_directories(directory)
+        if len(files) + len(subdirectories) != entry_count:
+            return None
+        return (files, subdirectories)
+
+    def __reuse(
+            self, reused: tuple,
+            data_directory: tuple) -> Iterator[Tuple[Path, Path, stat_result]]:
+        (files, subdirectories) = reused
+        self.__stats.count("directories_reused")
+        for (item, _) in files:
+            path = self.__root_path.joinpath(item)
+            try:
+                stats = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield (path, item, stats)
+        for subdirectory in subdirectories:
+            path = self.__root_path.joinpath(subdirectory)
+            yield from self.__scan(directory=os.fspath(path),
+                                   relative=subdirectory.as_posix() + "/",
+                                   data_directory=data_directory)
+
+    def __record_directories(self) -> None:
+        """
+        Records the directories listed by the current call of `changes`. The
+        subdirectories that they no longer have are forgotten.
+        """
+        store = self.__state_store
+        removed = []
+        for (directory, (_, _, subdirectories)) in (
+                self.__listed_directories.items()):
+            removed += [
+                subdirectory
+                for subdirectory in store.child_directories(directory)
+                if subdirectory not in subdirectories
+            ]
+        store.remove_directories(removed, subtrees=True)
+        fingerprint = self.__ignore_rules.fingerprint
+        store.store_directories(
+            (directory, mtime_ns, entry_count, fingerprint)
+            for (directory, (mtime_ns, entry_count,
+                             _)) in self.__listed_directories.items())
+
+    def __is_data_path(self, entry: os.DirEntry, item: str,
+                       data_directory: tuple) -> bool:
+        if item == self.__data_item:
+            return True
+        if data_directory is None:
+            return False
+        # The inode of an entry is known without a system call (on POSIX), so
+        # a directory is only `stat`ed if it may be the data directory. A
+        # link's inode is not the inode of the directory that it links to.
+        if not entry.is_symlink() and entry.inode() != data_directory[1]:
+            return False
+        stats = entry.stat()
+        return (stats.st_dev, stats.st_ino) == data_directory
+
+    @staticmethod
+    def __known_to_differ(stored_state: State, stats: stat_result,
+                          deleted_sizes: set) -> bool:
+        """
+        Determines whether the content of a file is known to be different from
+        its stored state, without hashing it. A new file must not have the
+        size of a deleted item, which it could have been moved from.
+        """
+        if stored_state is None:
+            return stats.st_size not in deleted_sizes
+        return stats.st_size != stored_state.size
+
+    @staticmethod
+    def __metadata(state: State) -> tuple:
+        return (state.mtime_ns, state.inode, state.device)
+
+    def __change(self, deleted: dict, item: Path, stored_state: State,
+                 calculation: Future) -> Change:
+        """
+        Waits for the state of an item on the file system to be calculated and
+        compares it against the item's stored state.
+
+        Parameters
+        ----------
+        deleted
+            Items that have been deleted from the repository, by their size and
+            content hash. A new item with the same size and content hash as a
+            deleted item is considered to have been moved from it. The deleted
+            item is then removed from `deleted`.
+
+        Returns
+        -------
+        The `Change` for the item, or `None` if the item has not changed.
+        """
+        (state_on_system, comparable_state) = calculation.result()
+
+        if stored_state is None:
+            candidates = deleted.get(
+                (state_on_system.size, state_on_system.content_hash))
+            if candidates:
+                (moved_from, previous_state) = candidates.pop()
+                logging.debug(f"{item} was moved from {moved_from}.")
+                return Change(repository_root=self.__root_path,
+                              item=item,
+                              previous_state=previous_state,
+                              new_state=state_on_system,
+                              state_store=self.__state_store,
+                              moved_from=moved_from)
 
-    def __is_data_path(self, test_path: Path) -> bool:
-        result = False
-        if self.__data_path.exists():
-            result = test_path.samefile(self.__data_path)
-        return result
+            # The entry has not yet been stored in the state.
+            logging.debug(f"No state available for path. {item} is new.")
+        elif stored_state.has_changed(other=comparable_state):
+            logging.debug(f"State of file {item} has changed")
+        elif (StateRepository.__metadata(stored_state) !=
+              StateRepository.__metadata(state_on_system)
+              or stored_state.hash_algorithm !=
+              state_on_system.hash_algorithm):
+            logging.debug(f"Metadata of file {item} has changed")
+        else:
+            return None
 
-    def changes(self) -> Change:
+        return Change(repository_root=self.__root_path,
+                      item=item,
+                      previous_state=stored_state,
+                      new_state=state_on_system,
+                      state_store=self.__state_store,
+                      content_changed=(stored_state is None or
+                                       stored_state.has_changed(
+                                           other=comparable_state)))
+
+    def changes(self,
+                defer_hash: Callable[[stat_result], bool] = None,
+                paths: Iterable[Path] = None) -> Change:
         """
         Finds items that have changed in the repository.
 
+        Parameters
+        ----------
+        paths
+            If given, only these paths (relative to the repository's root) are
+            looked at, e.g. because they are known to have changed. A path may
+            be a file or a directory, which is then walked. Stored items at (or
+            under) a path that no longer exists are deleted. Items elsewhere are
+            assumed to be unchanged, so moves are only detected between the
+            given paths.
+
+        defer_hash
+            If given, files whose content is known to have changed without
+            being hashed are not hashed if this returns `True` for them (given
+            the result of `stat`-ing the file). The content of a file is known
+            to have changed if its size is different from its stored state's,
+            or if it is new and no deleted item has the same size (so it cannot
+            have been moved). The new state of such a change has no
+            `content_hash`. It is expected to be calculated while the content
+            is read for another reason (e.g. to upload it), and set with
+            `Change.with_new_state` before the change is committed.
+
         Yields
         -----
-        A `Change` in the repository.
+        A `Change` in the repository. A `Change` is also provided for files
+        whose contents is the same, but whose metadata has changed, so that the
+        updated metadata can be committed. A new item with the same size and
+        content as a deleted item is provided as a single `MOVED` change,
+        instead of separate changes for the new and deleted items.
         """
-        for entry in self.content_paths():
-            logging.debug(f"Checking path: {entry}")
-            relativized = entry.relative_to(self.__root_path)
-            stored_state = self.__state_store.get_state(relativized)
-            state_on_system = calculate_state(path=entry)
+        self.__skipped = 0
+        self.__directories = {}
+        self.__reusable = {}
+        self.__listed_directories = {}
+        self.__state_store.flush()
+        if paths is not None:
+            paths = StateRepository.__outermost(paths)
+        deleted = self.__deleted_items(paths)
+        deleted_sizes = {size for (size, _) in deleted}
+        with ThreadPoolExecutor(max_workers=self.__hash_workers) as executor:
+            # Hashes that are still being calculated, in the order that their
+            # files were found. At most `__pending_limit` are kept, so the walk
+            # does not get too far ahead of the hashing.
+            pending = deque()
+            for (entry, relativized, stats) in self.__stats.timed(
+                    "walk", self.__content_entries(paths)):
+                logging.debug(f"Checking path: {entry}")
+                self.__stats.count("files_scanned")
+                stored_state = self.__state_store.get_state(relativized)
 
-            if stored_state is None:
-                # The entry has not yet been stored in the state.
-                logging.debug(f"No state available for path. {entry} is new.")
-                yield Change(repository_root=self.__root_path,
-                             item=relativized,
-                             previous_state=None,
-                             new_state=state_on_system,
-                             state_store=self.__state_store)
-            else:
-                if stored_state.has_changed(other=state_on_system):
-                    logging.debug(f"State of file {entry} has changed")
-                    item_state = calculate_state(entry)
-                    yield Change(repository_root=self.__root_path,
-                                 item=relativized,
-                                 previous_state=stored_state,
-                                 new_state=item_state,
-                                 state_store=self.__state_store)
-
-        # Search for items in the store that have been deleted. Since the above
-        # loop has handled the case where the item still exists but has been
-        # modified, this only has to handle the case where items have been
-        # deleted from the repository.
-        for entry in self.__state_store.stored_items():
-            item_path = self.__root_path.joinpath(entry)
-            if not item_path.exists():
-                stored_state = self.__state_store.get_state(entry)
+                if (stored_state is not None and not self.__paranoid
+                        and stored_state.matches_metadata(stats)):
+                    logging.debug(
+                        f"Metadata of {entry} unchanged, skipping hash")
+                    self.__skipped += 1
+                    self.__stats.count("metadata_cache_hits")
+                    continue
+
+                if (defer_hash is not None
+                        and StateRepository.__known_to_differ(
+                            stored_state, stats, deleted_sizes)
+                        and defer_hash(stats)):
+                    logging.debug(f"Content of {entry} changed, deferring hash")
+                    self.__stats.count("hashes_deferred")
+                    deferred = Future()
+                    deferred.set_result((state_from_stats(
+                        stats, None, self.__hash_algorithm), ) * 2)
+                    pending.append((relativized, stored_state, deferred))
+                else:
+                    pending.append(
+                        (relativized, stored_state,
+                         executor.submit(self.__calculate_state, entry, stats,
+                                         stored_state)))
+                # The changes whose states are known are yielded as soon as
+                # the ones found before them are, e.g. so that they can be
+                # uploaded while the walk goes on.
+                while pending and (len(pending) >= self.__pending_limit
+                                   or pending[0][2].done()):
+                    change = self.__change(deleted, *pending.popleft())
+                    if change:
+                        yield change
+
+            while pending:
+                change = self.__change(deleted, *pending.popleft())
+                if change:
+                    yield change
+
+        if self.__skip_directories:
+            self.__record_directories()
+
+        # The items that are left have been deleted, rather than moved.
+        for candidates in deleted.values():
+            for (entry, stored_state) in candidates:
                 yield Change(repository_root=self.__root_path,
                              item=entry,
                              previous_state=stored_state,
                              new_state=None,
                              state_store=self.__state_store)
+
+    def __calculate_state(self, path: Path, stats: stat_result,
+                          stored_state: State) -> Tuple[State, State]:
+        """
+        Calculates the state of a file.
+
+        Returns
+        -------
+        The state of the file, and its state with the hash algorithm of its
+        `stored_state`, so that the two can be compared. If the stored state
+        was hashed with the same algorithm (or there is none), both are the
+        same.
+        """
+        algorithms = [self.__hash_algorithm]
+        if (stored_state is not None
+                and stored_state.hash_algorithm != self.__hash_algorithm):
+            algorithms.append(stored_state.hash_algorithm)
+        with self.__stats.phase("hash"):
+            states = calculate_states(path, algorithms, stats)
+        self.__stats.count("files_hashed")
+        self.__stats.count("bytes_hashed", states[0].size)
+        return (states[0], states[-1])
+
+    @staticmethod
+    def __outermost(paths: Iterable[Path]) -> List[Path]:
+        """
+        Returns
+        -------
+        The paths, without the ones that are under another of the paths, or
+        `None` if the root of the repository is one of them.
+        """
+        paths = set(paths)
+        if Path(".") in paths:
+            return None
+        return sorted(path for path in paths
+                      if not any(parent in paths for parent in path.parents))
+
+    def __deleted_items(self, paths: List[Path] = None) -> dict:
+        """
+        Searches for items in the store that have been deleted from the
+        repository, or that are now excluded by the ignore rules if they are
+        to be deleted (see `deletes_excluded`). This is done before looking for
+        new items, so that new items can be matched against deleted ones to
+        detect moves.
+
+        Parameters
+        ----------
+        paths
+            If given, only the stored items at or under these paths are
+            searched.
+
+        Returns
+        -------
+        Lists of deleted items and their stored states, by their size and
+        content hash.
+        """
+        deleted = {}
+        for (entry, stored_state) in self.__stats.timed(
+                "find_deleted", self.__stored_states(paths)):
+            item_path = self.__root_path.joinpath(entry)
+            excluded = self.__ignore_rules.excludes(entry)
+            if excluded:
+                self.__stats.count("excluded_items")
+            # The items in an unchanged directory still exist, so they do not
+            # need to be checked.
+            exists = ((self.__skip_directories
+                       and self.__is_reusable(entry.parent))
+                      or item_path.exists())
+            if not exists or (excluded and self.__delete_excluded):
+                deleted.setdefault(
+                    (stored_state.size, stored_state.content_hash),
+                    []).append((entry, stored_state))
+        return deleted
+
+    def __stored_states(
+            self, paths: List[Path] = None) -> Iterator[Tuple[Path, State]]:
+        if paths is None:
+            yield from self.__state_store.stored_states()
+            return
+        for path in paths:
+            stored_state = self.__state_store.get_state(path)
+            if stored_state is not None:
+                yield (path, stored_state)
+            yield from self.__state_store.stored_states(directory=path)
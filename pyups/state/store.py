@@ -2,31 +2,131 @@ from pathlib import Path
 from pyups.state.model import State
 import pyups.state.model as state
 import logging
-import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, List, Tuple
 
 
 class StateStore:
     """
     Provides facilities for storing information about the state of files.
+
+    The states are kept in a single SQLite database, indexed by the item's path.
+    Earlier versions stored the state of each item in a separate file under the
+    `state` directory. If such a directory is found, its contents is migrated
+    into the database the first time the store is used.
+
+    States (and chunks and objects) may be committed in groups: they are kept in memory
+    until `batch_size` items are pending or `batch_interval` seconds have passed
+    since the first of them, and are then written in a single transaction. A
+    timer writes them once the interval has passed, even if nothing else is
+    stored (e.g. while a large file is uploaded).
+    After a crash, the database therefore holds either all or none of the
+    states of a group. Pending states are taken into account when the store is
+    read, and are written when the store is flushed or closed.
+    """
+    __DATABASE_NAME = "state.db"
+
+    __LEGACY_STORE_PATH = Path("state")
+
+    """
+    The number of items that `stored_items` reads from the database at a time.
     """
-    __STATE_STORE_PATH = Path("state")
+    __PAGE_SIZE = 1000
+
+    """
+    Statements that bring the database schema up to date. The database records
+    the number of statements that have already been applied to it (as its
+    `user_version`), so only the ones after that are applied when opening it.
+    """
+    __SCHEMA = [
+        """
+        CREATE TABLE states (
+            item TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            device INTEGER
+        )
+        """,
+        "CREATE INDEX states_content_hash ON states (content_hash)",
+        "CREATE TABLE objects (key TEXT PRIMARY KEY)",
+        """
+        CREATE TABLE chunks (
+            item TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            chunk_hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (item, position)
+        )
+        """,
+        "CREATE INDEX chunks_chunk_hash ON chunks (chunk_hash)",
+        "ALTER TABLE objects ADD COLUMN size INTEGER",
+        # States stored before the algorithm was recorded were all hashed with
+        # SHA3-256.
+        "ALTER TABLE states ADD COLUMN hash_algorithm TEXT NOT NULL "
+        "DEFAULT 'sha3_256'",
+        """
+        CREATE TABLE directories (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            entries INTEGER NOT NULL,
+            ignore_rules TEXT
+        )
+        """,
+    ]
 
     # TODO: Field renamed to content hash, need to allow the field name to be different.
-    __PARSERS = {"size": ("size", int), "hash": ("content_hash", lambda x: x)}
+    __PARSERS = {
+        "size": ("size", int),
+        "hash": ("content_hash", lambda x: x),
+        "mtime": ("mtime_ns", int),
+        "inode": ("inode", int),
+        "device": ("device", int)
+    }
 
-    def __init__(self, store_root: Path):
+    def __init__(self,
+                 store_root: Path,
+                 batch_size: int = 1,
+                 batch_interval: float = None):
         """
         Parameters
         ----------
         store_root
             The root directory where the states will be stored in the filesystem.
+
+        batch_size
+            The number of items whose states are written together. By default,
+            states are written as soon as they are stored.
+
+        batch_interval
+            If given, the longest time (in seconds) that states are kept in
+            memory before they are written.
         """
-        self.__store_path = store_root.joinpath(StateStore.__STATE_STORE_PATH)
+        self.__store_root = store_root
+        self.__database_path = store_root.joinpath(StateStore.__DATABASE_NAME)
+        self.__legacy_path = store_root.joinpath(
+            StateStore.__LEGACY_STORE_PATH)
+        self.__connection = None
+        self.__lock = threading.RLock()
+        self.__batch_size = batch_size
+        self.__batch_interval = batch_interval
+        # Writes that have not been flushed yet, in the order they were made,
+        # and the states and chunks that they will write, by item.
+        self.__pending = []
+        self.__pending_states = {}
+        self.__pending_chunks = {}
+        self.__pending_objects = {}
+        self.__batch_started = None
+        self.__timer = None
 
     def store_state(self, item: Path, state: State) -> None:
         """
         Stores the state of an item in the store.
-    
+
         Parameters
         ----------
         path
@@ -37,62 +137,531 @@ class StateStore:
             The state of the file. Set this to `None` if the entry should be
             deleted from the store instead.
         """
+        self.store_states([(item, state)])
+
+    def store_states(self, states: Iterable[Tuple[Path, State]]) -> None:
+        """
+        Stores the states of several items in a single transaction. Either all
+        of the states are stored or, if an error occurs, none of them are. With
+        group commits, they are written together with the rest of their group.
 
-        state_file = self.__store_path.joinpath(item)
+        Parameters
+        ----------
+        states
+            Pairs of an item (relative to the repository's root) and its state.
+            As with `store_state`, a state of `None` deletes the item from the
+            store.
+        """
+        with self.__lock:
+            for (item, state) in states:
+                key = item.as_posix()
+                self.__pending.append((StateStore.__write, item, state))
+                self.__pending_states[key] = state
+                if not state:
+                    self.__pending_chunks[key] = []
+            self.__flush_if_due()
+
+    def flush(self) -> None:
+        """
+        Writes the states and chunks that are pending in a single transaction.
+        """
+        with self.__lock:
+            if not self.__pending:
+                return
+            connection = self.__connect(create=True)
+            with connection:
+                for (write, item, value) in self.__pending:
+                    write(connection, item, value)
+            logging.debug(f"Committed {len(self.__pending)} pending writes.")
+            self.__pending = []
+            self.__pending_states = {}
+            self.__pending_chunks = {}
+            self.__pending_objects = {}
+            self.__batch_started = None
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+
+    def __flush_if_due(self) -> None:
+        if not self.__pending:
+            return
+        if self.__batch_started is None:
+            self.__batch_started = time.monotonic()
+            if self.__batch_interval is not None:
+                self.__timer = threading.Timer(self.__batch_interval,
+                                               self.__flush_expired)
+                self.__timer.daemon = True
+                self.__timer.start()
+        if len(self.__pending) >= self.__batch_size or (
+                self.__batch_interval is not None and time.monotonic() -
+                self.__batch_started >= self.__batch_interval):
+            self.flush()
+
+    def __flush_expired(self) -> None:
+        """
+        Writes the pending batch once `batch_interval` has passed since it was
+        started. If it cannot be written, it is kept for the next flush.
+        """
+        try:
+            self.flush()
+        except sqlite3.Error as error:
+            logging.warning(f"Could not commit pending writes: {error}")
+
+    @staticmethod
+    def __write(connection: sqlite3.Connection, item: Path,
+                state: State) -> None:
         if state:
-            state_file.parent.mkdir(parents=True, exist_ok=True)
-            with state_file.open(mode="wb") as entry:
-                content = [
-                    StateStore.__contentAsBytes(state, attribute)
-                    for attribute in StateStore.__PARSERS
-                ]
-                entry.writelines(content)
+            connection.execute(
+                "INSERT OR REPLACE INTO states (item, size, content_hash, "
+                "mtime_ns, inode, device, hash_algorithm) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (item.as_posix(), state.size, state.content_hash,
+                 state.mtime_ns, state.inode, state.device,
+                 state.hash_algorithm))
         else:
             logging.debug(f"Clearing state for {item}.")
-            if state_file.exists():
-                state_file.unlink()
+            connection.execute("DELETE FROM states WHERE item = ?",
+                               (item.as_posix(), ))
+            connection.execute("DELETE FROM chunks WHERE item = ?",
+                               (item.as_posix(), ))
 
     def stored_items(self) -> Path:
-        for item in self.__stored_items(self, from_item=Path(".")):
+        """
+        Yields items in the store, ordered by their path. The items are read
+        from the database a page at a time, so states may be stored while the
+        items are being iterated over.
+
+        Yields
+        ------
+        Items that have been previously stored in the store.
+        """
+        for (item, _) in self.stored_states():
             yield item
 
-    @staticmethod
-    def __stored_items(self, from_item: Path) -> Path:
+    def stored_states(self,
+                      directory: Path = None) -> Iterator[Tuple[Path, State]]:
         """
-        Yields items in the store.
+        Yields the items in the store together with their states, ordered by
+        the items' paths. As with `stored_items`, they are read a page at a
+        time.
 
         Parameters
         ----------
-        item
-            The search for items in the store will begin from this `item`. May 
-            be set to `None` if the entire store should be searched. If given,
-            the item is expected to be a directory.
-        
+        directory
+            If given, only the items under this directory are yielded.
+
         Yields
         ------
-        Items that have been previously stored in the store.
+        Pairs of an item and its stored state.
         """
-        path_in_store = self.__store_path.joinpath(from_item)
-
-        if path_in_store.exists() and path_in_store.is_dir():
-            for candidate in path_in_store.iterdir():
-                child_item = candidate.relative_to(self.__store_path)
-                if candidate.is_dir() and not (candidate.name == ".pyups"):
-                    for item in self.__stored_items(self=self,
-                                                    from_item=child_item):
-                        yield item
-                elif candidate.is_file():
-                    yield child_item
-        else:
-            logging.debug(
-                f"Store path {path_in_store} does not exist. Nothing to yield."
-            )
+        last = ""
+        end = None
+        if directory is not None:
+            # The items under a directory sort between its path followed by
+            # "/" and by "0", the character after "/".
+            last = directory.as_posix() + "/"
+            end = directory.as_posix() + "0"
+        while True:
+            with self.__lock:
+                self.flush()
+                connection = self.__connect(create=False)
+                if connection is None:
+                    logging.debug(
+                        f"Store {self.__database_path} does not exist. Nothing to yield."
+                    )
+                    return
+                page = connection.execute(
+                    "SELECT item, size, content_hash, mtime_ns, inode, device, "
+                    "hash_algorithm FROM states WHERE item > ? AND "
+                    "(? IS NULL OR item < ?) ORDER BY item LIMIT ?",
+                    (last, end, end, StateStore.__PAGE_SIZE)).fetchall()
+
+            for row in page:
+                yield (Path(row[0]), StateStore.__to_state(row[1:]))
+
+            if len(page) < StateStore.__PAGE_SIZE:
+                return
+            last = page[-1][0]
+
+    def is_referenced(self, content_hash: str) -> bool:
+        """
+        Determines whether any item in the store has content with the given
+        hash.
+        """
+        with self.__lock:
+            self.flush()
+            connection = self.__connect(create=False)
+            return connection is not None and connection.execute(
+                "SELECT 1 FROM states WHERE content_hash = ? LIMIT 1",
+                (content_hash, )).fetchone() is not None
+
+    def find_item(self, content_hash: str) -> Path:
+        """
+        Returns
+        -------
+        An item in the store whose content has the given hash, or `None` if
+        there is no such item.
+        """
+        with self.__lock:
+            self.flush()
+            connection = self.__connect(create=False)
+            row = None
+            if connection is not None:
+                row = connection.execute(
+                    "SELECT item FROM states WHERE content_hash = ? LIMIT 1",
+                    (content_hash, )).fetchone()
+        return Path(row[0]) if row else None
+
+    def get_chunks(self, item: Path) -> List[Tuple[str, int]]:
+        """
+        Obtains the chunks that the content of an item was split into.
+
+        Returns
+        -------
+        The hash and size of each chunk, in order. The list is empty if the
+        item was not split into chunks.
+        """
+        with self.__lock:
+            if item.as_posix() in self.__pending_chunks:
+                return list(self.__pending_chunks[item.as_posix()])
+            connection = self.__connect(create=False)
+            if connection is None:
+                return []
+            return [
+                tuple(row) for row in connection.execute(
+                    "SELECT chunk_hash, size FROM chunks WHERE item = ? "
+                    "ORDER BY position", (item.as_posix(), ))
+            ]
+
+    def store_chunks(self, item: Path, chunks: List[Tuple[str,
+                                                          int]]) -> None:
+        """
+        Stores the chunks that the content of an item was split into, replacing
+        any chunks that were previously stored for it. The chunks of an item
+        are also removed when its state is removed.
+
+        Parameters
+        ----------
+        item
+            The item, relative to the repository's root.
+
+        chunks
+            The hash and size of each chunk, in order.
+        """
+        with self.__lock:
+            chunks = list(chunks)
+            self.__pending.append((StateStore.__write_chunks, item, chunks))
+            self.__pending_chunks[item.as_posix()] = chunks
+            self.__flush_if_due()
+
+    @staticmethod
+    def __write_chunks(connection: sqlite3.Connection, item: Path,
+                       chunks: List[Tuple[str, int]]) -> None:
+        connection.execute("DELETE FROM chunks WHERE item = ?",
+                           (item.as_posix(), ))
+        connection.executemany(
+            "INSERT INTO chunks (item, position, chunk_hash, size) "
+            "VALUES (?, ?, ?, ?)",
+            [(item.as_posix(), position, chunk_hash, size)
+             for (position, (chunk_hash, size)) in enumerate(chunks)])
+
+    def is_chunk_referenced(self, chunk_hash: str) -> bool:
+        """
+        Determines whether any item in the store has a chunk with the given
+        hash.
+        """
+        with self.__lock:
+            self.flush()
+            connection = self.__connect(create=False)
+            return connection is not None and connection.execute(
+                "SELECT 1 FROM chunks WHERE chunk_hash = ? LIMIT 1",
+                (chunk_hash, )).fetchone() is not None
+
+    def has_object(self, key: str) -> bool:
+        """
+        Determines whether an object is known to be stored in the bucket. This
+        is a local index of the objects, so the bucket does not need to be
+        queried.
+
+        Parameters
+        ----------
+        key
+            The key of the object in the bucket.
+        """
+        with self.__lock:
+            if key in self.__pending_objects:
+                return True
+            connection = self.__connect(create=False)
+            return connection is not None and connection.execute(
+                "SELECT 1 FROM objects WHERE key = ?",
+                (key, )).fetchone() is not None
+
+    def object_size(self, key: str) -> int:
+        """
+        Returns
+        -------
+        The size of an object, as it was stored in the bucket, or `None` if the
+        object is not known or was stored before sizes were recorded.
+        """
+        with self.__lock:
+            if key in self.__pending_objects:
+                return self.__pending_objects[key]
+            connection = self.__connect(create=False)
+            row = None
+            if connection is not None:
+                row = connection.execute(
+                    "SELECT size FROM objects WHERE key = ?",
+                    (key, )).fetchone()
+        return row[0] if row else None
+
+    def store_object(self, key: str, size: int) -> None:
+        """
+        Records that an object has been stored in the bucket, together with its
+        size in the bucket (e.g. after it was compressed and encrypted). With
+        group commits, it is written together with the rest of its group.
+        """
+        with self.__lock:
+            self.__pending.append((StateStore.__write_object, key, size))
+            self.__pending_objects[key] = size
+            self.__flush_if_due()
+
+    @staticmethod
+    def __write_object(connection: sqlite3.Connection, key: str,
+                       size: int) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO objects (key, size) VALUES (?, ?)",
+            (key, size))
+
+    def store_objects(self, keys: Iterable[str]) -> None:
+        """
+        Records that objects have been stored in the bucket, without their
+        sizes.
+        """
+        with self.__lock:
+            self.flush()
+            connection = self.__connect(create=True)
+            with connection:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO objects (key) VALUES (?)",
+                    [(key, ) for key in keys])
+
+    def remove_objects(self, keys: Iterable[str]) -> None:
+        """
+        Records that objects are no longer stored in the bucket.
+        """
+        with self.__lock:
+            self.flush()
+            connection = self.__connect(create=True)
+            with connection:
+                connection.executemany("DELETE FROM objects WHERE key = ?",
+                                       [(key, ) for key in keys])
+
+    def get_directory(self, directory: Path) -> Tuple[int, int, str]:
+        """
+        Obtains what was recorded about a directory when it was last listed
+        (see `store_directories`).
+
+        Parameters
+        ----------
+        directory
+            The directory, relative to the repository's root (which is `.`).
+
+        Returns
+        -------
+        The modification time of the directory, the number of entries that
+        were listed in it and the fingerprint of the ignore rules that it was
+        listed with, or `None` if nothing was recorded.
+        """
+        with self.__lock:
+            connection = self.__connect(create=False)
+            if connection is None:
+                return None
+            row = connection.execute(
+                "SELECT mtime_ns, entries, ignore_rules FROM directories "
+                "WHERE path = ?",
+                (StateStore.__directory_key(directory), )).fetchone()
+        return tuple(row) if row else None
+
+    def store_directories(self,
+                          directories: Iterable[Tuple[Path, int, int, str]]
+                          ) -> None:
+        """
+        Records the directories that were listed, so that they do not need to
+        be listed again while their modification time is the same.
+
+        Parameters
+        ----------
+        directories
+            The directory (relative to the repository's root), its modification
+            time (or `None` if it cannot be trusted), the number of its entries
+            that were listed and the fingerprint of the ignore rules that it was
+            listed with.
+        """
+        with self.__lock:
+            self.flush()
+            connection = self.__connect(create=True)
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO directories (path, mtime_ns, "
+                    "entries, ignore_rules) VALUES (?, ?, ?, ?)",
+                    [(StateStore.__directory_key(directory), mtime_ns,
+                      entries, ignore_rules)
+                     for (directory, mtime_ns, entries,
+                          ignore_rules) in directories])
+
+    def remove_directories(self,
+                           directories: Iterable[Path],
+                           subtrees: bool = False) -> None:
+        """
+        Forgets directories, so that they are listed again.
+
+        Parameters
+        ----------
+        subtrees
+            If `True`, the directories under them are forgotten as well.
+        """
+        with self.__lock:
+            connection = self.__connect(create=False)
+            if connection is None:
+                return
+            with connection:
+                for directory in directories:
+                    key = StateStore.__directory_key(directory)
+                    connection.execute("DELETE FROM directories WHERE path = ?",
+                                       (key, ))
+                    if subtrees:
+                        (start, end) = StateStore.__children_range(key)
+                        connection.execute(
+                            "DELETE FROM directories WHERE path >= ? AND "
+                            "(? IS NULL OR path < ?)", (start, end, end))
+
+    def child_directories(self, directory: Path) -> List[Path]:
+        """
+        Returns
+        -------
+        The directories directly in a directory that have been recorded (see
+        `store_directories`), ordered by their paths.
+        """
+        return [
+            Path(row[0]) for row in self.__children(
+                "SELECT path FROM directories WHERE path >= ? AND "
+                "(? IS NULL OR path < ?) ORDER BY path LIMIT ?", directory)
+        ]
+
+    def child_states(self, directory: Path) -> List[Tuple[Path, State]]:
+        """
+        Returns
+        -------
+        The items directly in a directory, together with their states, ordered
+        by the items' paths.
+        """
+        return [(Path(row[0]), StateStore.__to_state(row[1:]))
+                for row in self.__children(
+                    "SELECT item, size, content_hash, mtime_ns, inode, device, "
+                    "hash_algorithm FROM states WHERE item >= ? AND "
+                    "(? IS NULL OR item < ?) ORDER BY item LIMIT ?", directory)]
+
+    def __children(self, query: str, directory: Path) -> List[tuple]:
+        """
+        Runs a query for the rows of the paths directly in a directory. The
+        query takes the (inclusive) start and (exclusive) end of a range of
+        paths, and the page size, as its parameters. The paths under each
+        subdirectory are skipped with a new query from the end of their range,
+        so only the rows directly in the directory are read.
+        """
+        key = StateStore.__directory_key(directory)
+        prefix = key + "/" if key else ""
+        (start, end) = StateStore.__children_range(key)
+        children = []
+        with self.__lock:
+            connection = self.__connect(create=False)
+            if connection is None:
+                return children
+            while True:
+                page = connection.execute(
+                    query, (start, end, end, StateStore.__PAGE_SIZE)).fetchall()
+                for row in page:
+                    name = row[0][len(prefix):]
+                    if "/" in name:
+                        # Skip to the path after the subdirectory's paths.
+                        start = prefix + name.split("/", 1)[0] + "0"
+                        break
+                    if name:
+                        children.append(tuple(row))
+                    # The smallest path after this one.
+                    start = row[0] + "\0"
+                else:
+                    if len(page) < StateStore.__PAGE_SIZE:
+                        return children
 
     @staticmethod
-    def __contentAsBytes(source, attribute) -> bytes:
-        (attribute_name) = StateStore.__PARSERS[attribute][0]
-        value = getattr(source, attribute_name)
-        return bytes(f"{attribute}: {value}{os.linesep}", "utf-8")
+    def __directory_key(directory: Path) -> str:
+        return "" if directory == Path(".") else directory.as_posix()
+
+    @staticmethod
+    def __children_range(key: str) -> Tuple[str, str]:
+        """
+        Returns
+        -------
+        The (inclusive) start and (exclusive) end of the paths under a
+        directory. The paths under a directory sort between its path followed
+        by "/" and by "0", the character after "/". The paths under the root
+        directory have no end.
+        """
+        if not key:
+            return ("", None)
+        return (key + "/", key + "0")
+
+    def stored_hashes(self) -> Iterator[Tuple[str, int]]:
+        """
+        Yields the distinct content hashes of the items in the store, ordered
+        by the hash, together with the size of the content. As with
+        `stored_items`, they are read a page at a time.
+        """
+        yield from self.__distinct_pages(
+            "SELECT content_hash, MAX(size) FROM states WHERE content_hash > ? "
+            "GROUP BY content_hash ORDER BY content_hash LIMIT ?")
+
+    def stored_chunk_hashes(self) -> Iterator[Tuple[str, int]]:
+        """
+        Yields the distinct hashes of the chunks of the items in the store,
+        ordered by the hash, together with the size of the chunk.
+        """
+        yield from self.__distinct_pages(
+            "SELECT chunk_hash, MAX(size) FROM chunks WHERE chunk_hash > ? "
+            "GROUP BY chunk_hash ORDER BY chunk_hash LIMIT ?")
+
+    def __distinct_pages(self, query: str) -> Iterator[Tuple[str, int]]:
+        """
+        Runs a query a page at a time. The query takes the last value of the
+        previous page and the page size as its parameters.
+        """
+        last = ""
+        while True:
+            with self.__lock:
+                self.flush()
+                connection = self.__connect(create=False)
+                if connection is None:
+                    return
+                page = connection.execute(
+                    query, (last, StateStore.__PAGE_SIZE)).fetchall()
+
+            for row in page:
+                yield tuple(row)
+
+            if len(page) < StateStore.__PAGE_SIZE:
+                return
+            last = page[-1][0]
+
+    @staticmethod
+    def __to_state(row: tuple) -> State:
+        (size, content_hash, mtime_ns, inode, device, hash_algorithm) = row
+        return State(size=size,
+                     content_hash=content_hash,
+                     mtime_ns=mtime_ns,
+                     inode=inode,
+                     device=device,
+                     hash_algorithm=hash_algorithm)
 
     def get_state(self, path: Path) -> State:
         """
@@ -107,20 +676,21 @@ class StateStore:
         -------
         The state stored that was stored for the given `path` or `None` if there is no state stored.
         """
-        state_file = self.__store_path.joinpath(path)
+        with self.__lock:
+            self.__flush_if_due()
+            if path.as_posix() in self.__pending_states:
+                return self.__pending_states[path.as_posix()]
+            connection = self.__connect(create=False)
+            row = None
+            if connection is not None:
+                row = connection.execute(
+                    "SELECT size, content_hash, mtime_ns, inode, device, "
+                    "hash_algorithm FROM states WHERE item = ?",
+                    (path.as_posix(), )).fetchone()
 
         result = None
-        if state_file.exists() and state_file.is_file():
-            with state_file.open(mode="rt") as entry:
-                builder = state.Builder()
-                for line in entry:
-                    key, value = [
-                        word.strip()
-                        for word in line.split(sep=":", maxsplit=1)
-                    ]
-                    (attribute, parser) = StateStore.__PARSERS[key]
-                    setattr(builder, attribute, parser(value))
-            result = builder.build()
+        if row:
+            result = StateStore.__to_state(row)
             logging.debug(
                 f"Stored: {path}, Size={result.size}, Hash={result.content_hash}"
             )
@@ -128,3 +698,97 @@ class StateStore:
             logging.debug(f"No state stored yet for {path}")
 
         return result
+
+    def close(self) -> None:
+        """
+        Writes the pending states and closes the underlying database. The store
+        will be opened again if it is used after being closed.
+        """
+        with self.__lock:
+            self.flush()
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+
+    def __connect(self, create: bool) -> sqlite3.Connection:
+        """
+        Opens the database, if it is not already opened.
+
+        Parameters
+        ----------
+        create
+            If `True`, the database is created if it does not exist yet.
+            Otherwise, `None` is returned when there is no database (or legacy
+            store to migrate from).
+        """
+        if self.__connection is None:
+            exists = (self.__database_path.exists()
+                      or self.__legacy_path.is_dir())
+            if not (exists or create):
+                return None
+
+            self.__store_root.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.__database_path.as_posix(),
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            StateStore.__upgrade_schema(connection)
+            self.__connection = connection
+            self.__migrate_legacy_store()
+
+        return self.__connection
+
+    @staticmethod
+    def __upgrade_schema(connection: sqlite3.Connection) -> None:
+        """
+        Applies the schema statements that the database does not have yet. They
+        are applied, together with the new version, in a single transaction, so
+        that a failed upgrade leaves the database as it was.
+        """
+        (version, ) = connection.execute("PRAGMA user_version").fetchone()
+        if version >= len(StateStore.__SCHEMA):
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have upgraded it before the lock was taken.
+            (version, ) = connection.execute("PRAGMA user_version").fetchone()
+            for statement in StateStore.__SCHEMA[version:]:
+                connection.execute(statement)
+            connection.execute(
+                f"PRAGMA user_version = {len(StateStore.__SCHEMA)}")
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+    def __migrate_legacy_store(self) -> None:
+        """
+        Moves the states from the `state` directory, where each item had its
+        state stored in a separate file, into the database. The directory is
+        removed once all of its states have been stored.
+        """
+        if not self.__legacy_path.is_dir():
+            return
+
+        logging.info(f"Migrating states from {self.__legacy_path}.")
+        with self.__connection:
+            for state_file in self.__legacy_path.rglob("*"):
+                if state_file.is_file():
+                    item = state_file.relative_to(self.__legacy_path)
+                    StateStore.__write(
+                        self.__connection, item,
+                        StateStore.__read_legacy_state(state_file))
+
+        shutil.rmtree(self.__legacy_path)
+
+    @staticmethod
+    def __read_legacy_state(state_file: Path) -> State:
+        with state_file.open(mode="rt") as entry:
+            builder = state.Builder()
+            for line in entry:
+                key, value = [
+                    word.strip() for word in line.split(sep=":", maxsplit=1)
+                ]
+                (attribute, parser) = StateStore.__PARSERS[key]
+                setattr(builder, attribute, parser(value))
+        return builder.build()
@@ -0,0 +1,192 @@
+"""
+Statistics about a single run of pyups, such as how long each phase took and
+how many files and bytes were processed. They can be written as JSON, or in the
+Prometheus text format so that they can be collected by the textfile collector
+of node_exporter.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Iterable, Iterator
+
+"""
+The upper bounds (in seconds) of the buckets of the latency histograms.
+"""
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+"""
+The prefix of the names of the metrics written by `RunStats.write_prometheus`.
+"""
+METRIC_PREFIX = "pyups"
+
+
+class RunStats:
+    """
+    Collects statistics during a run. It may be updated from several threads.
+
+    The time of a phase is the total time spent in it. Phases that run on
+    several threads at once (e.g. hashing and uploading) can therefore add up
+    to more than the time of the whole run.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__phases = {}
+        self.__counters = {}
+        self.__histograms = {}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """
+        Adds to a counter, such as the number of files or bytes processed.
+        """
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        """
+        Adds time spent in a phase.
+        """
+        with self.__lock:
+            totals = self.__phases.setdefault(phase, {
+                "seconds": 0.0,
+                "count": 0
+            })
+            totals["seconds"] += seconds
+            totals["count"] += 1
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Records a latency in a histogram.
+        """
+        with self.__lock:
+            histogram = self.__histograms.setdefault(
+                name, {
+                    "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                    "sum": 0.0,
+                    "count": 0
+                })
+            histogram["buckets"][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    @contextmanager
+    def phase(self, phase: str, histogram: str = None) -> Iterator[None]:
+        """
+        Times the code in the `with` block as part of a phase.
+
+        Parameters
+        ----------
+        histogram
+            If given, the time is also recorded in this latency histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add_time(phase, elapsed)
+            if histogram is not None:
+                self.observe(histogram, elapsed)
+
+    def timed(self, phase: str, iterable: Iterable) -> Iterator:
+        """
+        Provides the items of an iterable, adding the time spent producing each
+        of them to a phase. The time spent by the caller on each item is not
+        included.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(phase, time.perf_counter() - start)
+            yield item
+
+    def to_dict(self) -> dict:
+        """
+        Returns
+        -------
+        The statistics as a dictionary that can be written as JSON.
+        """
+        with self.__lock:
+            return {
+                "started": self.__started,
+                "phases": {
+                    phase: dict(totals)
+                    for (phase, totals) in self.__phases.items()
+                },
+                "counters": dict(self.__counters),
+                "histograms": {
+                    name: {
+                        "bounds": LATENCY_BUCKETS,
+                        "buckets": list(histogram["buckets"]),
+                        "sum": histogram["sum"],
+                        "count": histogram["count"]
+                    }
+                    for (name, histogram) in self.__histograms.items()
+                }
+            }
+
+    def write_json(self, path: Path) -> None:
+        """
+        Writes the statistics to a file as JSON.
+        """
+        RunStats.__write_atomically(
+            path,
+            json.dumps(self.to_dict(), indent=1) + "\n")
+
+    def write_prometheus(self, path: Path) -> None:
+        """
+        Writes the statistics to a file in the Prometheus text format. The file
+        is replaced in a single step, so that a collector never reads a
+        partially written file.
+        """
+        RunStats.__write_atomically(path, prometheus_text(self.to_dict()))
+
+    @staticmethod
+    def __write_atomically(path: Path, content: str) -> None:
+        temporary = path.with_name(f".{path.name}.tmp")
+        temporary.write_text(content)
+        os.replace(temporary, path)
+
+
+def prometheus_text(stats: dict) -> str:
+    """
+    Formats statistics from `RunStats.to_dict` in the Prometheus text format.
+    """
+    lines = [
+        f"# HELP {METRIC_PREFIX}_last_run_timestamp_seconds When the last run started.",
+        f"# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge",
+        f"{METRIC_PREFIX}_last_run_timestamp_seconds {stats['started']}",
+        f"# HELP {METRIC_PREFIX}_phase_seconds Time spent in each phase of the last run.",
+        f"# TYPE {METRIC_PREFIX}_phase_seconds gauge"
+    ]
+    for (phase, totals) in sorted(stats["phases"].items()):
+        lines.append(
+            f'{METRIC_PREFIX}_phase_seconds{{phase="{phase}"}} {totals["seconds"]}'
+        )
+
+    for (name, value) in sorted(stats["counters"].items()):
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+        lines.append(f"{METRIC_PREFIX}_{name} {value}")
+
+    for (name, histogram) in sorted(stats["histograms"].items()):
+        metric = f"{METRIC_PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        bounds = [str(bound) for bound in histogram["bounds"]] + ["+Inf"]
+        for (bound, count) in zip(bounds, histogram["buckets"]):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{metric}_sum {histogram['sum']}")
+        lines.append(f"{metric}_count {histogram['count']}")
+
+    return "\n".join(lines) + "\n"
+
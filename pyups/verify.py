@@ -0,0 +1,336 @@
+"""
+Verifies that the bucket holds the objects that the state store says were
+backed up, without downloading their content. The objects are listed a page at
+a time and merged against a walk of the store in the same (sorted) order, so
+the bucket is not queried once per item. Objects that are listed, but no longer
+belong to any item in the store, are reported as orphans.
+
+The content of a sample of the objects can also be checked, with ranged reads
+of a small part of each. Content that is stored as it is, is compared with the
+backed up file. Otherwise, only the start of the object is checked to be that
+of compressed or encrypted content.
+"""
+import logging
+from pathlib import Path
+import random
+from typing import Iterable, Iterator, List, Tuple
+import boto3
+from pyups import compression, encryption
+from pyups.configuration import (Configuration, DATA_PATH,
+                                 LAYOUT_CONTENT_ADDRESSED)
+from pyups.manifest import INDEX_KEY, RemoteManifest
+from pyups.state.model import State
+from pyups.state.store import StateStore
+
+"""
+The most content that is read from an object to check a sample.
+"""
+SAMPLE_SIZE = 64 * 1024
+
+
+class Report:
+    """
+    The result of verifying a backup.
+    """
+    def __init__(self):
+        # The keys of the objects that should be in the bucket, but are not.
+        self.missing = []
+        # The key, expected size and size in the bucket of the objects whose
+        # size is not the expected one.
+        self.size_mismatches = []
+        # The keys of the objects in the bucket that no item needs.
+        self.orphans = []
+        # The keys of the sampled objects whose content is not what was
+        # expected, with the reason.
+        self.sample_failures = []
+        self.objects_checked = 0
+        self.samples_checked = 0
+        self.samples_skipped = 0
+
+    @property
+    def ok(self) -> bool:
+        """
+        Returns
+        -------
+        `True` if every object that is needed is in the bucket as expected.
+        Orphans do not make a backup incomplete, so they are not taken into
+        account.
+        """
+        return not (self.missing or self.size_mismatches
+                    or self.sample_failures)
+
+
+def verify(repository_path: Path,
+           configuration: Configuration,
+           sample: int = 0,
+           client=None) -> Report:
+    """
+    Verifies the backup of a repository.
+
+    Parameters
+    ----------
+    repository_path
+        The path of the directory that was backed up. Its state store lists
+        the items that should be in the bucket.
+
+    configuration
+        The configuration of the backup.
+
+    sample
+        The number of items whose content is checked with ranged reads.
+
+    client
+        The S3 client to verify with. If not given, a client is created.
+
+    Returns
+    -------
+    What was found to be missing, different or unneeded in the bucket.
+    """
+    if client is None:
+        client = boto3.client('s3')
+    bucket = configuration.s3_bucket
+    store = StateStore(repository_path.joinpath(DATA_PATH))
+    report = Report()
+    try:
+        if configuration.layout == LAYOUT_CONTENT_ADDRESSED:
+            expected = ((f"objects/{content_hash}",
+                         __expected_size(store, configuration,
+                                         f"objects/{content_hash}", size))
+                        for (content_hash, size) in store.stored_hashes())
+            __compare(report, expected, __listed(client, bucket, "objects/"))
+        else:
+            expected = ((f"content/{item.as_posix()}",
+                         __expected_size(store, configuration,
+                                         f"content/{item.as_posix()}",
+                                         state.size))
+                        for (item, state) in store.stored_states())
+            __compare(report, expected, __listed(client, bucket, "content/"))
+
+        chunks = ((f"chunks/{chunk_hash}",
+                   __expected_size(store, configuration,
+                                   f"chunks/{chunk_hash}", size,
+                                   chunk=True))
+                  for (chunk_hash, size) in store.stored_chunk_hashes())
+        __compare(report, chunks, __listed(client, bucket, "chunks/"))
+        __compare(report, __manifest_keys(client, configuration),
+                  __listed(client, bucket, "manifest/"))
+
+        if sample > 0:
+            # Objects that are already known to be wrong are not sampled.
+            wrong = set(report.missing).union(
+                key for (key, _, _) in report.size_mismatches)
+            for (item, state) in __sample_items(store, configuration,
+                                                sample):
+                key = __key(configuration, item, state)
+                if key not in wrong:
+                    __check_sample(report, client, configuration,
+                                   repository_path, item, state, key)
+    finally:
+        store.close()
+    return report
+
+
+def format_report(report: Report) -> str:
+    """
+    Formats a report (see `verify`) for printing.
+    """
+    lines = [f"Checked {report.objects_checked} object(s)."]
+    if report.samples_checked or report.samples_skipped:
+        lines.append(f"Checked the content of {report.samples_checked} "
+                     f"sampled object(s), skipped {report.samples_skipped} "
+                     "whose file changed since it was backed up.")
+    lines += [f"Missing: {key}" for key in report.missing]
+    lines += [
+        f"Wrong size: {key} (expected {expected} bytes, found {found})"
+        for (key, expected, found) in report.size_mismatches
+    ]
+    lines += [
+        f"Wrong content: {key} ({reason})"
+        for (key, reason) in report.sample_failures
+    ]
+    lines += [f"Orphan: {key}" for key in report.orphans]
+    return "\n".join(lines)
+
+
+def __key(configuration: Configuration, item: Path, state: State) -> str:
+    if configuration.layout == LAYOUT_CONTENT_ADDRESSED:
+        return f"objects/{state.content_hash}"
+    return f"content/{item.as_posix()}"
+
+
+def __expected_size(store: StateStore,
+                    configuration: Configuration,
+                    key: str,
+                    size: int,
+                    chunk: bool = False) -> int:
+    """
+    Returns
+    -------
+    The size that an object should have in the bucket, or `None` if it is not
+    known. Objects stored before their sizes were recorded are expected to
+    have the size of their content, unless it may have been compressed,
+    encrypted or replaced with a recipe.
+    """
+    stored_size = store.object_size(key)
+    if stored_size is not None:
+        return stored_size
+    threshold = configuration.chunk_threshold
+    if (configuration.encryption_password
+            or configuration.compression_codec is not None
+            or (not chunk and threshold is not None and size >= threshold)):
+        return None
+    return size
+
+
+def __manifest_keys(client,
+                    configuration: Configuration) -> Iterator[Tuple[str, int]]:
+    index = RemoteManifest(
+        client=client,
+        bucket=configuration.s3_bucket,
+        encryption_password=configuration.encryption_password).read_index()
+    if index is None:
+        return
+    keys = [INDEX_KEY] + [
+        segment["key"] for segment in [index["base"]] + index["deltas"]
+    ]
+    for key in sorted(keys):
+        yield (key, None)
+
+
+def __listed(client, bucket: str, prefix: str) -> Iterator[Tuple[str, int]]:
+    """
+    Lists the objects under a prefix a page at a time, ordered by their keys.
+
+    Yields
+    ------
+    The key and size of each object.
+    """
+    arguments = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = client.list_objects_v2(**arguments)
+        for entry in response.get('Contents', []):
+            yield (entry['Key'], entry['Size'])
+        if not response.get('IsTruncated'):
+            return
+        arguments['ContinuationToken'] = response['NextContinuationToken']
+
+
+def __compare(report: Report, expected: Iterable[Tuple[str, int]],
+              listed: Iterable[Tuple[str, int]]) -> None:
+    """
+    Merges the objects that are expected with the ones that are listed, adding
+    the differences to the report. Both must be ordered by their keys. The
+    bucket lists keys in the order of their UTF-8 bytes, which is also the
+    order that the store and Python sort strings in.
+    """
+    expected = iter(expected)
+    listed = iter(listed)
+    wanted = next(expected, None)
+    found = next(listed, None)
+    while wanted is not None or found is not None:
+        if found is None or (wanted is not None and wanted[0] < found[0]):
+            report.missing.append(wanted[0])
+            wanted = next(expected, None)
+        elif wanted is None or found[0] < wanted[0]:
+            report.orphans.append(found[0])
+            found = next(listed, None)
+        else:
+            report.objects_checked += 1
+            if wanted[1] is not None and wanted[1] != found[1]:
+                report.size_mismatches.append((wanted[0], wanted[1], found[1]))
+            wanted = next(expected, None)
+            found = next(listed, None)
+
+
+def __sample_items(store: StateStore, configuration: Configuration,
+                   count: int) -> List[Tuple[Path, State]]:
+    """
+    Picks items at random, with a single walk of the store. Empty items, and
+    items whose objects are recipes, are not picked.
+    """
+    threshold = configuration.chunk_threshold
+    picked = []
+    seen = 0
+    for (item, state) in store.stored_states():
+        if state.size == 0 or (threshold is not None
+                               and state.size >= threshold):
+            continue
+        seen += 1
+        if len(picked) < count:
+            picked.append((item, state))
+        else:
+            position = random.randrange(seen)
+            if position < count:
+                picked[position] = (item, state)
+    return picked
+
+
+def __check_sample(report: Report, client, configuration: Configuration,
+                   repository_path: Path, item: Path, state: State,
+                   key: str) -> None:
+    """
+    Checks part of the content of an object. Content that is stored as it is,
+    is compared with the same range of the backed up file, if the file has not
+    changed since.
+    """
+    bucket = configuration.s3_bucket
+    try:
+        if configuration.encryption_password:
+            start = __read_range(client, bucket, key, 0,
+                                 len(encryption.HEADER))[0]
+            if start != encryption.HEADER:
+                report.sample_failures.append((key, "not encrypted content"))
+            else:
+                report.samples_checked += 1
+            return
+
+        offset = random.randrange(state.size)
+        length = min(SAMPLE_SIZE, state.size - offset)
+        (content, metadata) = __read_range(client, bucket, key, offset, length)
+        codec = metadata.get(compression.CODEC_METADATA)
+        if codec is not None:
+            magic = compression.MAGIC_NUMBERS.get(codec, b"")
+            start = __read_range(client, bucket, key, 0, len(magic))[0]
+            if start != magic:
+                report.sample_failures.append((key, f"not {codec} content"))
+            else:
+                report.samples_checked += 1
+            return
+
+        path = repository_path.joinpath(item)
+        if not __unchanged(path, state):
+            report.samples_skipped += 1
+            return
+        with path.open(mode="rb") as source:
+            source.seek(offset)
+            if source.read(length) != content:
+                report.sample_failures.append(
+                    (key, f"bytes {offset}-{offset + length - 1} differ"))
+                return
+        report.samples_checked += 1
+    except Exception as error:
+        logging.error(f"Could not check the content of {key}: {error}")
+        report.sample_failures.append((key, str(error)))
+
+
+def __read_range(client, bucket: str, key: str, offset: int,
+                 length: int) -> Tuple[bytes, dict]:
+    """
+    Returns
+    -------
+    The content of a range of an object, and the object's metadata.
+    """
+    response = client.get_object(Bucket=bucket,
+                                 Key=key,
+                                 Range=f"bytes={offset}-{offset + length - 1}")
+    return (response['Body'].read(), response.get('Metadata', {}))
+
+
+def __unchanged(path: Path, state: State) -> bool:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    return stat.st_size == state.size and (state.mtime_ns is None
+                                           or stat.st_mtime_ns
+                                           == state.mtime_ns)
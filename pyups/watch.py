@@ -0,0 +1,506 @@
+"""
+Backs up a directory continuously. Instead of walking the whole directory for
+each backup, the paths that change are collected as they change, and only they
+are looked at (see `StateRepository.changes`).
+
+Changes are reported by inotify on Linux. Elsewhere (or if inotify cannot be
+used, e.g. because there are too many directories to watch), the directory is
+walked periodically and the metadata of its files compared with the previous
+walk instead.
+
+The changed paths are backed up once no more changes have been reported for a
+short while, so that a burst of changes (e.g. a file being written, or a
+directory being copied) is backed up together. If changes may have been missed,
+e.g. because the inotify queue overflowed, the whole directory is looked at by
+the next backup.
+
+The manifest (see `pyups.manifest`) is not updated by each of these backups, so
+that a directory that changes often does not add a segment to it every few
+seconds. Their changes are added to it together once no more changes have been
+backed up for a while (or at the latest a while after the first of them), and
+when watching stops.
+"""
+from abc import ABC, abstractmethod
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+import threading
+import time
+from typing import Dict, Iterator, Set, Tuple
+from pyups import backups
+from pyups.configuration import Configuration, DATA_PATH
+from pyups.state.ignore import IGNORE_FILE_NAME, IgnoreRules, read_ignore_file
+
+"""
+Changed paths are backed up once no more changes have been reported for this
+long (in seconds).
+"""
+DEBOUNCE_DELAY = 2.0
+
+"""
+Changed paths are backed up at the latest this long (in seconds) after the
+first of them changed, even if changes are still being reported.
+"""
+MAXIMUM_DELAY = 60.0
+
+"""
+When a backup fails, it is not tried again for this long (in seconds).
+"""
+RETRY_DELAY = 60.0
+
+"""
+How often (in seconds) the directory is walked to look for changes, when
+inotify cannot be used.
+"""
+POLL_INTERVAL = 60.0
+
+"""
+The changes backed up while watching are added to the manifest once no more
+changes have been backed up for this long (in seconds).
+"""
+MANIFEST_IDLE_DELAY = 60.0
+
+"""
+The changes backed up while watching are added to the manifest at the latest
+this long (in seconds) after the first of them was backed up, even if changes
+are still being backed up.
+"""
+MANIFEST_INTERVAL = 15 * 60.0
+
+
+def watch(repository_path: Path,
+          configuration: Configuration,
+          debounce: float = DEBOUNCE_DELAY,
+          poll_interval: float = POLL_INTERVAL,
+          polling: bool = False,
+          hash_workers: int = 1,
+          upload_workers: int = 8,
+          client=None,
+          stop: threading.Event = None) -> None:
+    """
+    Backs up a directory, and then backs up the paths in it that change, until
+    stopped.
+
+    Parameters
+    ----------
+    repository_path
+        The path of the directory to back up.
+
+    configuration
+        The configuration of the backup.
+
+    debounce
+        Changed paths are backed up once no more changes have been reported for
+        this long (in seconds).
+
+    poll_interval
+        How often (in seconds) the directory is walked to look for changes, if
+        inotify is not used.
+
+    polling
+        If `True`, the directory is walked periodically, even if inotify could
+        be used.
+
+    hash_workers, upload_workers, client
+        As for `pyups.backups.backup`.
+
+    stop
+        If given, watching stops once this is set. Otherwise, it only stops
+        when interrupted.
+    """
+    if stop is None:
+        stop = threading.Event()
+
+    def watcher() -> "Watcher":
+        rules = IgnoreRules(
+            list(configuration.ignore_patterns) +
+            read_ignore_file(repository_path))
+        return create_watcher(repository_path, rules, poll_interval, polling)
+
+    # The paths that changed since the last backup, and whether the whole
+    # directory must be looked at instead.
+    dirty = set()
+    rescan = False
+    # When the first backup whose changes are not in the manifest yet was done
+    # (or `None` if there is none), and when the last backup was done.
+    unwritten = None
+    backed_up = 0.0
+
+    def backup(paths) -> bool:
+        """
+        Backs up the changes in some paths, or in the whole directory if
+        `paths` is `None`. The paths that could not be backed up are looked at
+        again by a later backup.
+
+        Returns
+        -------
+        `True` if every change was backed up.
+        """
+        nonlocal rescan, unwritten, backed_up
+        logging.info("Backing up " + ("every item" if paths is None else
+                                      f"{len(paths)} changed path(s)"))
+        try:
+            failed = backups.backup(repository_path,
+                                    configuration,
+                                    hash_workers=hash_workers,
+                                    upload_workers=upload_workers,
+                                    client=client,
+                                    paths=paths,
+                                    defer_manifest=True)
+        except Exception as error:
+            logging.error(f"Backup failed: {error}")
+            if paths is None:
+                rescan = True
+            else:
+                dirty.update(paths)
+            return False
+        finally:
+            backed_up = time.monotonic()
+            if unwritten is None:
+                unwritten = backed_up
+        dirty.update(failed)
+        return not failed
+
+    def update_manifest() -> bool:
+        """
+        Adds the changes that were backed up to the manifest.
+
+        Returns
+        -------
+        `True` if the manifest was updated.
+        """
+        nonlocal unwritten
+        logging.info("Updating the manifest")
+        try:
+            backups.update_manifest(repository_path,
+                                    configuration,
+                                    client=client)
+        except Exception as error:
+            logging.error(f"Could not update the manifest: {error}")
+            return False
+        unwritten = None
+        return True
+
+    # The watcher is started first, so that changes made during the first
+    # backup are not missed.
+    current = watcher()
+    try:
+        not_before = 0 if backup(None) else time.monotonic() + RETRY_DELAY
+        manifest_not_before = 0
+        first = last = time.monotonic()
+        while not stop.is_set():
+            now = time.monotonic()
+            if (unwritten is not None and now >= manifest_not_before and
+                ((not (dirty or rescan)
+                  and now - backed_up >= MANIFEST_IDLE_DELAY)
+                 or now - unwritten >= MANIFEST_INTERVAL)):
+                if not update_manifest():
+                    manifest_not_before = time.monotonic() + RETRY_DELAY
+                continue
+
+            if ((dirty or rescan) and now >= not_before and
+                (now - last >= debounce or now - first >= MAXIMUM_DELAY)):
+                if Path(IGNORE_FILE_NAME) in dirty:
+                    # Directories that were excluded may now be included, and
+                    # are not watched yet.
+                    current.close()
+                    current = watcher()
+                    rescan = True
+                paths = None if rescan else sorted(dirty)
+                dirty = set()
+                rescan = False
+                if not backup(paths):
+                    not_before = time.monotonic() + RETRY_DELAY
+                first = last = time.monotonic()
+                continue
+
+            changed = current.read(timeout=min(debounce, 1.0))
+            if changed is None or changed:
+                if not (dirty or rescan):
+                    first = now
+                last = now
+                if changed is None:
+                    logging.warning(
+                        "Changes may have been missed, looking at every item.")
+                    rescan = True
+                else:
+                    dirty.update(changed)
+    finally:
+        try:
+            if unwritten is not None:
+                update_manifest()
+        finally:
+            current.close()
+
+
+def create_watcher(repository_path: Path,
+                   ignore_rules: IgnoreRules,
+                   poll_interval: float = POLL_INTERVAL,
+                   polling: bool = False) -> "Watcher":
+    """
+    Creates a watcher of the changes in a directory. Inotify is used, unless
+    `polling` is `True` or it cannot be used.
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(repository_path, ignore_rules)
+        except (OSError, AttributeError) as error:
+            logging.warning(f"Cannot watch {repository_path} with inotify "
+                            f"({error}), looking for changes every "
+                            f"{poll_interval} seconds instead.")
+    return PollingWatcher(repository_path, ignore_rules, poll_interval)
+
+
+class Watcher(ABC):
+    """
+    Reports the paths in a directory that change.
+    """
+    @abstractmethod
+    def read(self, timeout: float) -> Set[Path]:
+        """
+        Waits for changes.
+
+        Parameters
+        ----------
+        timeout
+            The most time (in seconds) to wait for changes.
+
+        Returns
+        -------
+        The paths (relative to the directory) that have changed since the last
+        call, which may be empty. A path may be a directory, in which case
+        anything under it may have changed. `None` is returned if changes may
+        have been missed, so the whole directory must be looked at.
+        """
+
+    def close(self) -> None:
+        """
+        Stops watching for changes. Watchers that hold no resources need not
+        override this.
+        """
+
+
+class InotifyWatcher(Watcher):
+    """
+    Reports changes with inotify. Every directory is watched, except for the
+    data directory and directories that are excluded by the ignore rules.
+    """
+    # The flags of inotify, from <sys/inotify.h>.
+    __IN_MODIFY = 0x00000002
+    __IN_ATTRIB = 0x00000004
+    __IN_CLOSE_WRITE = 0x00000008
+    __IN_MOVED_FROM = 0x00000040
+    __IN_MOVED_TO = 0x00000080
+    __IN_CREATE = 0x00000100
+    __IN_DELETE = 0x00000200
+    __IN_Q_OVERFLOW = 0x00004000
+    __IN_IGNORED = 0x00008000
+    __IN_ONLYDIR = 0x01000000
+    __IN_ISDIR = 0x40000000
+    __IN_NONBLOCK = 0o4000
+    __IN_CLOEXEC = 0o2000000
+
+    __MASK = (__IN_MODIFY | __IN_ATTRIB | __IN_CLOSE_WRITE | __IN_MOVED_FROM
+              | __IN_MOVED_TO | __IN_CREATE | __IN_DELETE | __IN_ONLYDIR)
+
+    """
+    The header of each event read from inotify: its watch descriptor, mask,
+    cookie and the length of the name that follows it.
+    """
+    __EVENT = struct.Struct("iIII")
+
+    def __init__(self, repository_path: Path, ignore_rules: IgnoreRules):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__add_watch = libc.inotify_add_watch
+        self.__add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32
+        ]
+        self.__remove_watch = libc.inotify_rm_watch
+        self.__remove_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.__root_path = repository_path
+        self.__ignore_rules = ignore_rules
+        self.__fd = libc.inotify_init1(InotifyWatcher.__IN_NONBLOCK
+                                       | InotifyWatcher.__IN_CLOEXEC)
+        if self.__fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # The directory of each watch descriptor.
+        self.__directories = {}
+        try:
+            self.__watch_tree(Path("."))
+        except BaseException:
+            os.close(self.__fd)
+            raise
+
+    def read(self, timeout: float) -> Set[Path]:
+        (readable, _, _) = select.select([self.__fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        overflowed = False
+        while True:
+            try:
+                content = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                break
+            for (descriptor, mask, name) in self.__events(content):
+                if mask & InotifyWatcher.__IN_Q_OVERFLOW:
+                    overflowed = True
+                elif mask & InotifyWatcher.__IN_IGNORED:
+                    self.__directories.pop(descriptor, None)
+                elif name and descriptor in self.__directories:
+                    item = self.__directories[descriptor].joinpath(name)
+                    if not InotifyWatcher.__is_data_path(item):
+                        changed.add(item)
+                        if mask & InotifyWatcher.__IN_ISDIR:
+                            overflowed |= not self.__directory_changed(
+                                item, mask)
+
+        if overflowed:
+            # Directories created while events were lost are not watched.
+            for descriptor in list(self.__directories):
+                self.__remove_watch(self.__fd, descriptor)
+            self.__directories.clear()
+            try:
+                self.__watch_tree(Path("."))
+            except OSError as error:
+                logging.warning(f"Could not watch every directory: {error}")
+            return None
+        return changed
+
+    def close(self) -> None:
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    def __directory_changed(self, item: Path, mask: int) -> bool:
+        """
+        Updates the watches of a directory that was created, moved or deleted.
+
+        Returns
+        -------
+        `False` if the directory could not be watched.
+        """
+        if mask & InotifyWatcher.__IN_MOVED_FROM:
+            # Its watches now have the wrong paths. If it was moved within the
+            # directory, it is watched again under its new path.
+            for (descriptor, directory) in list(self.__directories.items()):
+                if directory == item or item in directory.parents:
+                    self.__remove_watch(self.__fd, descriptor)
+                    del self.__directories[descriptor]
+        elif mask & (InotifyWatcher.__IN_CREATE
+                     | InotifyWatcher.__IN_MOVED_TO):
+            try:
+                self.__watch_tree(item)
+            except OSError as error:
+                logging.warning(f"Could not watch {item}: {error}")
+                return False
+        return True
+
+    def __watch_tree(self, directory: Path) -> None:
+        """
+        Watches a directory and the directories under it.
+        """
+        if directory != Path(".") and self.__ignore_rules.excludes(
+                directory, directory=True):
+            return
+        descriptor = self.__add_watch(
+            self.__fd, os.fsencode(self.__root_path.joinpath(directory)),
+            InotifyWatcher.__MASK)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # It was deleted (or replaced) in the meantime.
+                return
+            raise OSError(error, os.strerror(error), str(directory))
+        self.__directories[descriptor] = directory
+        try:
+            entries = list(os.scandir(self.__root_path.joinpath(directory)))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for entry in entries:
+            item = directory.joinpath(entry.name)
+            if (entry.is_dir(follow_symlinks=False)
+                    and not InotifyWatcher.__is_data_path(item)):
+                self.__watch_tree(item)
+
+    @staticmethod
+    def __is_data_path(item: Path) -> bool:
+        return item.parts[0] == DATA_PATH
+
+    @staticmethod
+    def __events(content: bytes) -> Iterator[Tuple[int, int, str]]:
+        """
+        Yields
+        ------
+        The watch descriptor, mask and name of each event read from inotify.
+        """
+        offset = 0
+        while offset < len(content):
+            (descriptor, mask, _,
+             length) = InotifyWatcher.__EVENT.unpack_from(content, offset)
+            offset += InotifyWatcher.__EVENT.size
+            name = content[offset:offset + length].rstrip(b"\0")
+            offset += length
+            yield (descriptor, mask, os.fsdecode(name))
+
+
+class PollingWatcher(Watcher):
+    """
+    Reports changes by walking the directory every `poll_interval` seconds,
+    and comparing the size, modification time and inode of each file with the
+    previous walk.
+    """
+    def __init__(self, repository_path: Path, ignore_rules: IgnoreRules,
+                 poll_interval: float):
+        self.__root_path = repository_path
+        self.__ignore_rules = ignore_rules
+        self.__poll_interval = poll_interval
+        self.__files = self.__walk()
+        self.__next_poll = time.monotonic() + poll_interval
+
+    def read(self, timeout: float) -> Set[Path]:
+        remaining = self.__next_poll - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(remaining, 0))
+        files = self.__walk()
+        self.__next_poll = time.monotonic() + self.__poll_interval
+        changed = {
+            item
+            for item in files.keys() | self.__files.keys()
+            if files.get(item) != self.__files.get(item)
+        }
+        self.__files = files
+        return changed
+
+    def __walk(self) -> Dict[Path, tuple]:
+        files = {}
+        directories = [Path(".")]
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(self.__root_path.joinpath(directory)))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                item = directory.joinpath(entry.name)
+                name = item.as_posix()
+                if entry.is_dir():
+                    if not (name == DATA_PATH or self.__ignore_rules.ignores(
+                            name, directory=True)):
+                        directories.append(item)
+                elif entry.is_file() and not self.__ignore_rules.ignores(name):
+                    try:
+                        stats = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files[item] = (stats.st_size, stats.st_mtime_ns,
+                                   stats.st_ino)
+        return files
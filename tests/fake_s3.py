@@ -0,0 +1,204 @@
+import io
+from pathlib import Path
+import threading
+from botocore.exceptions import ClientError
+
+
+class FakeS3Client:
+    """
+    A stand-in for the S3 client from `boto3`, which keeps the objects of a
+    single bucket in memory. Only the operations used by `pyups` are provided.
+    """
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self.objects = {}
+        self.failing_keys = set()
+        # The number of times that deleting each of these keys is throttled,
+        # before it succeeds.
+        self.throttled_keys = {}
+        self.delete_requests = 0
+        self.uploaded_keys = []
+        self.metadata = {}
+        self.failing_parts = set()
+        self.uploaded_parts = []
+        self.multipart_uploads = {}
+        self.__lock = threading.Lock()
+
+    def objects_under(self, prefix: str) -> dict:
+        """
+        Returns
+        -------
+        The objects whose keys start with `prefix`.
+        """
+        return {
+            key: content
+            for (key, content) in self.objects.items()
+            if key.startswith(prefix)
+        }
+
+    def __check(self, bucket: str, key: str) -> None:
+        assert bucket == self.bucket
+        if key in self.failing_keys:
+            raise IOError(f"Simulated failure for {key}")
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str) -> None:
+        self.__check(Bucket, Key)
+        content = Path(Filename).read_bytes()
+        with self.__lock:
+            self.objects[Key] = content
+            self.uploaded_keys.append(Key)
+
+    def upload_fileobj(self,
+                       Fileobj,
+                       Bucket: str,
+                       Key: str,
+                       ExtraArgs: dict = None) -> None:
+        self.__check(Bucket, Key)
+        content = Fileobj.read()
+        with self.__lock:
+            self.objects[Key] = content
+            self.metadata[Key] = (ExtraArgs or {}).get("Metadata", {})
+            self.uploaded_keys.append(Key)
+
+    def download_fileobj(self, Bucket: str, Key: str, Fileobj) -> None:
+        self.__check(Bucket, Key)
+        with self.__lock:
+            content = self.objects.get(Key)
+        if content is None:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        Fileobj.write(content)
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None) -> dict:
+        self.__check(Bucket, Key)
+        with self.__lock:
+            content = self.objects.get(Key)
+            metadata = dict(self.metadata.get(Key, {}))
+        if content is None:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        if Range is not None:
+            (first, last) = Range[len("bytes="):].split("-")
+            content = content[int(first):int(last) + 1]
+        return {
+            "Body": io.BytesIO(content),
+            "ContentLength": len(content),
+            "Metadata": metadata
+        }
+
+    def list_objects_v2(self,
+                        Bucket: str,
+                        Prefix: str = "",
+                        ContinuationToken: str = None) -> dict:
+        """
+        Lists the objects under a prefix, two at a time so that paging is
+        exercised.
+        """
+        assert Bucket == self.bucket
+        with self.__lock:
+            keys = sorted(key for key in self.objects
+                          if key.startswith(Prefix))
+            start = int(ContinuationToken or 0)
+            page = [{
+                "Key": key,
+                "Size": len(self.objects[key])
+            } for key in keys[start:start + 2]]
+        response = {"Contents": page, "IsTruncated": start + 2 < len(keys)}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + 2)
+        return response
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        self.__check(Bucket, Key)
+        with self.__lock:
+            content = self.objects.get(Key)
+            metadata = dict(self.metadata.get(Key, {}))
+        if content is None:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": len(content), "Metadata": metadata}
+
+    def copy(self,
+             CopySource: dict,
+             Bucket: str,
+             Key: str,
+             ExtraArgs: dict = None) -> None:
+        """
+        Copies an object. Like the managed copies of large objects, the
+        metadata of the source is not carried over, so the copy only has the
+        metadata given in `ExtraArgs`.
+        """
+        self.__check(Bucket, Key)
+        with self.__lock:
+            self.objects[Key] = self.objects[CopySource["Key"]]
+            self.metadata[Key] = dict((ExtraArgs or {}).get("Metadata", {}))
+
+    def delete_object(self, Bucket: str, Key: str) -> None:
+        self.__check(Bucket, Key)
+        with self.__lock:
+            self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket: str, Delete: dict) -> dict:
+        assert Bucket == self.bucket
+        errors = []
+        with self.__lock:
+            self.delete_requests += 1
+            for entry in Delete["Objects"]:
+                key = entry["Key"]
+                if key in self.failing_keys:
+                    errors.append({"Key": key, "Code": "InternalError"})
+                elif self.throttled_keys.get(key, 0) > 0:
+                    self.throttled_keys[key] -= 1
+                    errors.append({"Key": key, "Code": "SlowDown"})
+                else:
+                    self.objects.pop(key, None)
+        return {"Errors": errors} if errors else {}
+
+    def create_multipart_upload(self, Bucket: str, Key: str) -> dict:
+        self.__check(Bucket, Key)
+        with self.__lock:
+            upload_id = f"upload-{len(self.multipart_uploads)}"
+            self.multipart_uploads[upload_id] = (Key, {})
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str,
+                    PartNumber: int, Body: bytes) -> dict:
+        self.__check(Bucket, Key)
+        if (Key, PartNumber) in self.failing_parts:
+            raise IOError(f"Simulated failure for part {PartNumber} of {Key}")
+        with self.__lock:
+            (key, parts) = self.multipart_uploads[UploadId]
+            assert key == Key
+            parts[PartNumber] = Body
+            self.uploaded_parts.append((Key, PartNumber))
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def list_parts(self,
+                   Bucket: str,
+                   Key: str,
+                   UploadId: str,
+                   PartNumberMarker: int = 0) -> dict:
+        self.__check(Bucket, Key)
+        (_, parts) = self.multipart_uploads[UploadId]
+        return {
+            "Parts": [{
+                "PartNumber": number,
+                "ETag": f"etag-{number}",
+                "Size": len(body)
+            } for (number, body) in sorted(parts.items())
+                      if number > PartNumberMarker],
+            "IsTruncated": False
+        }
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str,
+                                  MultipartUpload: dict) -> None:
+        self.__check(Bucket, Key)
+        with self.__lock:
+            (_, parts) = self.multipart_uploads.pop(UploadId)
+            self.objects[Key] = b"".join(
+                parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+            self.metadata[Key] = {}
+            self.uploaded_keys.append(Key)
+
+    def abort_multipart_upload(self, Bucket: str, Key: str,
+                               UploadId: str) -> None:
+        self.__check(Bucket, Key)
+        with self.__lock:
+            del self.multipart_uploads[UploadId]
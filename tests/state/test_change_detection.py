@@ -1,9 +1,11 @@
 from collections import Counter
 import logging
+import os
 from pathlib import Path
+from unittest.mock import patch
 import pytest
 from pyups.state.store import StateStore
-from pyups.state.repository import StateRepository, Change
+from pyups.state.repository import MOVED, StateRepository, Change
 """
 This describes the initial content that will be set up for the tests. The keys
 are the names of the file or directory. If the value, is a `str`, then it is
@@ -148,3 +150,242 @@ def test_detect_single_character_change(tmp_path: Path) -> None:
     changes = [c.item_path for c in repository.changes()]
 
     assert changes == [file_path]
+
+
+def __age_content(repository_path: Path) -> None:
+    """
+    Moves the modification time of the sample content back an hour, so that
+    it is old enough for its metadata to be trusted.
+    """
+    for name in CONTENT.keys():
+        item_path = repository_path.joinpath(name)
+        stats = item_path.stat()
+        os.utime(item_path,
+                 ns=(stats.st_atime_ns, stats.st_mtime_ns - 3600 * 10**9))
+
+
+def test_unchanged_metadata_skips_hash(repository_path: Path) -> None:
+    __age_content(repository_path)
+    repository = StateRepository(root_path=repository_path)
+    for c in repository.changes():
+        c.commit()
+
+    with patch("pyups.state.repository.calculate_states") as calculate:
+        changes = [c for c in repository.changes()]
+
+    assert changes == []
+    assert calculate.call_count == 0
+    assert repository.skipped == len(CONTENT)
+
+
+def test_paranoid_hashes_unchanged_metadata(repository_path: Path) -> None:
+    __age_content(repository_path)
+    repository = StateRepository(root_path=repository_path, paranoid=True)
+    for c in repository.changes():
+        c.commit()
+
+    changes = [c for c in repository.changes()]
+
+    assert changes == []
+    assert repository.skipped == 0
+
+
+def test_touched_file_refreshes_metadata(repository_path: Path) -> None:
+    __age_content(repository_path)
+    repository = StateRepository(root_path=repository_path)
+    for c in repository.changes():
+        c.commit()
+
+    # Only the modification time changes, the content stays the same.
+    item_path = repository_path.joinpath("names.txt")
+    stats = item_path.stat()
+    os.utime(item_path, ns=(stats.st_atime_ns, stats.st_mtime_ns + 10**9))
+
+    changes = [c for c in repository.changes()]
+
+    assert [c.item for c in changes] == [Path("names.txt")]
+    assert not changes[0].previous_state.has_changed(changes[0].new_state)
+
+
+def test_changes_with_hash_workers(repository_path: Path) -> None:
+    sequential = StateRepository(root_path=repository_path)
+    expected = [(c.item, c.new_state) for c in sequential.changes()]
+
+    parallel = StateRepository(root_path=repository_path, hash_workers=3)
+    actual = [(c.item, c.new_state) for c in parallel.changes()]
+
+    assert actual == expected
+
+
+def test_linked_data_directory_is_skipped(repository_path: Path) -> None:
+    repository = StateRepository(root_path=repository_path)
+    for c in repository.changes():
+        c.commit()
+
+    repository_path.joinpath("link").symlink_to(
+        repository_path.joinpath(".pyups"), target_is_directory=True)
+
+    assert [c for c in repository.changes()] == []
+
+
+def test_move_after_commit(repository_path: Path) -> None:
+    repository = StateRepository(root_path=repository_path)
+    for c in repository.changes():
+        c.commit()
+
+    repository_path.joinpath("reports").rename(
+        repository_path.joinpath("archive"))
+    changes = [c for c in repository.changes()]
+
+    assert [(c.kind, c.moved_from, c.item) for c in changes
+            ] == [(MOVED, Path("reports/scores.csv"), Path("archive/scores.csv"))]
+
+    changes[0].commit()
+    assert [c for c in repository.changes()] == []
+    assert Path("reports/scores.csv") not in repository.state_store.stored_items()
+
+
+def test_excluded_directory_is_not_walked(repository_path: Path) -> None:
+    repository_path.joinpath(".pyupsignore").write_text("reports/\n*.doc\n")
+    scanned = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        scanned.append(Path(path))
+        return scandir(path)
+
+    repository = StateRepository(root_path=repository_path)
+    with patch("os.scandir", side_effect=recording_scandir):
+        changes = [c.item for c in repository.changes()]
+
+    assert Counter(changes) == Counter(
+        [Path("document"),
+         Path("names.txt"),
+         Path(".pyupsignore")])
+    assert repository_path.joinpath("reports") not in scanned
+    assert repository.stats.to_dict()["counters"]["directories_excluded"] == 1
+
+
+@pytest.mark.parametrize("excluded_items,expected", [("keep", []),
+                                                     ("delete",
+                                                      [Path("story.doc")])])
+def test_newly_excluded_items(repository_path: Path, excluded_items: str,
+                              expected: list) -> None:
+    repository = StateRepository(root_path=repository_path)
+    for c in repository.changes():
+        c.commit()
+    repository.close()
+
+    repository = StateRepository(root_path=repository_path,
+                                 ignore_patterns=["*.doc"],
+                                 excluded_items=excluded_items)
+    changes = [c for c in repository.changes()]
+
+    assert [c.item for c in changes] == expected
+    assert all(c.new_state is None for c in changes)
+    assert repository.stats.to_dict()["counters"]["excluded_items"] == 1
+
+
+def test_changes_in_paths(repository_path: Path) -> None:
+    repository = StateRepository(root_path=repository_path)
+    for c in repository.changes():
+        c.commit()
+
+    repository_path.joinpath("names.txt").write_text("Changed")
+    repository_path.joinpath("story.doc").write_text("Changed")
+    repository_path.joinpath("reports/scores.csv").unlink()
+    repository_path.joinpath("reports/new.csv").write_text("7, 8, 9")
+    changes = [(c.item, c.kind) for c in repository.changes(
+        paths=[Path("names.txt"),
+               Path("reports"),
+               Path("reports/new.csv")])]
+
+    # The change to story.doc is not looked for.
+    assert Counter(changes) == Counter([(Path("names.txt"), "modified"),
+                                        (Path("reports/new.csv"), "new"),
+                                        (Path("reports/scores.csv"), "deleted")
+                                        ])
+
+
+def __age_directories(repository_path: Path) -> None:
+    """
+    Sets the modification times of the repository's directories back, so that
+    they are outside the window in which their entries may change unseen.
+    """
+    for directory in [repository_path, repository_path.joinpath("reports")]:
+        stats = directory.stat()
+        os.utime(directory,
+                 ns=(stats.st_atime_ns, stats.st_mtime_ns - 3600 * 10**9))
+
+
+def __list_directories(repository: StateRepository) -> None:
+    for c in repository.changes():
+        c.commit()
+    __age_directories(repository.root_path)
+    assert [c for c in repository.changes()] == []
+
+
+def test_unchanged_directories_are_not_listed(repository_path: Path) -> None:
+    repository = StateRepository(root_path=repository_path,
+                                 skip_unchanged_directories=True)
+    __list_directories(repository)
+
+    repository_path.joinpath("reports/new.csv").write_text("7, 8, 9")
+    scanned = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        scanned.append(Path(path))
+        return scandir(path)
+
+    with patch("os.scandir", side_effect=recording_scandir):
+        changes = [(c.item, c.kind) for c in repository.changes()]
+
+    assert changes == [(Path("reports/new.csv"), "new")]
+    assert scanned == [repository_path.joinpath("reports")]
+    assert repository.stats.to_dict()["counters"]["directories_reused"] == 1
+
+
+def test_deleted_item_in_unlisted_directory(repository_path: Path) -> None:
+    repository = StateRepository(root_path=repository_path,
+                                 skip_unchanged_directories=True)
+    __list_directories(repository)
+
+    repository_path.joinpath("reports/scores.csv").unlink()
+    changes = [(c.item, c.kind) for c in repository.changes()]
+
+    assert changes == [(Path("reports/scores.csv"), "deleted")]
+
+
+@pytest.mark.parametrize("paranoid", [False, True])
+def test_modified_item_in_unchanged_directory(repository_path: Path,
+                                              paranoid: bool) -> None:
+    """
+    A file modified in place does not change its directory, but is still found
+    as the files of an unchanged directory are checked.
+    """
+    repository = StateRepository(root_path=repository_path,
+                                 skip_unchanged_directories=True)
+    __list_directories(repository)
+
+    repository.close()
+
+    repository_path.joinpath("names.txt").write_text("Changed")
+    repository = StateRepository(root_path=repository_path,
+                                 paranoid=paranoid,
+                                 skip_unchanged_directories=True)
+    changes = [c.item for c in repository.changes()]
+
+    assert changes == [Path("names.txt")]
+
+
+def test_deferred_changes_are_yielded_during_walk(tmp_path: Path) -> None:
+    for i in range(200):
+        tmp_path.joinpath(f"file{i}").write_text(str(i))
+    repository = StateRepository(root_path=tmp_path)
+
+    changes = repository.changes(defer_hash=lambda stats: True)
+    next(changes)
+
+    assert repository.stats.to_dict()["counters"]["files_scanned"] < 200
+    assert len(list(changes)) == 199
@@ -0,0 +1,44 @@
+from pathlib import Path
+import pytest
+from pyups.state.ignore import IgnoreRules
+
+
+@pytest.mark.parametrize("patterns,item,directory,ignored", [
+    (["*.pyc"], "module.pyc", False, True),
+    (["*.pyc"], "package/module.pyc", False, True),
+    (["*.pyc"], "module.py", False, False),
+    (["build/"], "build", True, True),
+    (["build/"], "src/build", True, True),
+    (["build/"], "build", False, False),
+    (["/build"], "src/build", True, False),
+    (["docs/*.txt"], "docs/notes.txt", False, True),
+    (["docs/*.txt"], "docs/old/notes.txt", False, False),
+    (["docs/*.txt"], "src/docs/notes.txt", False, False),
+    (["**/cache"], "a/b/cache", True, True),
+    (["logs/**/*.log"], "logs/app.log", False, True),
+    (["logs/**/*.log"], "logs/2020/01/app.log", False, True),
+    (["logs/**"], "logs/app.log", False, True),
+    (["report?.csv"], "report1.csv", False, True),
+    (["report[0-9].csv"], "reporta.csv", False, False),
+    (["report[!0-9].csv"], "reporta.csv", False, True),
+    (["\\#notes"], "#notes", False, True),
+    (["# comment", ""], "# comment", False, False),
+    (["*.log", "!keep.log"], "keep.log", False, False),
+    (["*.log", "!keep.log"], "other.log", False, True),
+    (["!keep.log", "*.log"], "keep.log", False, True),
+])
+def test_ignores(patterns: list, item: str, directory: bool,
+                 ignored: bool) -> None:
+    assert IgnoreRules(patterns).ignores(item, directory) == ignored
+
+
+def test_excludes_items_under_excluded_directory() -> None:
+    """
+    As with git, an item cannot be included again if a directory above it is
+    excluded.
+    """
+    rules = IgnoreRules(["node_modules/", "!*.json"])
+
+    assert rules.excludes(Path("web/node_modules/lib/package.json"))
+    assert not rules.excludes(Path("web/package.json"))
+    assert not IgnoreRules([]).excludes(Path("web/package.json"))
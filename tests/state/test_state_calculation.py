@@ -1,4 +1,5 @@
 import base64
+import hashlib
 import logging
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -74,3 +75,20 @@ def test_calculate_state(sample) -> None:
     actual = {"size": calculated.size, "hash": calculated.content_hash}
 
     assert actual == expected
+
+
+def test_calculate_hashes_of_large_file(tmp_path, monkeypatch) -> None:
+    """
+    Content spanning several reads is hashed the same as it is by `hashlib`.
+    """
+    monkeypatch.setattr(state, "RELEASE_INTERVAL", state.READ_SIZE)
+    content = bytes(range(256)) * (state.READ_SIZE * 3 // 256 + 7)
+    path = tmp_path.joinpath("large")
+    path.write_bytes(content)
+
+    hashes = state.calculate_hashes(path, [state.SHA3_256, state.BLAKE2B])
+
+    assert hashes == {
+        state.SHA3_256: hashlib.sha3_256(content).hexdigest(),
+        state.BLAKE2B: hashlib.blake2b(content, digest_size=32).hexdigest()
+    }
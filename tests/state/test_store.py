@@ -1,4 +1,7 @@
 from pathlib import Path
+import sqlite3
+import time
+import pytest
 from pyups.state.model import State
 from pyups.state.store import StateStore
 
@@ -24,3 +27,115 @@ def test_get_item(tmp_path: Path) -> None:
     store.store_state(item=item, state=state)
 
     assert store.get_state(item) == State(size=147, content_hash="acef468")
+
+
+def test_get_item_metadata(tmp_path: Path) -> None:
+    item = Path("sample_item")
+    store = StateStore(store_root=tmp_path)
+    state = State(size=147,
+                  content_hash="acef468",
+                  mtime_ns=1600000000000000000,
+                  inode=42,
+                  device=7)
+    store.store_state(item=item, state=state)
+
+    stored = store.get_state(item)
+    assert (stored.mtime_ns, stored.inode,
+            stored.device) == (1600000000000000000, 42, 7)
+
+
+def test_store_several_items(tmp_path: Path) -> None:
+    store = StateStore(store_root=tmp_path)
+    store.store_states([(Path("b"), State(size=1, content_hash="b")),
+                        (Path("a/c"), State(size=2, content_hash="c")),
+                        (Path("a"), State(size=3, content_hash="a"))])
+    store.store_states([(Path("b"), None)])
+
+    assert [x for x in store.stored_items()] == [Path("a"), Path("a/c")]
+
+
+def test_migrate_legacy_store(tmp_path: Path) -> None:
+    legacy_state = tmp_path.joinpath("state", "reports", "scores.csv")
+    legacy_state.parent.mkdir(parents=True)
+    legacy_state.write_text("size: 147\nhash: acef468\n")
+
+    store = StateStore(store_root=tmp_path)
+
+    assert [x for x in store.stored_items()] == [Path("reports/scores.csv")]
+    assert store.get_state(Path("reports/scores.csv")) == State(
+        size=147, content_hash="acef468")
+    assert not tmp_path.joinpath("state").exists()
+
+
+def test_group_commit(tmp_path: Path) -> None:
+    store = StateStore(store_root=tmp_path, batch_size=3)
+    reader = StateStore(store_root=tmp_path)
+    store.store_states([(Path("a"), State(size=1, content_hash="a"))])
+    store.store_chunks(Path("a"), [("x", 1)])
+
+    # Pending states are visible through the store that holds them.
+    assert store.get_state(Path("a")) == State(size=1, content_hash="a")
+    assert store.get_chunks(Path("a")) == [("x", 1)]
+    assert reader.get_state(Path("a")) is None
+
+    store.store_states([(Path("b"), State(size=2, content_hash="b"))])
+    assert reader.get_state(Path("a")) == State(size=1, content_hash="a")
+    assert reader.get_chunks(Path("a")) == [("x", 1)]
+
+    store.store_states([(Path("a"), None)])
+    assert store.get_state(Path("a")) is None
+    assert store.get_chunks(Path("a")) == []
+    store.close()
+    assert [x for x in reader.stored_items()] == [Path("b")]
+
+
+def test_children(tmp_path: Path) -> None:
+    store = StateStore(store_root=tmp_path)
+    store.store_states([(Path(name), State(size=1, content_hash=name))
+                        for name in ["a", "b/c", "b/d/e", "b/d0", "b0/f"]])
+    store.store_directories([(Path("b"), 100, 3, "rules"),
+                             (Path("b/d"), 200, 1, "rules"),
+                             (Path("b0"), 300, 1, "rules")])
+
+    assert [item for (item, _) in store.child_states(Path("."))] == [
+        Path("a")
+    ]
+    assert [item for (item, _) in store.child_states(Path("b"))
+            ] == [Path("b/c"), Path("b/d0")]
+    assert store.child_directories(Path(".")) == [Path("b"), Path("b0")]
+    assert store.child_directories(Path("b")) == [Path("b/d")]
+    assert store.get_directory(Path("b")) == (100, 3, "rules")
+
+    store.remove_directories([Path("b")], subtrees=True)
+    assert store.get_directory(Path("b")) is None
+    assert store.get_directory(Path("b/d")) is None
+
+
+def test_failed_schema_upgrade_is_rolled_back(tmp_path: Path,
+                                              monkeypatch) -> None:
+    schema = StateStore._StateStore__SCHEMA
+    monkeypatch.setattr(StateStore, "_StateStore__SCHEMA",
+                        schema + ["ALTER TABLE missing ADD COLUMN x INTEGER"])
+    with pytest.raises(sqlite3.OperationalError):
+        StateStore(store_root=tmp_path).store_state(
+            Path("a"), State(size=1, content_hash="a"))
+
+    monkeypatch.setattr(StateStore, "_StateStore__SCHEMA", schema)
+    store = StateStore(store_root=tmp_path)
+    store.store_state(Path("a"), State(size=1, content_hash="a"))
+    store.flush()
+    assert [x for x in store.stored_items()] == [Path("a")]
+
+
+def test_group_commit_interval(tmp_path: Path) -> None:
+    store = StateStore(store_root=tmp_path, batch_size=100, batch_interval=0.1)
+    reader = StateStore(store_root=tmp_path)
+    store.store_states([(Path("a"), State(size=1, content_hash="a"))])
+    assert reader.get_state(Path("a")) is None
+
+    # The batch is written once the interval has passed, without another write
+    # to the store.
+    deadline = time.monotonic() + 5
+    while reader.get_state(Path("a")) is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert reader.get_state(Path("a")) == State(size=1, content_hash="a")
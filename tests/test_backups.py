@@ -0,0 +1,383 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import random
+import pyAesCrypt
+import pytest
+from pyups import (backups, chunking, compression, deletion, encryption,
+                   manifest)
+from pyups.configuration import (Configuration, EXCLUDED_DELETE,
+                                 LAYOUT_CONTENT_ADDRESSED, LAYOUT_PATH)
+from pyups.state.repository import StateRepository
+from pyups.stats import RunStats
+from tests.fake_s3 import FakeS3Client
+
+CONTENT = {
+    "names.txt": "Adam Eve Jack Jill Hansel Gretel",
+    "reports/scores.csv": "1, 2, 3\n4, 5, 6\n",
+    "reports/2020/summary.txt": "Nothing to report."
+}
+
+
+@pytest.fixture
+def repository_path(tmp_path) -> Path:
+    """
+    Prepares a directory with sample content to back up.
+    """
+    for (name, entry) in CONTENT.items():
+        file_path = tmp_path.joinpath(name)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(entry)
+
+    return tmp_path
+
+
+@pytest.fixture
+def client() -> FakeS3Client:
+    return FakeS3Client(bucket="bucket")
+
+
+def __backup(repository_path: Path, client: FakeS3Client) -> None:
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket"),
+                   upload_workers=2,
+                   client=client)
+
+
+def test_backup_uploads_content(repository_path: Path,
+                                client: FakeS3Client) -> None:
+    __backup(repository_path, client)
+
+    assert client.objects_under("content/") == {
+        f"content/{name}": bytes(entry, "utf-8")
+        for (name, entry) in CONTENT.items()
+    }
+    assert manifest.INDEX_KEY in client.objects
+    assert [c for c in StateRepository(repository_path).changes()] == []
+
+
+def test_failed_upload_is_not_committed(repository_path: Path,
+                                        client: FakeS3Client) -> None:
+    client.failing_keys.add("content/names.txt")
+    __backup(repository_path, client)
+
+    changes = [c.item for c in StateRepository(repository_path).changes()]
+    assert changes == [Path("names.txt")]
+
+
+def test_new_content_is_hashed_while_uploaded(repository_path: Path,
+                                             client: FakeS3Client) -> None:
+    """
+    New files are only read once, by the upload, which also hashes them.
+    """
+    stats = RunStats()
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket", encryption_password="pw"),
+                   client=client,
+                   stats=stats)
+
+    assert stats.to_dict()["counters"]["hashes_deferred"] == len(CONTENT)
+    repository = StateRepository(repository_path)
+    assert [c for c in repository.changes()] == []
+    assert {
+        item.as_posix(): state.content_hash
+        for (item, state) in repository.state_store.stored_states()
+    } == {
+        name: hashlib.sha3_256(bytes(entry, "utf-8")).hexdigest()
+        for (name, entry) in CONTENT.items()
+    }
+
+
+def test_failed_upload_in_unchanged_directory_is_retried(
+        repository_path: Path, client: FakeS3Client) -> None:
+    """
+    The directory of an item that could not be backed up is listed again by the
+    next backup, even if the directory does not change again.
+    """
+    configuration = Configuration(s3_bucket="bucket",
+                                  skip_unchanged_directories=True)
+    backups.backup(repository_path, configuration, client=client)
+    # Replacing the file changes its directory.
+    replacement = repository_path.joinpath("names.new")
+    replacement.write_text("Changed!")
+    replacement.replace(repository_path.joinpath("names.txt"))
+    stats = repository_path.stat()
+    os.utime(repository_path,
+             ns=(stats.st_atime_ns, stats.st_mtime_ns - 3600 * 10**9))
+
+    client.failing_keys.add("content/names.txt")
+    assert backups.backup(repository_path, configuration,
+                          client=client) == [Path("names.txt")]
+    client.failing_keys.clear()
+    assert backups.backup(repository_path, configuration, client=client) == []
+
+    assert client.objects["content/names.txt"] == b"Changed!"
+
+
+def test_file_modified_in_place_in_unchanged_directory(
+        repository_path: Path, client: FakeS3Client) -> None:
+    """
+    A file that is modified in place is backed up, even though its directory
+    is not listed again.
+    """
+    configuration = Configuration(s3_bucket="bucket",
+                                  skip_unchanged_directories=True)
+    backups.backup(repository_path, configuration, client=client)
+    stats = repository_path.stat()
+    os.utime(repository_path,
+             ns=(stats.st_atime_ns, stats.st_mtime_ns - 3600 * 10**9))
+    backups.backup(repository_path, configuration, client=client)
+
+    with repository_path.joinpath("names.txt").open("r+") as names:
+        names.write("Changed!")
+    run_stats = RunStats()
+    assert backups.backup(repository_path,
+                          configuration,
+                          client=client,
+                          stats=run_stats) == []
+
+    assert client.objects["content/names.txt"].startswith(b"Changed!")
+    assert run_stats.to_dict()["counters"]["directories_reused"] >= 1
+
+
+def test_file_changed_during_upload_is_not_committed(
+        repository_path: Path, client: FakeS3Client) -> None:
+    upload_fileobj = client.upload_fileobj
+
+    def upload_and_change(Fileobj, Bucket: str, Key: str, **kwargs) -> None:
+        upload_fileobj(Fileobj, Bucket, Key, **kwargs)
+        if Key == "content/names.txt":
+            repository_path.joinpath("names.txt").write_text("Changed!")
+
+    client.upload_fileobj = upload_and_change
+    stats = RunStats()
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket"),
+                   client=client,
+                   stats=stats)
+
+    assert stats.to_dict()["counters"]["uploads_torn"] == 1
+    changes = [c.item for c in StateRepository(repository_path).changes()]
+    assert changes == [Path("names.txt")]
+
+
+def test_backup_deletes_removed_item(repository_path: Path,
+                                     client: FakeS3Client) -> None:
+    __backup(repository_path, client)
+    repository_path.joinpath("names.txt").unlink()
+    __backup(repository_path, client)
+
+    assert "content/names.txt" not in client.objects
+    assert [c for c in StateRepository(repository_path).changes()] == []
+
+
+def test_backup_deletes_excluded_item(repository_path: Path,
+                                      client: FakeS3Client) -> None:
+    __backup(repository_path, client)
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket",
+                                 ignore_patterns=["reports/"],
+                                 excluded_items=EXCLUDED_DELETE),
+                   client=client)
+
+    assert list(client.objects_under("content/")) == ["content/names.txt"]
+    assert repository_path.joinpath("reports/scores.csv").exists()
+    items = manifest.RemoteManifest(client=client, bucket="bucket").read()
+    assert list(items) == [Path("names.txt")]
+
+
+def test_failed_delete_is_not_committed(repository_path: Path,
+                                        client: FakeS3Client,
+                                        monkeypatch) -> None:
+    monkeypatch.setattr(deletion, "RETRY_DELAY", 0)
+    __backup(repository_path, client)
+    repository_path.joinpath("names.txt").unlink()
+    repository_path.joinpath("reports/scores.csv").unlink()
+    client.failing_keys.add("content/names.txt")
+    client.throttled_keys["content/reports/scores.csv"] = 2
+    __backup(repository_path, client)
+
+    assert "content/reports/scores.csv" not in client.objects
+    assert [c.item for c in StateRepository(repository_path).changes()
+            ] == [Path("names.txt")]
+    items = manifest.RemoteManifest(client=client, bucket="bucket").read()
+    assert Path("names.txt") in items
+    assert Path("reports/scores.csv") not in items
+
+
+def test_deletes_are_retried_in_batches(client: FakeS3Client,
+                                        monkeypatch) -> None:
+    monkeypatch.setattr(deletion, "RETRY_DELAY", 0)
+    monkeypatch.setattr(deletion, "BATCH_SIZE", 10)
+    keys = [f"content/{i}" for i in range(95)]
+    for key in keys:
+        client.objects[key] = b""
+    client.throttled_keys = {key: 1 for key in keys[:25]}
+    client.throttled_keys["content/0"] = deletion.MAXIMUM_ATTEMPTS
+    stats = RunStats()
+
+    failed = deletion.delete_objects(client,
+                                     "bucket",
+                                     keys,
+                                     workers=4,
+                                     stats=stats)
+
+    assert failed == {"content/0": "SlowDown"}
+    assert client.objects == {"content/0": b""}
+    # 10 batches, then 3 with the throttled keys, then one for each retry of
+    # the key that is always throttled.
+    assert client.delete_requests == 10 + 3 + 3
+    counters = stats.to_dict()["counters"]
+    assert counters["objects_deleted"] == 94
+    assert counters["deletes_failed"] == 1
+    assert counters["delete_retries"] == 25 + 3
+
+
+def test_backup_encrypts_content(repository_path: Path,
+                                 client: FakeS3Client) -> None:
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket",
+                                 encryption_password="secret"),
+                   client=client)
+
+    encrypted = client.objects["content/names.txt"]
+    decrypted = io.BytesIO()
+    pyAesCrypt.decryptStream(io.BytesIO(encrypted), decrypted, "secret",
+                             encryption.BUFFER_SIZE, len(encrypted))
+
+    assert decrypted.getvalue() == bytes(CONTENT["names.txt"], "utf-8")
+
+
+def test_content_addressed_stores_duplicates_once(
+        repository_path: Path, client: FakeS3Client) -> None:
+    repository_path.joinpath("copy.txt").write_text(CONTENT["names.txt"])
+    configuration = Configuration(s3_bucket="bucket",
+                                  layout=LAYOUT_CONTENT_ADDRESSED)
+    backups.backup(repository_path, configuration, client=client)
+
+    objects = [key for key in client.objects if key.startswith("objects/")]
+    assert len(objects) == len(CONTENT)
+
+    items = manifest.RemoteManifest(client=client, bucket="bucket").read()
+    assert sorted(items) == sorted(
+        [Path(name) for name in CONTENT] + [Path("copy.txt")])
+
+
+def test_content_addressed_keeps_referenced_objects(
+        repository_path: Path, client: FakeS3Client) -> None:
+    repository_path.joinpath("copy.txt").write_text(CONTENT["names.txt"])
+    configuration = Configuration(s3_bucket="bucket",
+                                  layout=LAYOUT_CONTENT_ADDRESSED)
+    backups.backup(repository_path, configuration, client=client)
+    objects = set(client.objects_under("objects/"))
+
+    repository_path.joinpath("names.txt").unlink()
+    backups.backup(repository_path, configuration, client=client)
+    assert set(client.objects_under("objects/")) == objects
+
+    repository_path.joinpath("copy.txt").unlink()
+    backups.backup(repository_path, configuration, client=client)
+    assert len(objects - set(client.objects_under("objects/"))) == 1
+
+
+def test_changed_hash_algorithm_reuses_content(repository_path: Path,
+                                              client: FakeS3Client) -> None:
+    """
+    Content that is hashed again with a new algorithm is not uploaded again.
+    With the content-addressed layout, it is copied to its new key instead.
+    """
+    for layout in [LAYOUT_PATH, LAYOUT_CONTENT_ADDRESSED]:
+        client = FakeS3Client(bucket="bucket")
+        backups.backup(repository_path,
+                       Configuration(s3_bucket="bucket", layout=layout),
+                       client=client)
+        uploaded = len(client.uploaded_keys)
+        configuration = Configuration(s3_bucket="bucket",
+                                      layout=layout,
+                                      hash_algorithm="blake2b")
+        backups.backup(repository_path,
+                       configuration,
+                       paranoid=True,
+                       client=client)
+
+        assert [
+            key for key in client.uploaded_keys[uploaded:]
+            if not key.startswith("manifest/")
+        ] == []
+        items = manifest.RemoteManifest(client=client, bucket="bucket").read()
+        assert {state.hash_algorithm
+                for (state, _) in items.values()} == {"blake2b"}
+        assert {key for (_, key) in items.values()} == set(
+            client.objects_under("content/")).union(
+                client.objects_under("objects/"))
+        repository = StateRepository(repository_path, hash_algorithm="blake2b")
+        assert [c for c in repository.changes()] == []
+        repository.close()
+        repository_path.joinpath(".pyups", "state.db").unlink()
+
+
+def test_backup_copies_moved_item(repository_path: Path,
+                                  client: FakeS3Client) -> None:
+    __backup(repository_path, client)
+    repository_path.joinpath("names.txt").rename(
+        repository_path.joinpath("people.txt"))
+    client.uploaded_keys.clear()
+    __backup(repository_path, client)
+
+    assert [
+        key for key in client.uploaded_keys if not key.startswith("manifest/")
+    ] == []
+    assert "content/names.txt" not in client.objects
+    assert client.objects["content/people.txt"] == bytes(
+        CONTENT["names.txt"], "utf-8")
+
+
+def test_chunked_upload_sends_only_new_chunks(repository_path: Path,
+                                              client: FakeS3Client) -> None:
+    configuration = Configuration(s3_bucket="bucket",
+                                  chunk_threshold=4096,
+                                  chunk_size=256)
+    large_file = repository_path.joinpath("large.bin")
+    generator = random.Random(1)
+    content = bytes(generator.getrandbits(8) for _ in range(64 * 1024))
+    large_file.write_bytes(content)
+    backups.backup(repository_path, configuration, client=client)
+
+    assert client.metadata["content/large.bin"] == {
+        chunking.FORMAT_METADATA: chunking.RECIPE_FORMAT
+    }
+    recipe = json.loads(client.objects["content/large.bin"])
+    assert b"".join(client.objects[f"chunks/{chunk_hash}"]
+                    for (chunk_hash, _) in recipe["chunks"]) == content
+
+    large_file.write_bytes(content[:30000] + b"inserted" + content[30000:])
+    client.uploaded_keys.clear()
+    backups.backup(repository_path, configuration, client=client)
+
+    new_chunks = [k for k in client.uploaded_keys if k.startswith("chunks/")]
+    assert 0 < len(new_chunks) <= 3
+
+    large_file.unlink()
+    backups.backup(repository_path, configuration, client=client)
+    assert [k for k in client.objects if k.startswith("chunks/")] == []
+
+
+def test_backup_compresses_content(repository_path: Path,
+                                   client: FakeS3Client) -> None:
+    log = "2020-06-01 INFO Nothing happened.\n" * 1000
+    repository_path.joinpath("app.log").write_text(log)
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket",
+                                 compression_codec=compression.GZIP),
+                   client=client)
+
+    assert client.metadata["content/app.log"] == {
+        compression.CODEC_METADATA: compression.GZIP
+    }
+    assert gzip.decompress(client.objects["content/app.log"]) == bytes(
+        log, "utf-8")
+    # Content that is too small is uploaded as it is.
+    assert client.metadata["content/names.txt"] == {}
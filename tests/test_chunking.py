@@ -0,0 +1,41 @@
+import io
+import random
+import pytest
+from pyups import chunking
+
+TEST_CONTENT = bytes(random.Random(1).getrandbits(8) for _ in range(256 * 1024))
+
+
+@pytest.mark.parametrize("native", [False, True])
+def test_chunks_round_trip(native: bool, monkeypatch) -> None:
+    if native and chunking.fastcdc is None:
+        pytest.skip("The fastcdc package is not installed")
+    if not native:
+        monkeypatch.setattr(chunking, "fastcdc", None)
+    (minimum, maximum) = chunking.chunk_limits(1024)
+
+    chunk_list = list(chunking.chunks(io.BytesIO(TEST_CONTENT), 1024))
+
+    assert b"".join(chunk_list) == TEST_CONTENT
+    assert all(minimum <= len(chunk) <= maximum for chunk in chunk_list[:-1])
+
+
+@pytest.mark.skipif(chunking.fastcdc is None,
+                    reason="The fastcdc package is not installed")
+@pytest.mark.parametrize("average_size", [256, 4096])
+def test_pure_python_finds_same_boundaries(average_size: int,
+                                           monkeypatch) -> None:
+    native = list(chunking.chunks(io.BytesIO(TEST_CONTENT), average_size))
+    monkeypatch.setattr(chunking, "fastcdc", None)
+
+    assert list(chunking.chunks(io.BytesIO(TEST_CONTENT),
+                                average_size)) == native
+
+
+def test_large_files_are_not_split_in_pure_python(monkeypatch) -> None:
+    monkeypatch.setattr(chunking, "fastcdc", None)
+
+    assert chunking.splits(1024, threshold=1024)
+    assert not chunking.splits(1023, threshold=1024)
+    assert not chunking.splits(chunking.PURE_PYTHON_LIMIT, threshold=1024)
+    assert not chunking.splits(1024, threshold=None)
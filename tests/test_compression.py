@@ -0,0 +1,35 @@
+import io
+import os
+from pathlib import Path
+import pytest
+from pyups import compression
+
+TEST_CONTENT = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 200
+
+
+def test_compressed_stream_round_trip() -> None:
+    with compression.compressed_stream(io.BytesIO(TEST_CONTENT),
+                                       compression.GZIP, 6) as stream:
+        compressed = stream.read()
+
+    with compression.decompressed_stream(io.BytesIO(compressed),
+                                         compression.GZIP) as stream:
+        decompressed = stream.read()
+
+    assert len(compressed) < len(TEST_CONTENT)
+    assert decompressed == TEST_CONTENT
+
+
+@pytest.mark.parametrize("name,content,expected",
+                         [("notes.txt", TEST_CONTENT, True),
+                          ("archive.zip", TEST_CONTENT, False),
+                          ("random.bin", os.urandom(8192), False),
+                          ("tiny.txt", b"abc", False)])
+def test_should_compress(name: str, content: bytes, expected: bool) -> None:
+    assert compression.should_compress(Path(name), content, compression.GZIP,
+                                       6) == expected
+
+
+def test_unknown_codec() -> None:
+    with pytest.raises(ValueError):
+        compression.check_codec("lzw")
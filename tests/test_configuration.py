@@ -1,3 +1,4 @@
+import pytest
 from pyups import configuration
 from pyups.configuration import Configuration
 from unittest.mock import patch
@@ -136,3 +137,80 @@ def test_read_configuration_with_encryption(tmp_path) -> None:
 
     assert created_configuration == read_configuration
     assert read_configuration == read_configuration
+
+
+def test_read_configuration_with_layout(tmp_path) -> None:
+    """
+    Tests reading the layout of the bucket from the configuration file.
+    """
+    __set_up_no_encryption(s3_bucket="abc", repository_path=tmp_path)
+    config_file = tmp_path.joinpath(".pyups", "config")
+    config_file.write_text(config_file.read_text().replace(
+        "[s3]\n", "[s3]\nlayout = content-addressed\n"))
+
+    read_configuration = configuration.get_configuration(
+        repository_path=tmp_path)
+
+    assert read_configuration.layout == configuration.LAYOUT_CONTENT_ADDRESSED
+
+
+def test_read_configuration_with_hash_algorithm(tmp_path) -> None:
+    """
+    Tests reading the hash algorithm from the configuration file.
+    """
+    __set_up_no_encryption(s3_bucket="abc", repository_path=tmp_path)
+    config_file = tmp_path.joinpath(".pyups", "config")
+    config_file.write_text(config_file.read_text() +
+                           "[hashing]\nalgorithm = blake2b\n")
+
+    read_configuration = configuration.get_configuration(
+        repository_path=tmp_path)
+
+    assert read_configuration.hash_algorithm == "blake2b"
+
+
+def test_content_addressed_needs_cryptographic_hash() -> None:
+    """
+    The content-addressed layout identifies content by its hash, so a hash that
+    can be forced to collide may not be used with it.
+    """
+    with pytest.raises(ValueError):
+        Configuration(s3_bucket="abc",
+                      layout=configuration.LAYOUT_CONTENT_ADDRESSED,
+                      hash_algorithm="xxh3")
+
+
+def test_read_configuration_with_ignore_patterns(tmp_path) -> None:
+    """
+    Tests reading the ignore patterns, one on each line, and the policy for
+    excluded items from the configuration file.
+    """
+    __set_up_no_encryption(s3_bucket="abc", repository_path=tmp_path)
+    config_file = tmp_path.joinpath(".pyups", "config")
+    config_file.write_text(config_file.read_text() + "[ignore]\n"
+                           "patterns =\n    node_modules/\n    *.pyc\n"
+                           "excluded_items = delete\n")
+
+    read_configuration = configuration.get_configuration(
+        repository_path=tmp_path)
+
+    assert read_configuration.ignore_patterns == ("node_modules/", "*.pyc")
+    assert read_configuration.excluded_items == configuration.EXCLUDED_DELETE
+
+
+def test_read_configuration_with_skip_unchanged_directories(tmp_path) -> None:
+    """
+    Tests reading whether unchanged directories are listed from the
+    configuration file.
+    """
+    __set_up_no_encryption(s3_bucket="abc", repository_path=tmp_path)
+    config_file = tmp_path.joinpath(".pyups", "config")
+    assert not configuration.get_configuration(
+        repository_path=tmp_path).skip_unchanged_directories
+
+    config_file.write_text(config_file.read_text() +
+                           "[scanning]\nskip_unchanged_directories = yes\n")
+    read_configuration = configuration.get_configuration(
+        repository_path=tmp_path)
+
+    assert read_configuration.skip_unchanged_directories
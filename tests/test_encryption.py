@@ -1,4 +1,6 @@
+import io
 from pathlib import Path
+import pyAesCrypt
 import pytest
 from pyups import encryption
 
@@ -53,3 +55,20 @@ def test_encrypted_cleanup(sample_path):
 
     assert sample_path.exists()
     assert not encrypted_file.exists()
+
+
+def test_encrypted_stream(sample_path):
+    """
+    Tests that the stream provided by `encryption.encrypted_stream` can be
+    decrypted back to the original content.
+    """
+    with sample_path.open(mode="rb") as source:
+        with encryption.encrypted_stream(source, "abcdef") as stream:
+            encrypted = stream.read()
+
+    decrypted = io.BytesIO()
+    pyAesCrypt.decryptStream(io.BytesIO(encrypted), decrypted, "abcdef",
+                             encryption.BUFFER_SIZE, len(encrypted))
+
+    assert encrypted != bytearray(TEST_CONTENT, "utf8")
+    assert decrypted.getvalue() == bytearray(TEST_CONTENT, "utf8")
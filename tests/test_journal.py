@@ -0,0 +1,111 @@
+import os
+from pathlib import Path
+import pytest
+from pyups import backups
+from pyups.configuration import Configuration, DATA_PATH
+from pyups.journal import Journal, JOURNAL_NAME
+from pyups.state.repository import StateRepository
+from pyups.stats import RunStats
+from tests.fake_s3 import FakeS3Client
+
+CONTENT = bytes(range(256)) * 12
+
+
+@pytest.fixture
+def client() -> FakeS3Client:
+    return FakeS3Client(bucket="bucket")
+
+
+@pytest.fixture
+def small_parts(monkeypatch) -> None:
+    """
+    Makes files large enough to be uploaded in several parts.
+    """
+    monkeypatch.setattr(backups, "MULTIPART_THRESHOLD", 1024)
+    monkeypatch.setattr(backups, "PART_SIZE", 1024)
+
+
+def __backup(repository_path: Path, client: FakeS3Client,
+             stats: RunStats = None) -> None:
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket"),
+                   client=client,
+                   stats=stats)
+
+
+def __journal_path(repository_path: Path) -> Path:
+    return repository_path.joinpath(DATA_PATH, JOURNAL_NAME)
+
+
+def test_failed_upload_resumes_from_missing_parts(tmp_path: Path,
+                                                  client: FakeS3Client,
+                                                  small_parts) -> None:
+    """
+    Only the parts that were not uploaded by a failed upload are uploaded by
+    the next backup.
+    """
+    tmp_path.joinpath("large.bin").write_bytes(CONTENT)
+    client.failing_parts.add(("content/large.bin", 2))
+    __backup(tmp_path, client)
+
+    assert "content/large.bin" not in client.objects
+    assert __journal_path(tmp_path).exists()
+
+    client.failing_parts.clear()
+    client.uploaded_parts.clear()
+    __backup(tmp_path, client)
+
+    assert client.objects["content/large.bin"] == CONTENT
+    assert client.uploaded_parts == [("content/large.bin", 2),
+                                     ("content/large.bin", 3)]
+    assert client.multipart_uploads == {}
+    assert not __journal_path(tmp_path).exists()
+
+
+def test_interrupted_backup_resumes_without_hashing(
+        tmp_path: Path, client: FakeS3Client) -> None:
+    """
+    Changes recorded in the journal by a backup that did not finish are backed
+    up without their files being hashed again.
+    """
+    file_path = tmp_path.joinpath("names.txt")
+    file_path.write_text("Adam Eve Jack Jill Hansel Gretel")
+    stats = file_path.stat()
+    os.utime(file_path,
+             ns=(stats.st_atime_ns, stats.st_mtime_ns - 3600 * 10**9))
+
+    states = StateRepository(root_path=tmp_path)
+    journal = Journal(tmp_path.joinpath(DATA_PATH))
+    for c in states.changes():
+        journal.record_change(c)
+    journal.close()
+    states.close()
+
+    run_stats = RunStats()
+    __backup(tmp_path, client, run_stats)
+
+    assert client.objects_under("content/") == {
+        "content/names.txt": b"Adam Eve Jack Jill Hansel Gretel"
+    }
+    assert "files_hashed" not in run_stats.to_dict()["counters"]
+    assert not __journal_path(tmp_path).exists()
+    assert [c for c in StateRepository(tmp_path).changes()] == []
+
+
+def test_stale_upload_is_aborted(tmp_path: Path,
+                                 client: FakeS3Client) -> None:
+    """
+    An open upload in the journal, which the next backup does not continue, is
+    aborted.
+    """
+    tmp_path.joinpath("names.txt").write_text("Adam Eve")
+    upload_id = client.create_multipart_upload(
+        Bucket="bucket", Key="content/removed.bin")["UploadId"]
+    journal = Journal(tmp_path.joinpath(DATA_PATH))
+    journal.record_upload("content/removed.bin", "0" * 64, upload_id, 1024)
+    journal.close()
+
+    __backup(tmp_path, client)
+
+    assert client.multipart_uploads == {}
+    assert not __journal_path(tmp_path).exists()
@@ -0,0 +1,151 @@
+import json
+from pathlib import Path
+import tempfile
+import pytest
+from pyups import backups, manifest
+from pyups.configuration import Configuration
+from pyups.state.model import State
+from pyups.stats import RunStats
+from tests.fake_s3 import FakeS3Client
+
+
+@pytest.fixture
+def client() -> FakeS3Client:
+    return FakeS3Client(bucket="bucket")
+
+
+def __index(client: FakeS3Client) -> dict:
+    return json.loads(client.objects[manifest.INDEX_KEY])
+
+
+def test_backups_append_deltas(tmp_path: Path, client: FakeS3Client) -> None:
+    """
+    Each backup adds a delta with the items that it changed, which is applied
+    on top of the base when the manifest is read.
+    """
+    configuration = Configuration(s3_bucket="bucket")
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        tmp_path.joinpath(name).write_text(name)
+    backups.backup(tmp_path, configuration, client=client)
+    assert __index(client)["base"]["entries"] == 3
+
+    tmp_path.joinpath("a.txt").write_text("changed")
+    tmp_path.joinpath("c.txt").unlink()
+    backups.backup(tmp_path, configuration, client=client)
+
+    index = __index(client)
+    assert [segment["entries"] for segment in index["deltas"]] == [2]
+    items = manifest.RemoteManifest(client=client, bucket="bucket").read()
+    assert {item: (state.size, key)
+            for (item, (state, key)) in items.items()} == {
+                Path("a.txt"): (7, "content/a.txt"),
+                Path("b.txt"): (5, "content/b.txt")
+            }
+
+
+def test_deltas_are_compacted(client: FakeS3Client, monkeypatch) -> None:
+    monkeypatch.setattr(manifest, "MAXIMUM_DELTAS", 2)
+    remote = manifest.RemoteManifest(client=client, bucket="bucket")
+    entries = [(Path(f"item{i}"), State(size=i, content_hash=f"{i}"),
+                f"content/item{i}") for i in range(10)]
+    remote.update(changed=[], all_entries=entries)
+    remote.update(changed=entries[:1], all_entries=entries)
+    remote.update(changed=entries[1:2], all_entries=entries)
+    assert len(__index(client)["deltas"]) == 2
+
+    remote.update(changed=entries[2:3], all_entries=entries)
+
+    assert __index(client)["deltas"] == []
+    segments = [key for key in client.objects if key.startswith("manifest/")]
+    assert sorted(segments) == sorted(
+        [manifest.INDEX_KEY, __index(client)["base"]["key"]])
+    assert len(remote.read()) == 10
+
+
+def test_encrypted_manifest(tmp_path: Path, client: FakeS3Client) -> None:
+    tmp_path.joinpath("a.txt").write_text("secret content")
+    backups.backup(tmp_path,
+                   Configuration(s3_bucket="bucket",
+                                 encryption_password="secret"),
+                   client=client)
+
+    base = __index(client)["base"]
+    assert base["encrypted"]
+    assert b"a.txt" not in client.objects[base["key"]]
+    with pytest.raises(ValueError):
+        manifest.RemoteManifest(client=client, bucket="bucket").read()
+    items = manifest.RemoteManifest(client=client,
+                                    bucket="bucket",
+                                    encryption_password="secret").read()
+    assert list(items) == [Path("a.txt")]
+
+
+def test_manifest_is_streamed(tmp_path: Path, client: FakeS3Client,
+                              monkeypatch) -> None:
+    """
+    Segments are compressed, encrypted, decrypted and decompressed as they are
+    transferred, without temporary files.
+    """
+    def no_temporary_file(*args, **kwargs):
+        raise AssertionError("A temporary file was used")
+
+    monkeypatch.setattr(tempfile, "TemporaryFile", no_temporary_file)
+    remote = manifest.RemoteManifest(client=client,
+                                     bucket="bucket",
+                                     encryption_password="secret")
+    entries = [(Path(f"item{i}"), State(size=i, content_hash=f"{i}"),
+                f"content/item{i}") for i in range(5000)]
+    remote.update(changed=[], all_entries=entries)
+    remote.update(changed=[(Path("item0"), None, None)], all_entries=[])
+
+    items = remote.read()
+
+    assert len(items) == 4999
+    assert items[Path("item42")] == (State(size=42, content_hash="42"),
+                                     "content/item42")
+
+
+def test_failed_update_rebases_next_time(tmp_path: Path,
+                                         client: FakeS3Client) -> None:
+    configuration = Configuration(s3_bucket="bucket")
+    tmp_path.joinpath("a.txt").write_text("a")
+    backups.backup(tmp_path, configuration, client=client)
+
+    tmp_path.joinpath("b.txt").write_text("b")
+    client.failing_keys.add(manifest.INDEX_KEY)
+    stats = RunStats()
+    with pytest.raises(backups.ManifestError):
+        backups.backup(tmp_path, configuration, client=client, stats=stats)
+    assert stats.to_dict()["counters"]["manifest_failures"] == 1
+    client.failing_keys.clear()
+    backups.backup(tmp_path, configuration, client=client)
+
+    assert __index(client)["base"]["entries"] == 2
+    assert __index(client)["deltas"] == []
+
+
+def test_deferred_backups_add_one_delta(tmp_path: Path,
+                                        client: FakeS3Client) -> None:
+    configuration = Configuration(s3_bucket="bucket")
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        tmp_path.joinpath(name).write_text(name)
+    backups.backup(tmp_path, configuration, client=client)
+
+    tmp_path.joinpath("a.txt").write_text("changed")
+    backups.backup(tmp_path, configuration, client=client, defer_manifest=True)
+    tmp_path.joinpath("c.txt").unlink()
+    tmp_path.joinpath("a.txt").write_text("changed again")
+    backups.backup(tmp_path, configuration, client=client, defer_manifest=True)
+    assert __index(client)["deltas"] == []
+
+    backups.update_manifest(tmp_path, configuration, client=client)
+
+    assert [segment["entries"] for segment in __index(client)["deltas"]] == [2]
+    items = manifest.RemoteManifest(client=client, bucket="bucket").read()
+    assert {item: state.size
+            for (item, (state, _)) in items.items()} == {
+                Path("a.txt"): 13,
+                Path("b.txt"): 5
+            }
+    backups.update_manifest(tmp_path, configuration, client=client)
+    assert len(__index(client)["deltas"]) == 1
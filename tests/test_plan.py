@@ -0,0 +1,80 @@
+from pathlib import Path
+import pytest
+from pyups import backups, plan
+from pyups.configuration import Configuration
+from pyups.state.repository import StateRepository
+from tests.fake_s3 import FakeS3Client
+
+CONTENT = {
+    "names.txt": "Adam Eve Jack Jill Hansel Gretel",
+    "reports/scores.csv": "1, 2, 3\n4, 5, 6\n"
+}
+
+
+@pytest.fixture
+def repository_path(tmp_path) -> Path:
+    """
+    Prepares a directory with sample content, whose plan will be written
+    outside of it.
+    """
+    repository_path = tmp_path.joinpath("repository")
+    for (name, entry) in CONTENT.items():
+        file_path = repository_path.joinpath(name)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(entry)
+
+    return repository_path
+
+
+def test_plan_summary(repository_path: Path) -> None:
+    states = StateRepository(root_path=repository_path)
+    summary = plan.create_plan(states).summary(bandwidth=10)
+
+    size = sum(len(entry) for entry in CONTENT.values())
+    assert summary[plan.NEW] == {"items": len(CONTENT), "bytes": size}
+    assert summary[plan.DELETED] == {"items": 0, "bytes": 0}
+    assert summary["upload_bytes"] == size
+    assert summary["estimated_seconds"] == round(size / 10, 1)
+
+
+def test_plan_uses_backup_configuration(repository_path: Path) -> None:
+    states = backups.open_states(
+        repository_path,
+        Configuration(s3_bucket="bucket", ignore_patterns=["reports/"]))
+    summary = plan.create_plan(states).summary(bandwidth=10)
+
+    assert summary[plan.NEW] == {
+        "items": 1,
+        "bytes": len(CONTENT["names.txt"])
+    }
+
+
+def test_apply_plan(repository_path: Path, tmp_path: Path,
+                    monkeypatch) -> None:
+    plan_file = tmp_path.joinpath("plan.json")
+    states = StateRepository(root_path=repository_path)
+    plan.create_plan(states).write(plan_file)
+    states.close()
+
+    client = FakeS3Client(bucket="bucket")
+    # Applying the plan must not scan the repository again.
+    monkeypatch.setattr(StateRepository, "changes", None)
+    backups.backup(repository_path,
+                   Configuration(s3_bucket="bucket"),
+                   client=client,
+                   plan_file=plan_file)
+
+    assert sorted(client.objects_under("content/")) == sorted(f"content/{name}"
+                                            for name in CONTENT)
+
+
+def test_apply_plan_skips_items_changed_since(repository_path: Path,
+                                              tmp_path: Path) -> None:
+    plan_file = tmp_path.joinpath("plan.json")
+    states = StateRepository(root_path=repository_path)
+    plan.create_plan(states).write(plan_file)
+
+    repository_path.joinpath("names.txt").write_text("Someone else")
+    applied = plan.read_plan(plan_file, states)
+
+    assert [c.item for c in applied.changes] == [Path("reports/scores.csv")]
@@ -0,0 +1,138 @@
+from pathlib import Path
+import random
+import pytest
+from pyups import backups, compression, restore
+from pyups.configuration import Configuration
+from tests.fake_s3 import FakeS3Client
+
+CONTENT = {
+    "names.txt": "Adam Eve Jack Jill Hansel Gretel",
+    "reports/scores.csv": "1, 2, 3\n4, 5, 6\n" * 100,
+    "reports/2020/summary.txt": "Nothing to report."
+}
+
+
+@pytest.fixture
+def repository_path(tmp_path) -> Path:
+    repository_path = tmp_path.joinpath("repository")
+    for (name, entry) in CONTENT.items():
+        file_path = repository_path.joinpath(name)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(entry)
+    return repository_path
+
+
+@pytest.fixture
+def client() -> FakeS3Client:
+    return FakeS3Client(bucket="bucket")
+
+
+def __restored(destination: Path) -> dict:
+    return {
+        path.relative_to(destination).as_posix(): path.read_text()
+        for path in destination.rglob("*") if path.is_file()
+    }
+
+
+def test_restore(repository_path: Path, tmp_path: Path,
+                 client: FakeS3Client) -> None:
+    configuration = Configuration(s3_bucket="bucket")
+    backups.backup(repository_path, configuration, client=client)
+
+    destination = tmp_path.joinpath("restored")
+    failures = restore.restore(destination, configuration, client=client)
+
+    assert failures == []
+    assert __restored(destination) == CONTENT
+
+
+def test_restore_encrypted_compressed_chunks(repository_path: Path,
+                                             tmp_path: Path,
+                                             client: FakeS3Client) -> None:
+    """
+    Chunked content is put back together, and each object is decrypted and
+    decompressed as it is downloaded.
+    """
+    generator = random.Random(7)
+    large = "".join(
+        generator.choice("abcdefgh") for _ in range(200 * 1024))
+    repository_path.joinpath("large.txt").write_text(large)
+    configuration = Configuration(s3_bucket="bucket",
+                                  encryption_password="secret",
+                                  chunk_threshold=64 * 1024,
+                                  chunk_size=16 * 1024,
+                                  compression_codec=compression.GZIP)
+    backups.backup(repository_path, configuration, client=client)
+
+    destination = tmp_path.joinpath("restored")
+    failures = restore.restore(destination, configuration, client=client)
+
+    assert failures == []
+    assert __restored(destination) == dict(CONTENT, **{"large.txt": large})
+
+
+def test_restore_moved_items(repository_path: Path, tmp_path: Path,
+                             client: FakeS3Client) -> None:
+    """
+    Items that were moved keep the metadata of their objects (e.g. their codec
+    or that they are chunked), which is needed to restore them.
+    """
+    generator = random.Random(7)
+    large = "".join(
+        generator.choice("abcdefgh") for _ in range(200 * 1024))
+    repository_path.joinpath("large.txt").write_text(large)
+    configuration = Configuration(s3_bucket="bucket",
+                                  chunk_threshold=64 * 1024,
+                                  chunk_size=16 * 1024,
+                                  compression_codec=compression.GZIP)
+    backups.backup(repository_path, configuration, client=client)
+    repository_path.joinpath("large.txt").rename(
+        repository_path.joinpath("moved.txt"))
+    repository_path.joinpath("reports/scores.csv").rename(
+        repository_path.joinpath("scores.csv"))
+    client.uploaded_keys.clear()
+    backups.backup(repository_path, configuration, client=client)
+    assert not any(key.startswith("content/") for key in client.uploaded_keys)
+
+    destination = tmp_path.joinpath("restored")
+    failures = restore.restore(destination, configuration, client=client)
+
+    assert failures == []
+    assert __restored(destination) == {
+        "names.txt": CONTENT["names.txt"],
+        "scores.csv": CONTENT["reports/scores.csv"],
+        "reports/2020/summary.txt": CONTENT["reports/2020/summary.txt"],
+        "moved.txt": large
+    }
+
+
+def test_restore_selected_items(repository_path: Path, tmp_path: Path,
+                                client: FakeS3Client) -> None:
+    configuration = Configuration(s3_bucket="bucket")
+    backups.backup(repository_path, configuration, client=client)
+
+    destination = tmp_path.joinpath("restored")
+    restore.restore(destination,
+                    configuration,
+                    patterns=["reports/2020", "*.txt"],
+                    client=client)
+
+    assert sorted(__restored(destination)) == [
+        "names.txt", "reports/2020/summary.txt"
+    ]
+
+
+def test_restore_rejects_corrupted_content(repository_path: Path,
+                                           tmp_path: Path,
+                                           client: FakeS3Client) -> None:
+    configuration = Configuration(s3_bucket="bucket")
+    backups.backup(repository_path, configuration, client=client)
+    client.objects["content/names.txt"] = b"Adam Eve Jack Jill Hansel Greta"
+
+    destination = tmp_path.joinpath("restored")
+    failures = restore.restore(destination, configuration, client=client)
+
+    assert [item for (item, _) in failures] == [Path("names.txt")]
+    assert isinstance(failures[0][1], restore.RestoreError)
+    assert "names.txt" not in __restored(destination)
+    assert "names.txt.partial" not in __restored(destination)
@@ -0,0 +1,57 @@
+from pathlib import Path
+import json
+from pyups import backups
+from pyups.configuration import Configuration
+from pyups.stats import RunStats
+from tests.fake_s3 import FakeS3Client
+
+
+def test_backup_records_stats(tmp_path: Path) -> None:
+    """
+    Backing up records the files that were hashed and uploaded, and the time of
+    each upload.
+    """
+    tmp_path.joinpath("first.txt").write_text("first")
+    tmp_path.joinpath("second.txt").write_text("second!")
+    stats = RunStats()
+    backups.backup(tmp_path,
+                   Configuration(s3_bucket="bucket"),
+                   client=FakeS3Client(bucket="bucket"),
+                   stats=stats)
+
+    result = stats.to_dict()
+    assert result["counters"]["files_hashed"] == 2
+    assert result["counters"]["bytes_hashed"] == 12
+    assert result["counters"]["files_uploaded"] == 2
+    assert result["counters"]["bytes_uploaded"] == 12
+    assert result["histograms"]["upload_seconds"]["count"] == 2
+    # The new files are hashed while they are uploaded, rather than before.
+    assert result["counters"]["hashes_deferred"] == 2
+    assert {"total", "walk", "upload"} <= result["phases"].keys()
+
+
+def test_stats_are_written(tmp_path: Path) -> None:
+    """
+    The statistics can be written as JSON and in the Prometheus text format.
+    """
+    stats = RunStats()
+    stats.count("files_uploaded", 3)
+    stats.observe("upload_seconds", 0.2)
+    stats.observe("upload_seconds", 120)
+    stats.add_time("upload", 2.5)
+
+    stats.write_json(tmp_path.joinpath("stats.json"))
+    assert json.loads(tmp_path.joinpath("stats.json").read_text(
+    ))["counters"] == {"files_uploaded": 3}
+
+    stats.write_prometheus(tmp_path.joinpath("pyups.prom"))
+    lines = tmp_path.joinpath("pyups.prom").read_text().splitlines()
+    assert 'pyups_phase_seconds{phase="upload"} 2.5' in lines
+    assert "pyups_files_uploaded 3" in lines
+    assert 'pyups_upload_seconds_bucket{le="0.1"} 0' in lines
+    assert 'pyups_upload_seconds_bucket{le="0.25"} 1' in lines
+    assert 'pyups_upload_seconds_bucket{le="+Inf"} 2' in lines
+    assert "pyups_upload_seconds_count 2" in lines
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "pyups.prom", "stats.json"
+    ]
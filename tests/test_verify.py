@@ -0,0 +1,110 @@
+from pathlib import Path
+import pytest
+from pyups import backups, compression, verify
+from pyups.configuration import Configuration, LAYOUT_CONTENT_ADDRESSED
+from tests.fake_s3 import FakeS3Client
+
+CONTENT = {
+    "names.txt": "Adam Eve Jack Jill Hansel Gretel",
+    "reports/scores.csv": "1, 2, 3\n4, 5, 6\n" * 100,
+    "reports/2020/summary.txt": "Nothing to report.",
+    "reports/copy.txt": "Nothing to report."
+}
+
+
+@pytest.fixture
+def repository_path(tmp_path) -> Path:
+    repository_path = tmp_path.joinpath("repository")
+    for (name, entry) in CONTENT.items():
+        file_path = repository_path.joinpath(name)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(entry)
+    return repository_path
+
+
+@pytest.fixture
+def client() -> FakeS3Client:
+    return FakeS3Client(bucket="bucket")
+
+
+@pytest.mark.parametrize("configuration", [
+    Configuration(s3_bucket="bucket"),
+    Configuration(s3_bucket="bucket", layout=LAYOUT_CONTENT_ADDRESSED),
+    Configuration(s3_bucket="bucket",
+                  encryption_password="secret",
+                  compression_codec=compression.GZIP,
+                  chunk_threshold=1024,
+                  chunk_size=256)
+])
+def test_verify_complete_backup(repository_path: Path, client: FakeS3Client,
+                                configuration: Configuration) -> None:
+    backups.backup(repository_path, configuration, client=client)
+
+    report = verify.verify(repository_path,
+                           configuration,
+                           sample=10,
+                           client=client)
+
+    assert report.ok
+    assert report.orphans == []
+    assert report.objects_checked == len(
+        client.objects_under("content/")) + len(
+            client.objects_under("objects/")) + len(
+                client.objects_under("chunks/")) + len(
+                    client.objects_under("manifest/"))
+    # The chunked item is not sampled, as its object is a recipe.
+    assert report.samples_checked >= len(CONTENT) - 1
+
+
+def test_modified_items_leave_no_orphans(repository_path: Path,
+                                        client: FakeS3Client) -> None:
+    """
+    The objects (and recipes) of the previous content of modified items are
+    deleted with the content-addressed layout.
+    """
+    configuration = Configuration(s3_bucket="bucket",
+                                  layout=LAYOUT_CONTENT_ADDRESSED,
+                                  chunk_threshold=1024,
+                                  chunk_size=256)
+    backups.backup(repository_path, configuration, client=client)
+    for i in range(3):
+        repository_path.joinpath("names.txt").write_text(f"Version {i}")
+        repository_path.joinpath("reports/scores.csv").write_text(
+            f"{i}, 2, 3\n" * 200)
+        backups.backup(repository_path, configuration, client=client)
+
+    report = verify.verify(repository_path, configuration, client=client)
+
+    assert report.ok
+    assert report.orphans == []
+
+
+def test_verify_finds_differences(repository_path: Path,
+                                  client: FakeS3Client) -> None:
+    """
+    Missing objects, objects of the wrong size and orphans are found by
+    listing the bucket. Wrong content of the right size is only found by the
+    sampled content checks.
+    """
+    configuration = Configuration(s3_bucket="bucket")
+    backups.backup(repository_path, configuration, client=client)
+    del client.objects["content/names.txt"]
+    client.objects["content/reports/scores.csv"] = b"truncated"
+    client.objects["content/reports/copy.txt"] = b"X" * len(
+        CONTENT["reports/copy.txt"])
+    client.objects["content/removed.txt"] = b"left behind"
+
+    report = verify.verify(repository_path,
+                           configuration,
+                           sample=10,
+                           client=client)
+
+    assert not report.ok
+    assert report.missing == ["content/names.txt"]
+    assert report.size_mismatches == [
+        ("content/reports/scores.csv", len(CONTENT["reports/scores.csv"]),
+         len("truncated"))
+    ]
+    assert report.orphans == ["content/removed.txt"]
+    assert [key for (key, _) in report.sample_failures
+            ] == ["content/reports/copy.txt"]
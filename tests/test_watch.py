@@ -0,0 +1,150 @@
+from pathlib import Path
+import threading
+import time
+import pytest
+from pyups import backups, manifest, watch
+from pyups.configuration import Configuration
+from pyups.state.ignore import IgnoreRules
+from tests.fake_s3 import FakeS3Client
+
+CONTENT = {
+    "names.txt": "Adam Eve Jack Jill Hansel Gretel",
+    "reports/scores.csv": "1, 2, 3\n4, 5, 6\n",
+    "reports/2020/summary.txt": "Nothing to report."
+}
+
+
+@pytest.fixture
+def repository_path(tmp_path) -> Path:
+    for (name, entry) in CONTENT.items():
+        file_path = tmp_path.joinpath(name)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(entry)
+    return tmp_path
+
+
+def __eventually(condition) -> None:
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def __read_until(watcher: watch.Watcher, expected: set) -> set:
+    changed = set()
+    deadline = time.monotonic() + 10
+    while not expected <= changed and time.monotonic() < deadline:
+        changed |= watcher.read(timeout=0.1)
+    return changed
+
+
+def test_inotify_watcher_reports_changes(repository_path: Path) -> None:
+    try:
+        watcher = watch.InotifyWatcher(repository_path, IgnoreRules(["2020/"]))
+    except (OSError, AttributeError):
+        pytest.skip("inotify is not available")
+    try:
+        repository_path.joinpath("names.txt").write_text("Changed")
+        repository_path.joinpath("reports/2020/summary.txt").write_text("X")
+        repository_path.joinpath("new").mkdir()
+        assert __read_until(watcher, {Path("names.txt"), Path("new")
+                                      }) == {Path("names.txt"),
+                                             Path("new")}
+
+        # Directories that are created are watched as well.
+        repository_path.joinpath("new/file.txt").write_text("New")
+        assert __read_until(watcher, {Path("new/file.txt")
+                                      }) == {Path("new/file.txt")}
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher_reports_changes(repository_path: Path) -> None:
+    watcher = watch.PollingWatcher(repository_path,
+                                   IgnoreRules(["2020/"]),
+                                   poll_interval=0)
+    repository_path.joinpath("names.txt").write_text("Changed")
+    repository_path.joinpath("reports/2020/summary.txt").write_text("X")
+    repository_path.joinpath("reports/scores.csv").unlink()
+
+    assert watcher.read(timeout=0) == {
+        Path("names.txt"), Path("reports/scores.csv")
+    }
+    assert watcher.read(timeout=0) == set()
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watch_backs_up_changed_paths(repository_path: Path, polling: bool,
+                                      monkeypatch) -> None:
+    client = FakeS3Client(bucket="bucket")
+    backed_up = []
+    backup = backups.backup
+
+    def recording_backup(*args, paths=None, **kwargs):
+        backed_up.append(paths)
+        return backup(*args, paths=paths, **kwargs)
+
+    monkeypatch.setattr(backups, "backup", recording_backup)
+    monkeypatch.setattr(watch, "MANIFEST_IDLE_DELAY", 1000)
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch.watch,
+                               args=(repository_path,
+                                     Configuration(s3_bucket="bucket")),
+                               kwargs={
+                                   "debounce": 0.05,
+                                   "poll_interval": 0.05,
+                                   "polling": polling,
+                                   "client": client,
+                                   "stop": stop
+                               })
+    watcher.start()
+    try:
+        __eventually(lambda: "content/names.txt" in client.objects)
+        repository_path.joinpath("names.txt").write_text("Changed")
+        repository_path.joinpath("reports/scores.csv").unlink()
+        __eventually(lambda: client.objects.get("content/names.txt") ==
+                     b"Changed" and "content/reports/scores.csv" not in client.
+                     objects)
+        # The manifest is only updated once the watcher is idle.
+        assert manifest.INDEX_KEY not in client.objects
+    finally:
+        stop.set()
+        watcher.join()
+
+    items = manifest.RemoteManifest(client=client, bucket="bucket").read()
+    assert sorted(items) == [
+        Path("names.txt"), Path("reports/2020/summary.txt")
+    ]
+    # Only the first backup looks at every item.
+    assert backed_up[0] is None
+    assert all(paths is not None for paths in backed_up[1:])
+    assert set().union(*backed_up[1:]) == {
+        Path("names.txt"), Path("reports/scores.csv")
+    }
+
+
+def test_watch_updates_manifest_when_idle(repository_path: Path,
+                                         monkeypatch) -> None:
+    monkeypatch.setattr(watch, "MANIFEST_IDLE_DELAY", 0.1)
+    client = FakeS3Client(bucket="bucket")
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch.watch,
+                               args=(repository_path,
+                                     Configuration(s3_bucket="bucket")),
+                               kwargs={
+                                   "debounce": 0.05,
+                                   "polling": True,
+                                   "poll_interval": 0.05,
+                                   "client": client,
+                                   "stop": stop
+                               })
+    watcher.start()
+    try:
+        __eventually(lambda: manifest.INDEX_KEY in client.objects)
+        repository_path.joinpath("names.txt").write_text("Changed")
+        __eventually(lambda: manifest.RemoteManifest(
+            client=client, bucket="bucket").read()[Path("names.txt")][0].size
+                     == len("Changed"))
+    finally:
+        stop.set()
+        watcher.join()